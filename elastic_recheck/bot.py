@@ -43,6 +43,7 @@ openstack-qa:
 
 import argparse
 import daemon
+import functools
 import os
 import textwrap
 import threading
@@ -52,8 +53,12 @@ import yaml
 import irc.bot
 from launchpadlib import launchpad
 
+from elastic_recheck import catchup as er_catchup
 import elastic_recheck.config as er_conf
+import elastic_recheck.feed as er_feed
+import elastic_recheck.journal as er_journal
 from elastic_recheck import log as logging
+from elastic_recheck import pipeline
 
 LPCACHEDIR = os.path.expanduser('~/.launchpadlib/cache')
 
@@ -132,6 +137,9 @@ class RecheckWatch(threading.Thread):
                                                         'production',
                                                         LPCACHEDIR,
                                                         timeout=60)
+        # several stage workers report events, the irc connection and
+        # launchpadlib can only be used by one of them at a time
+        self._output_lock = threading.Lock()
 
     def display(self, channel, event):
         display = False
@@ -182,6 +190,10 @@ class RecheckWatch(threading.Thread):
         return set(projects)
 
     def _read(self, event=None, msg=""):
+        with self._output_lock:
+            self._read_locked(event=event, msg=msg)
+
+    def _read_locked(self, event=None, msg=""):
         for channel in self.channel_config.channels:
             if msg:
                 if channel in self.channel_config.events['negative']:
@@ -202,31 +214,155 @@ class RecheckWatch(threading.Thread):
         # Import here because it needs to happen after daemonization
         import elastic_recheck.elasticRecheck as er
         classifier = er.Classifier(self.queries, config=self.config)
+        lag_monitor = er.IndexLagMonitor(
+            classifier, interval=self.config.lag_monitor_interval)
+        lag_monitor.start()
+        journal = None
+        if self.config.journal_db:
+            journal = er_journal.EventJournal(
+                self.config.journal_db,
+                retention=self.config.journal_retention)
+            journal.start_compaction()
+        feed = None
+        if self.config.readiness_feed:
+            feed = er_feed.from_url(self.config.readiness_feed)
+        # where to catch up from, before the new events move it on
+        since = None
+        if self.config.catchup and journal is not None:
+            since = journal.last_seen()
         stream = er.Stream(self.username, self.host, self.key,
-                           config=self.config)
+                           config=self.config, lag_monitor=lag_monitor,
+                           journal=journal, feed=feed)
+
+        size = self.config.stage_queue_size
+        failed = functools.partial(self._failed, stream)
+        self.pipeline = pipeline.Pipeline([
+            pipeline.Stage('readiness',
+                           functools.partial(self._ready, stream),
+                           workers=self.config.readiness_workers,
+                           maxsize=size,
+                           priority=self._priority,
+                           on_error=failed),
+            pipeline.Stage('classification',
+                           functools.partial(self._classify, classifier,
+                                             stream),
+                           workers=self.config.classify_workers,
+                           maxsize=size,
+                           priority=self._priority,
+                           shed=functools.partial(self._shed, stream),
+                           on_error=failed),
+            pipeline.Stage('notification',
+                           functools.partial(self._notify, stream),
+                           workers=self.config.notify_workers,
+                           maxsize=size,
+                           on_error=failed),
+        ])
+        self.pipeline.start()
+        # events that weren't ready go back to the readiness stage when
+        # they are due for another check
+        release = threading.Thread(target=self._release, args=(stream,),
+                                   name='readiness-scheduler')
+        release.daemon = True
+        release.start()
+        if since is not None:
+            catch_up = threading.Thread(
+                target=self._catch_up, args=(stream, classifier, since),
+                name='catch-up')
+            catch_up.daemon = True
+            catch_up.start()
+
+        interval = self.config.stage_stats_interval
+        last_stats = time.time()
         while True:
             try:
-                event = stream.get_failed_tempest()
-
-                for job in event.failed_jobs:
-                    job.bugs = set(classifier.classify(
-                        event.change,
-                        event.rev,
-                        job.build_short_uuid,
-                        recent=True))
-                if not event.get_all_bugs():
-                    self._read(event)
-                else:
-                    self._read(event)
-                    stream.leave_comment(
-                        event,
-                        self.msgs,
-                        debug=not self.commenting)
-            except er.ResultTimedOut as e:
-                self.log.warning(e.message)
-                self._read(msg=e.message)
+                event = stream.next_failure(timeout=interval)
+                if event is not None:
+                    self.pipeline.put(event)
             except Exception:
-                self.log.exception("Uncaught exception processing event.")
+                self.log.exception("Uncaught exception reading events.")
+            if time.time() - last_stats >= interval:
+                self.pipeline.log_stats()
+                self.log.info("Dropped %d duplicate failure reports" %
+                              stream.coalescer.coalesced)
+                last_stats = time.time()
+
+    def _catch_up(self, stream, classifier, since):
+        since = max(since, time.time() - self.config.catchup_max_age)
+        try:
+            er_catchup.CatchUp(stream, classifier, config=self.config).run(
+                self.msgs, since, commenting=self.commenting)
+        except Exception:
+            self.log.exception("Failed to catch up with missed failures")
+
+    def _release(self, stream):
+        while True:
+            self.pipeline.put(stream.scheduler.wait_due())
+
+    def _ready(self, stream, event):
+        """Readiness stage, pass the event on once its logs are indexed."""
+        # Import here because it needs to happen after daemonization
+        import elastic_recheck.elasticRecheck as er
+        try:
+            if stream.check_ready(event):
+                return event
+        except er.ResultTimedOut as e:
+            self.log.warning(str(e))
+            self._read(msg=str(e))
+        return None
+
+    def _failed(self, stream, event):
+        """A stage failed to process an event, it won't be retried."""
+        stream.mark(event, er_journal.FAILED)
+
+    @staticmethod
+    def _priority(event):
+        # Only gate failures are announced, and a gate reset holds up every
+        # change behind it, so they go before any check failure.
+        return (0 if event.queue() == 'gate' else 1, event.created_on)
+
+    def _shed(self, stream, event, backlog):
+        """Shed policy of the classification stage.
+
+        Returns pipeline.DROP or pipeline.DEFER for events older than
+        shed_age while more than shed_backlog events are queued.
+        """
+        policy = self.config.shed_policy
+        if policy is None or backlog < self.config.shed_backlog:
+            return None
+        age = time.time() - event.created_on
+        if age < self.config.shed_age:
+            return None
+        self.log.info("Shedding (%s) %s, %ds old with %d events queued for "
+                      "classification" % (policy, event.name(), age, backlog))
+        if policy == pipeline.DROP:
+            stream.mark(event, er_journal.SHED)
+        return policy
+
+    def _classify(self, classifier, stream, event):
+        """Classification stage, find the bugs of every failed job."""
+        # events resumed from the journal may be classified already
+        if event.stage != er_journal.CLASSIFIED:
+            for job in event.failed_jobs:
+                job.bugs = set(classifier.classify(
+                    event.change,
+                    event.rev,
+                    job.build_short_uuid,
+                    job_name=job.name,
+                    files=job.files,
+                    queue=event.queue(),
+                    timerange=event.timerange()))
+            stream.mark(event, er_journal.CLASSIFIED)
+        return event
+
+    def _notify(self, stream, event):
+        """Notification stage, report the event on irc and gerrit."""
+        self._read(event)
+        if event.get_all_bugs():
+            stream.leave_comment(
+                event,
+                self.msgs,
+                debug=not self.commenting)
+        stream.mark(event, er_journal.COMMENTED)
 
 
 class MessageConfig(dict):
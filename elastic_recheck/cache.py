@@ -0,0 +1,270 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Caches used by elastic recheck."""
+
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger('recheckwatchbot')
+
+
+class LRUCache(object):
+    """A thread safe, size bounded, least recently used cache.
+
+    Once more than `maxsize` entries are stored the least recently used
+    ones are evicted. If `ttl` is set, entries also expire `ttl` seconds
+    after they were stored.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            # move to the most recently used end
+            expires, value = self._data.pop(key)
+            if expires is not None and expires < time.time():
+                return default
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class ClassificationCache(object):
+    """Cache of query results for builds.
+
+    Entries are keyed by build_short_uuid and the fingerprint of a query
+    (see loader.fingerprint), and record whether that query matched the
+    build. Changing a query changes its fingerprint, so only the entries of
+    that query stop being used.
+
+    Entries are kept in memory, and optionally in a sqlite database at
+    `path` so they survive restarts. Both expire after `ttl` seconds, and
+    both keep at most `maxsize` entries.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._memory = LRUCache(maxsize, ttl=ttl)
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS classifications ('
+                    'build_uuid TEXT, fingerprint TEXT, matched INTEGER, '
+                    'created REAL, PRIMARY KEY (build_uuid, fingerprint))')
+                self._db.execute(
+                    'CREATE INDEX IF NOT EXISTS classifications_created '
+                    'ON classifications (created)')
+
+    def get(self, build_uuid, fingerprints):
+        """Return a dict of fingerprint to result for the cached queries."""
+        found = {}
+        for fp in fingerprints:
+            matched = self._memory.get((build_uuid, fp))
+            if matched is not None:
+                found[fp] = matched
+        missing = [fp for fp in fingerprints if fp not in found]
+        if missing and self._db is not None:
+            oldest = 0
+            if self.ttl is not None:
+                oldest = time.time() - self.ttl
+            with self._db_lock:
+                rows = self._db.execute(
+                    'SELECT fingerprint, matched FROM classifications '
+                    'WHERE build_uuid = ? AND created > ?',
+                    (build_uuid, oldest)).fetchall()
+            missing = set(missing)
+            for fp, matched in rows:
+                if fp in missing:
+                    found[fp] = bool(matched)
+                    self._memory.set((build_uuid, fp), bool(matched))
+        return found
+
+    def set(self, build_uuid, results):
+        """Store a dict of fingerprint to result for a build."""
+        for fp, matched in results.items():
+            self._memory.set((build_uuid, fp), matched)
+        if self._db is None or not results:
+            return
+        now = time.time()
+        with self._db_lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO classifications '
+                    'VALUES (?, ?, ?, ?)',
+                    [(build_uuid, fp, int(matched), now)
+                     for fp, matched in results.items()])
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._expire()
+
+    def _expire(self):
+        """Drop expired entries and keep the database under maxsize."""
+        with self._db:
+            if self.ttl is not None:
+                self._db.execute(
+                    'DELETE FROM classifications WHERE created < ?',
+                    (time.time() - self.ttl,))
+            self._db.execute(
+                'DELETE FROM classifications WHERE rowid IN ('
+                'SELECT rowid FROM classifications '
+                'ORDER BY created DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+        LOG.debug("Expired old entries from the classification cache")
+
+
+class IndexResultCache(object):
+    """On disk cache of search results for indexes that don't change.
+
+    The daily indexes of past days are complete, so what a query finds in
+    one of them never changes. Entries are keyed by the fingerprint of the
+    query (see fingerprint()) and the name of the index, and are stored as
+    JSON in a sqlite database at `path`. They don't expire, the least
+    recently used ones are evicted once they add up to more than
+    `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS index_results ('
+                'fingerprint TEXT, index_name TEXT, result TEXT, '
+                'size INTEGER, used REAL, '
+                'PRIMARY KEY (fingerprint, index_name))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS index_results_used '
+                'ON index_results (used)')
+
+    @staticmethod
+    def fingerprint(query):
+        """Return the fingerprint of a query, a dict of the query DSL."""
+        data = json.dumps(query, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, fingerprint, index):
+        """Return the cached result of a query on an index, or None."""
+        with self._lock:
+            with self._db:
+                row = self._db.execute(
+                    'SELECT result FROM index_results '
+                    'WHERE fingerprint = ? AND index_name = ?',
+                    (fingerprint, index)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                self._db.execute(
+                    'UPDATE index_results SET used = ? '
+                    'WHERE fingerprint = ? AND index_name = ?',
+                    (time.time(), fingerprint, index))
+        return json.loads(row[0])
+
+    def set(self, fingerprint, index, result):
+        """Store the result of a query on an index."""
+        data = json.dumps(result)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO index_results '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (fingerprint, index, data, len(data), time.time()))
+                self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries over max_bytes."""
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM index_results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            'SELECT rowid, size FROM index_results ORDER BY used').fetchall()
+        evicted = []
+        for rowid, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((rowid,))
+            total -= size
+        self._db.executemany('DELETE FROM index_results WHERE rowid = ?',
+                             evicted)
+        LOG.debug("Evicted %d entries from the index result cache" %
+                  len(evicted))
+
+    def purge(self, index=None):
+        """Drop every entry, or the entries of `index`.
+
+        Returns the number of entries dropped.
+        """
+        with self._lock:
+            with self._db:
+                if index is None:
+                    cursor = self._db.execute('DELETE FROM index_results')
+                else:
+                    cursor = self._db.execute(
+                        'DELETE FROM index_results WHERE index_name = ?',
+                        (index,))
+        return cursor.rowcount
+
+    def size(self):
+        """Return the number of entries and their size in bytes."""
+        with self._lock:
+            return tuple(self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                'FROM index_results').fetchone())
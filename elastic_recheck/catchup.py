@@ -0,0 +1,175 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Catch up with the failures reported while the bot was down.
+
+Gerrit is queried for the open changes of the watched projects that CI
+commented on since the last event the bot saw. The CI failure comments on
+their latest patch set that the bot hasn't reported yet are classified all
+at once, their logs are indexed by now so there is no readiness check, and
+comments are left at a limited pace.
+"""
+
+import logging
+import re
+import time
+
+import elastic_recheck.config as er_conf
+import elastic_recheck.journal as er_journal
+
+PATCH_SET_RE = re.compile(r"^Patch Set (\d+):")
+
+
+def comment_event(change, comment, patchset):
+    """Turn a comment of a gerrit query result into a comment-added event."""
+    return {
+        'type': 'comment-added',
+        'author': comment.get('reviewer', {}),
+        'comment': comment['message'],
+        'change': {
+            'number': str(change['number']),
+            'project': change['project'],
+            'branch': change.get('branch'),
+            'url': change.get('url'),
+        },
+        'patchSet': {'number': str(patchset)},
+        'eventCreatedOn': comment['timestamp'],
+    }
+
+
+class CatchUp(object):
+    """Finds, classifies and reports the failures the bot missed."""
+
+    log = logging.getLogger("recheckwatchbot")
+
+    def __init__(self, stream, classifier, config=None):
+        self.stream = stream
+        self.classifier = classifier
+        self.config = config or er_conf.Config()
+        self.ci_usernames = (self.config.ci_username, 'zuul')
+        # the comments of the bot itself
+        self.username = getattr(self.config, 'gerrit_user', None)
+
+    def _query(self, since):
+        """Return the open changes updated since `since`."""
+        age = max(1, int(time.time() - since))
+        scope = '(%s) (%s)' % (
+            ' OR '.join('project:%s' % x
+                        for x in self.config.catchup_projects),
+            ' OR '.join('commentby:%s' % x for x in self.ci_usernames))
+        changes = []
+        while True:
+            rows = self.stream.gerrit.bulk_query(
+                '--patch-sets --comments --start %d status:open '
+                'NOT age:%ds %s' % (len(changes), age, scope)) or []
+            more = False
+            for row in rows:
+                if row.get('type') == 'stats':
+                    more = row.get('moreChanges', False)
+                else:
+                    changes.append(row)
+            if not more:
+                return changes
+
+    def _latest_failure(self, change, since):
+        """Return the unreported failure of the latest patch set, or None."""
+        patchsets = [int(x['number']) for x in change.get('patchSets', [])]
+        if not patchsets:
+            return None
+        latest = max(patchsets)
+        last_ci = None
+        last_bot = None
+        for comment in change.get('comments', []):
+            m = PATCH_SET_RE.match(comment.get('message', ''))
+            if not m or int(m.group(1)) != latest:
+                continue
+            username = comment.get('reviewer', {}).get('username')
+            if username in self.ci_usernames:
+                last_ci = comment
+            elif username == self.username:
+                last_bot = comment
+        # a later CI report, like a successful recheck, makes the failure
+        # irrelevant, and so does a comment the bot already left
+        if last_ci is None or last_ci['timestamp'] < since:
+            return None
+        if last_bot is not None and last_bot['timestamp'] >= \
+                last_ci['timestamp']:
+            return None
+        fevent = self.stream._failure_event(
+            comment_event(change, last_ci, latest))
+        if fevent is None:
+            return None
+        journal = self.stream.journal
+        if journal is not None and journal.stage(fevent.key()) is not None:
+            # the bot saw it before going down
+            return None
+        return fevent
+
+    def failures(self, since):
+        """Return the failures missed since `since`, oldest first."""
+        events = []
+        for change in self._query(since):
+            fevent = self._latest_failure(change, since)
+            if fevent is not None:
+                events.append(fevent)
+        return sorted(events, key=lambda x: x.created_on)
+
+    def run(self, msgs, since, commenting=True):
+        """Classify and report the failures missed since `since`.
+
+        Returns the failure events that were caught up with.
+        """
+        events = self.failures(since)
+        self.log.info("Catching up with %d failures since %s" %
+                      (len(events), time.ctime(since)))
+        missed = []
+        for fevent in events:
+            # a live duplicate may be on its way already
+            if self.stream.coalescer.add(fevent) is not None:
+                continue
+            self.stream.mark(fevent, er_journal.WAITING)
+            for job in fevent.failed_jobs:
+                job.ready = True
+            missed.append(fevent)
+        try:
+            self.classifier.classify_events(missed)
+        except Exception:
+            self.log.exception("Failed to classify %d missed failures" %
+                               len(missed))
+            for fevent in missed:
+                self.stream.mark(fevent, er_journal.FAILED)
+            return []
+        interval = self.config.catchup_comment_interval
+        last_comment = None
+        done = []
+        for fevent in missed:
+            try:
+                self.stream.mark(fevent, er_journal.CLASSIFIED)
+                if fevent.get_all_bugs():
+                    if last_comment is not None:
+                        wait = last_comment + interval - time.time()
+                        if wait > 0:
+                            time.sleep(wait)
+                    self.stream.leave_comment(fevent, msgs,
+                                              debug=not commenting)
+                    last_comment = time.time()
+                self.stream.mark(fevent, er_journal.COMMENTED)
+            except Exception:
+                self.log.exception("Failed to catch up with %s" %
+                                   fevent.name())
+                self.stream.mark(fevent, er_journal.FAILED)
+                continue
+            done.append(fevent)
+        self.log.info("Caught up with %d failures" % len(done))
+        return done
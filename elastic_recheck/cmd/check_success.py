@@ -30,6 +30,9 @@ import elastic_recheck.results as er_results
 
 LPCACHEDIR = os.path.expanduser('~/.launchpadlib/cache')
 
+# the hits of a query are counted per build status, build and job
+FACETS = ["build_status", "build_uuid", "build_name"]
+
 
 def get_options():
     parser = argparse.ArgumentParser(
@@ -52,7 +55,8 @@ def all_fails(classifier):
     so we can figure out how good we are doing on total classification.
     """
     all_fails = {}
-    results = classifier.hits_by_query(er_config.ALL_FAILS_QUERY, size=30000)
+    results = classifier.iter_hits_by_query(er_config.ALL_FAILS_QUERY,
+                                            limit=30000)
     facets = er_results.FacetSet()
     facets.detect_facets(results, ["build_uuid"])
     for build in facets:
@@ -106,13 +110,8 @@ def classifying_rate(fails, data):
         print("  %3s : %s" % (s[1], s[0]))
 
 
-def _status_count(results):
+def _status_count(facets):
     counts = {}
-    facets = er_results.FacetSet()
-    facets.detect_facets(
-        results,
-        ["build_status", "build_uuid"])
-
     for key in facets:
         counts[key] = len(facets[key])
     return counts
@@ -125,34 +124,29 @@ def _failure_count(hits):
         return 0
 
 
-def _failed_jobs(results):
+def _failed_jobs(facets):
     failed_jobs = []
-    facets = er_results.FacetSet()
-    facets.detect_facets(
-        results,
-        ["build_status", "build_uuid"])
     if "FAILURE" in facets:
         for build in facets["FAILURE"]:
-            for result in facets["FAILURE"][build]:
-                failed_jobs.append("%s.%s" % (build, result.build_name))
+            for build_name in facets["FAILURE"][build]:
+                failed_jobs.append("%s.%s" % (build, build_name))
     return failed_jobs
 
 
-def _count_fails_per_build_name(hits):
-    facets = er_results.FacetSet()
+def _count_fails_per_build_name(facets):
     counts = collections.defaultdict(int)
-    facets.detect_facets(
-        hits,
-        ["build_status", "build_name", "build_uuid"])
     if "FAILURE" in facets:
-        for build_name in facets["FAILURE"]:
+        build_names = set(build_name
+                          for build in facets["FAILURE"].values()
+                          for build_name in build)
+        for build_name in build_names:
             counts[build_name] += 1
     return counts
 
 
-def _failure_percentage(hits, fails):
+def _failure_percentage(facets, fails):
     total_fails_per_build_name = num_fails_per_build_name(fails)
-    fails_per_build_name = _count_fails_per_build_name(hits)
+    fails_per_build_name = _count_fails_per_build_name(facets)
     per = {}
     for build in fails_per_build_name:
         this_job = fails_per_build_name[build]
@@ -166,17 +160,17 @@ def collect_metrics(classifier, fails):
     data = {}
     for q in classifier.queries:
         start = time.time()
-        results = classifier.hits_by_query(q['query'], size=30000)
+        facets = classifier.facets_by_query(q['query'], FACETS)
         log = logging.getLogger('recheckwatchbot')
         log.debug("Took %d seconds to run (uncached) query for bug %s" %
                   (time.time() - start, q['bug']))
-        hits = _status_count(results)
+        hits = _status_count(facets)
         data[q['bug']] = {
             'fails': _failure_count(hits),
             'hits': hits,
-            'percentages': _failure_percentage(results, fails),
+            'percentages': _failure_percentage(facets, fails),
             'query': q['query'],
-            'failed_jobs': _failed_jobs(results)
+            'failed_jobs': _failed_jobs(facets)
         }
 
     return data
@@ -161,7 +161,8 @@ def main():
     }
 
     # Get the cluster health for the header
-    es = pyelasticsearch.ElasticSearch(config.es_url)
+    es = er_results.get_client(config.es_url, pool_size=config.es_pool_size,
+                               timeout=config.es_timeout)
     jsondata['status'] = es.health()['status']
 
     for query in classifier.queries:
@@ -188,11 +189,13 @@ def main():
                    data=[],
                    voting=(False if query.get('allow-nonvoting') else True))
         buglist.append(bug)
+        # the hits are counted by elastic search, per status, hour and build
         try:
-            results = classifier.hits_by_query(query['query'],
-                                               args.queue,
-                                               size=3000,
-                                               days=days)
+            facets = classifier.facets_by_query(
+                query['query'],
+                ["build_status", "timestamp", "build_uuid"],
+                queue=args.queue,
+                days=days)
         except pyelasticsearch.exceptions.InvalidJsonResponseError:
             LOG.exception("Invalid Json while collecting metrics for query %s"
                           % query['query'])
@@ -206,15 +209,10 @@ def main():
                       query['bug'], ex)
             continue
 
-        facets_for_fail = er_results.FacetSet()
-        facets_for_fail.detect_facets(results,
-                                      ["build_status", "build_uuid"])
-        if "FAILURE" in facets_for_fail:
-            bug['fails'] = len(facets_for_fail['FAILURE'])
-
-        facets = er_results.FacetSet()
-        facets.detect_facets(results,
-                             ["build_status", "timestamp", "build_uuid"])
+        if "FAILURE" in facets:
+            bug['fails'] = len(set(
+                build for builds in facets['FAILURE'].values()
+                for build in builds))
 
         for status in facets.keys():
             data = []
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Purge the on disk cache of the results of past day indexes.
+
+The cache never expires its entries, since the indexes of past days don't
+change. Purge it if an index was reindexed, or the logstash mapping
+changed what queries find.
+"""
+
+import argparse
+import sys
+
+from elastic_recheck import cache
+import elastic_recheck.config as er_conf
+
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='Purge the cache of search results of past day indexes.')
+    parser.add_argument('-c', '--conf', help="Elastic Recheck Configuration "
+                        "file with the result_cache_db data_source option.")
+    parser.add_argument('--index', help="Only purge the results of this "
+                        "index, like logstash-2014.06.12")
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help="Only print the size of the cache.")
+    return parser.parse_args()
+
+
+def main():
+    opts = get_options()
+    config = er_conf.Config(config_file=opts.conf)
+    if not config.result_cache_db:
+        print("No result_cache_db is configured")
+        return 1
+    result_cache = cache.IndexResultCache(config.result_cache_db,
+                                          max_bytes=config.result_cache_size)
+    entries, size = result_cache.size()
+    print("The result cache has %d entries, %d bytes" % (entries, size))
+    if opts.dry_run:
+        return 0
+    purged = result_cache.purge(index=opts.index)
+    print("Purged %d entries" % purged)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
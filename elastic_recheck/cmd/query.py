@@ -66,7 +66,9 @@ def query(query_file_name, config=None, days=DEFAULT_NUMBER_OF_DAYS,
           quantity=DEFAULT_MAX_QUANTITY, verbose=False,):
     _config = config or er_conf.Config()
     es = er_results.SearchEngine(url=_config.es_url,
-                                 indexfmt=_config.es_index_format)
+                                 indexfmt=_config.es_index_format,
+                                 pool_size=_config.es_pool_size,
+                                 timeout=_config.es_timeout)
 
     with open(query_file_name) as f:
         query_file = yaml.load(f.read())
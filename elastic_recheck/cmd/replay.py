@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Replay recorded gerrit and elastic search traffic through the bot.
+
+This measures the throughput of the bot pipeline (Stream ->
+Classifier -> comment) without a live gerrit or elastic search. A
+recording is a directory with:
+
+events.json
+    the gerrit events, in the format of tests/unit/gerrit/events.json
+es.json
+    a list of {"request": query, "response": elastic search response}, the
+    responses are in the format of tests/unit/samples/*.json
+failing_tests.json
+    the failing test_ids in subunit2sql of the classified builds
+
+Recordings are made with --record, which runs the bot against the real
+gerrit and elastic search from the config file, without commenting.
+--prefilter only measures how fast the failure events are picked out of
+the recorded gerrit events.
+"""
+
+import argparse
+import collections
+import json
+import logging as std_logging
+import os
+import time
+
+import pyelasticsearch
+import yaml
+
+import elastic_recheck.config as er_conf
+import elastic_recheck.elasticRecheck as er
+import elastic_recheck.log as logging
+from elastic_recheck import pipeline
+import elastic_recheck.results as er_results
+
+LOG = logging.getLogger('erreplay')
+
+EMPTY_RESPONSE = {
+    "hits": {"hits": [], "total": 0, "max_score": None},
+    "_shards": {"successful": 1, "failed": 0, "total": 1},
+    "took": 0,
+    "timed_out": False,
+}
+
+
+class GerritDone(Exception):
+    pass
+
+
+def _key(query):
+    # the size is passed in different places by search and multi search,
+    # and doesn't change which response we want, neither does the time
+    # range of the event the search is about.
+    query = dict(query)
+    query.pop('size', None)
+    filtered = query.get('query', {}).get('filtered')
+    if filtered and '@timestamp' in filtered['filter'].get('range', {}):
+        query['query'] = filtered['query']
+    return json.dumps(query, sort_keys=True)
+
+
+def _split_msearch(body):
+    """Return the queries of a multi search body."""
+    lines = [line for line in body.split('\n') if line.strip()]
+    # every query is a header line followed by the query line
+    return [json.loads(line) for line in lines[1::2]]
+
+
+class Recording(object):
+    """Recorded gerrit events, elastic search responses and test failures."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.events = []
+        self.responses = collections.OrderedDict()
+        self.failing_tests = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        with open(self._path('events.json')) as f:
+            self.events = json.load(f)
+        if os.path.exists(self._path('es.json')):
+            with open(self._path('es.json')) as f:
+                for entry in json.load(f):
+                    self.responses[_key(entry['request'])] = entry
+        if os.path.exists(self._path('failing_tests.json')):
+            with open(self._path('failing_tests.json')) as f:
+                self.failing_tests = json.load(f)
+        return self
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(self._path('events.json'), 'w') as f:
+            json.dump(self.events, f, indent=2)
+        with open(self._path('es.json'), 'w') as f:
+            json.dump(list(self.responses.values()), f, indent=2)
+        with open(self._path('failing_tests.json'), 'w') as f:
+            json.dump(dict((uuid, sorted(test_ids)) for uuid, test_ids
+                           in self.failing_tests.items()), f, indent=2)
+
+    def add_response(self, query, response):
+        self.responses[_key(query)] = {'request': query,
+                                       'response': response}
+
+    def response(self, query):
+        entry = self.responses.get(_key(query))
+        if entry is not None:
+            return entry['response']
+        response = dict(EMPTY_RESPONSE)
+        if 'facets' in query:
+            response['facets'] = {'tag': {'terms': [], 'total': 0}}
+        return response
+
+
+class ReplayES(object):
+    """A stand in for pyelasticsearch.ElasticSearch serving a recording.
+
+    Queries that aren't in the recording get an empty response, they are
+    counted as misses.
+    """
+
+    def __init__(self, recording, counts):
+        self.recording = recording
+        self.counts = counts
+
+    def _response(self, query):
+        if _key(query) not in self.recording.responses:
+            self.counts['misses'] += 1
+        return self.recording.response(query)
+
+    def status(self, index=None):
+        self.counts['status'] += 1
+        return {}
+
+    def search(self, query, **kwargs):
+        self.counts['search'] += 1
+        return self._response(query)
+
+    def send_request(self, method, path_components, body='', **kwargs):
+        self.counts[path_components[-1]] += 1
+        if path_components != ['_msearch']:
+            # like a server that can't list its indexes, they are looked
+            # up one by one with status() instead
+            raise pyelasticsearch.exceptions.ElasticHttpNotFoundError()
+        queries = _split_msearch(body)
+        self.counts['msearch queries'] += len(queries)
+        return {'responses': [self._response(q) for q in queries]}
+
+
+class RecordingES(object):
+    """Sends requests to elastic search, and records the responses."""
+
+    def __init__(self, url, recording, counts):
+        self.es = pyelasticsearch.ElasticSearch(url)
+        self.recording = recording
+        self.counts = counts
+
+    def status(self, index=None):
+        self.counts['status'] += 1
+        return self.es.status(index=index)
+
+    def search(self, query, **kwargs):
+        self.counts['search'] += 1
+        response = self.es.search(query, **kwargs)
+        self.recording.add_response(query, response)
+        return response
+
+    def send_request(self, method, path_components, body='', **kwargs):
+        self.counts[path_components[-1]] += 1
+        response = self.es.send_request(method, path_components, body,
+                                        **kwargs)
+        if path_components != ['_msearch']:
+            return response
+        queries = _split_msearch(body)
+        self.counts['msearch queries'] += len(queries)
+        for query, result in zip(queries, response['responses']):
+            if 'error' not in result:
+                self.recording.add_response(query, result)
+        return response
+
+
+class ReplayGerrit(object):
+    """A gerrit stand in that emits the recorded events.
+
+    With a `speed` the events are spaced out like they originally were,
+    `speed` times faster, otherwise they are emitted as fast as possible.
+    """
+
+    def __init__(self, events, speed=None):
+        self.events = list(events)
+        self.speed = speed
+        self.consumed = 0
+        self.reviews = []
+        self._started = None
+
+    def getEvent(self):
+        if self.consumed >= len(self.events):
+            raise GerritDone()
+        event = self.events[self.consumed]
+        self.consumed += 1
+        if self.speed:
+            first = self.events[0].get('eventCreatedOn', 0)
+            offset = (event.get('eventCreatedOn', first) - first) / self.speed
+            if self._started is None:
+                self._started = time.time()
+            delay = self._started + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return event
+
+    def review(self, project, name, msg):
+        self.reviews.append({'project': project, 'name': name, 'msg': msg})
+
+
+class RecordingFailingTestIds(er.FailingTestIds):
+    """Records the failing test_ids looked up in subunit2sql."""
+
+    def __init__(self, recording, maxsize=er_conf.TEST_IDS_CACHE_SIZE):
+        super(RecordingFailingTestIds, self).__init__(maxsize)
+        self.recording = recording
+
+    def get(self, build_uuid, session):
+        failing = super(RecordingFailingTestIds, self).get(build_uuid,
+                                                           session)
+        self.recording.failing_tests[build_uuid] = set(failing)
+        return failing
+
+
+class Stats(object):
+    """Wall clock time spent in each stage of the pipeline."""
+
+    def __init__(self):
+        self.timings = collections.defaultdict(list)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[stage].append(time.time() - start)
+
+    def report(self, events, elapsed, counts):
+        lines = ["Replayed %d gerrit events in %.2fs, %.1f events/sec" %
+                 (events, elapsed, events / elapsed if elapsed else 0.0)]
+        lines.append("%-10s %8s %10s %10s %10s" %
+                     ('stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms'))
+        for stage in ('stream', 'classify', 'comment'):
+            values = self.timings.get(stage, [])
+            lines.append("%-10s %8d %10.2f %10.2f %10.2f" % (
+                stage, len(values),
+                pipeline.percentile(values, 50) * 1000,
+                pipeline.percentile(values, 90) * 1000,
+                pipeline.percentile(values, 99) * 1000))
+        lines.append("Elastic search requests: %s" % ', '.join(
+            "%s=%d" % (name, counts[name]) for name in sorted(counts)))
+        return '\n'.join(lines)
+
+
+def replay(stream, classifier, msgs, stats, comment=True):
+    """Run the bot pipeline until gerrit runs out of events."""
+    while True:
+        try:
+            event = stats.time('stream', stream.get_failed_tempest)
+        except GerritDone:
+            return
+        except er.ResultTimedOut as e:
+            LOG.debug(e)
+            continue
+        for job in event.failed_jobs:
+            job.bugs = set(stats.time(
+                'classify', classifier.classify, event.change, event.rev,
+                job.build_short_uuid, job_name=job.name, files=job.files,
+                queue=event.queue(), timerange=event.timerange()))
+        stats.time('comment', stream.leave_comment, event, msgs,
+                   debug=not comment)
+
+
+def benchmark(recording, queries_dir, msgs, config=None, speed=None):
+    """Replay a recording through the bot pipeline.
+
+    Returns the Stats, the Stream, the elastic search request counts and
+    the elapsed wall clock time.
+    """
+    config = config or er_conf.Config()
+    counts = collections.Counter()
+    classifier = er.Classifier(queries_dir, config=config)
+    classifier.es = er_results.SearchEngine(
+        config.es_url, client_factory=lambda url: ReplayES(recording, counts))
+    for build_uuid, test_ids in recording.failing_tests.items():
+        classifier.failing_tests.set(build_uuid, test_ids)
+    stream = er.Stream('', '', '', config=config, thread=False)
+    stream.gerrit = ReplayGerrit(recording.events, speed=speed)
+    stream.es = er_results.SearchEngine(
+        config.es_url, client_factory=lambda url: ReplayES(recording, counts))
+
+    stats = Stats()
+    start = time.time()
+    replay(stream, classifier, msgs, stats)
+    return stats, stream, counts, time.time() - start
+
+
+def benchmark_prefilter(events, config=None, rounds=10):
+    """Measure how fast the failure events are picked out of the stream.
+
+    Returns the events/sec of the prefilter alone, and of the prefilter
+    followed by the parsing of the failure comments, and how many of the
+    events are failures.
+    """
+    config = config or er_conf.Config()
+    username = config.ci_username
+    start = time.time()
+    for i in range(rounds):
+        for event in events:
+            er.Stream.is_failure_comment(event, ci_username=username)
+    prefilter = time.time() - start
+    start = time.time()
+    for i in range(rounds):
+        failures = 0
+        for event in events:
+            if er.Stream.parse_jenkins_failure(event, ci_username=username):
+                failures += 1
+    parse = time.time() - start
+    count = len(events) * rounds
+    return (count / prefilter if prefilter else 0.0,
+            count / parse if parse else 0.0,
+            failures)
+
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='Replay recorded gerrit events and elastic search '
+                    'responses through the bot, and report its throughput.')
+    parser.add_argument('recording',
+                        help="Directory with the recorded traffic")
+    parser.add_argument('--dir', '-d', help="Queries Directory",
+                        default="queries")
+    parser.add_argument('--conf', help="Elastic Recheck Configuration file",
+                        default=None)
+    parser.add_argument('--msgs', help="Bot yaml file with the messages",
+                        default="recheckwatchbot.yaml")
+    parser.add_argument('--speed', type=float, default=None,
+                        help="Replay events this many times faster than "
+                             "they originally happened, default is as fast "
+                             "as possible")
+    parser.add_argument('--record', action='store_true', default=False,
+                        help="Record real gerrit and elastic search "
+                             "traffic into the recording directory instead")
+    parser.add_argument('--events', type=int, default=100,
+                        help="Number of gerrit events to record")
+    parser.add_argument('--prefilter', action='store_true', default=False,
+                        help="Only benchmark picking the failure events "
+                             "out of the recorded gerrit events")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        default=False, help="Keep the bot debug logging")
+    return parser.parse_args()
+
+
+def record(args, config, msgs):
+    recording = Recording(args.recording)
+    counts = collections.Counter()
+    classifier = er.Classifier(args.dir, config=config)
+    classifier.es = er_results.SearchEngine(
+        config.es_url,
+        client_factory=lambda url: RecordingES(url, recording, counts))
+    classifier.failing_tests = RecordingFailingTestIds(recording)
+    stream = er.Stream(config.gerrit_user, config.gerrit_host,
+                       config.gerrit_host_key, config=config)
+    stream.es = er_results.SearchEngine(
+        config.es_url,
+        client_factory=lambda url: RecordingES(url, recording, counts))
+    get_event = stream.gerrit.getEvent
+
+    def recording_get_event():
+        if len(recording.events) >= args.events:
+            raise GerritDone()
+        event = get_event()
+        recording.events.append(event)
+        return event
+
+    stream.gerrit.getEvent = recording_get_event
+    try:
+        # never comment on real reviews while recording
+        replay(stream, classifier, msgs, Stats(), comment=False)
+    finally:
+        recording.save()
+        LOG.info("Recorded %d events and %d elastic search responses in %s" %
+                 (len(recording.events), len(recording.responses),
+                  args.recording))
+
+
+def main():
+    args = get_options()
+    config = er_conf.Config(config_file=args.conf)
+    if not args.verbose:
+        std_logging.getLogger('recheckwatchbot').setLevel(std_logging.WARN)
+    with open(args.msgs) as f:
+        msgs = yaml.safe_load(f)['messages']
+
+    if args.record:
+        record(args, config, msgs)
+        return
+
+    recording = Recording(args.recording).load()
+    if args.prefilter:
+        prefilter, parse, failures = benchmark_prefilter(recording.events,
+                                                         config=config)
+        print("%d gerrit events, %d failures\n"
+              "prefilter: %.0f events/sec\n"
+              "prefilter and parse: %.0f events/sec" %
+              (len(recording.events), failures, prefilter, parse))
+        return
+
+    stats, stream, counts, elapsed = benchmark(
+        recording, args.dir, msgs, config=config, speed=args.speed)
+    print(stats.report(stream.gerrit.consumed, elapsed, counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,9 @@ import elastic_recheck.results as er_results
 
 LOG = logging.getLogger('eruncategorized')
 
+# the hits of a query are counted per build status, build and job
+FACETS = ["build_status", "build_uuid", "build_name"]
+
 
 def get_options():
     parser = argparse.ArgumentParser(
@@ -100,8 +103,8 @@ def all_fails(classifier, config=None):
     integrated_fails = {}
     other_fails = {}
     all_fails = {}
-    results = classifier.hits_by_query(config.all_fails_query,
-                                       size=config.uncat_search_size)
+    results = classifier.iter_hits_by_query(config.all_fails_query,
+                                            limit=config.uncat_search_size)
     facets = er_results.FacetSet()
     facets.detect_facets(results, ["build_uuid"])
     for build in facets:
@@ -254,13 +257,8 @@ def classifying_rate(fails, data, engine, classifier, ls_url):
     return engine.render(tvars)
 
 
-def _status_count(results):
+def _status_count(facets):
     counts = {}
-    facets = er_results.FacetSet()
-    facets.detect_facets(
-        results,
-        ["build_status", "build_uuid"])
-
     for key in facets:
         counts[key] = len(facets[key])
     return counts
@@ -273,34 +271,29 @@ def _failure_count(hits):
         return 0
 
 
-def _failed_jobs(results):
+def _failed_jobs(facets):
     failed_jobs = []
-    facets = er_results.FacetSet()
-    facets.detect_facets(
-        results,
-        ["build_status", "build_uuid"])
     if "FAILURE" in facets:
         for build in facets["FAILURE"]:
-            for result in facets["FAILURE"][build]:
-                failed_jobs.append("%s.%s" % (build, result.build_name))
+            for build_name in facets["FAILURE"][build]:
+                failed_jobs.append("%s.%s" % (build, build_name))
     return failed_jobs
 
 
-def _count_fails_per_build_name(hits):
-    facets = er_results.FacetSet()
+def _count_fails_per_build_name(facets):
     counts = collections.defaultdict(int)
-    facets.detect_facets(
-        hits,
-        ["build_status", "build_name", "build_uuid"])
     if "FAILURE" in facets:
-        for build_name in facets["FAILURE"]:
+        build_names = set(build_name
+                          for build in facets["FAILURE"].values()
+                          for build_name in build)
+        for build_name in build_names:
             counts[build_name] += 1
     return counts
 
 
-def _failure_percentage(hits, fails):
+def _failure_percentage(facets, fails):
     total_fails_per_build_name = num_fails_per_build_name(fails)
-    fails_per_build_name = _count_fails_per_build_name(hits)
+    fails_per_build_name = _count_fails_per_build_name(facets)
     per = {}
     for build in fails_per_build_name:
         this_job = fails_per_build_name[build]
@@ -315,17 +308,16 @@ def collect_metrics(classifier, fails, config=None):
     data = {}
     for q in classifier.queries:
         try:
-            results = classifier.hits_by_query(q['query'],
-                                               size=config.uncat_search_size)
-            hits = _status_count(results)
+            facets = classifier.facets_by_query(q['query'], FACETS)
+            hits = _status_count(facets)
             LOG.debug("Collected metrics for query %s, hits %s", q['query'],
                       hits)
             data[q['bug']] = {
                 'fails': _failure_count(hits),
                 'hits': hits,
-                'percentages': _failure_percentage(results, fails),
+                'percentages': _failure_percentage(facets, fails),
                 'query': q['query'],
-                'failed_jobs': _failed_jobs(results)
+                'failed_jobs': _failed_jobs(facets)
             }
         except requests.exceptions.ReadTimeout:
             LOG.exception("Failed to collection metrics for query %s" %
@@ -63,6 +63,96 @@ ALL_FAILS_QUERY = (
 
 UNCAT_MAX_SEARCH_SIZE = 30000
 
+# Connection pool settings for the subunit2sql database. Connections are
+# recycled after DB_POOL_RECYCLE seconds so that idle connections closed by
+# the server are not handed out again.
+DB_POOL_SIZE = 5
+DB_POOL_RECYCLE = 3600
+
+# Every elastic search client of a process shares ES_POOL_SIZE keep-alive
+# connections per server, requests time out after ES_TIMEOUT seconds.
+ES_POOL_SIZE = 10
+ES_TIMEOUT = 60
+
+# The list of elastic search indexes is cached for INDEX_CACHE_TTL seconds,
+# and until UTC midnight, when the next daily index shows up. Indexes that
+# weren't in the list are looked up again after INDEX_NEGATIVE_TTL seconds.
+INDEX_CACHE_TTL = 3600
+INDEX_NEGATIVE_TTL = 60
+
+# Searches that go through every hit fetch them SCROLL_PAGE_SIZE at a time.
+SCROLL_PAGE_SIZE = 1000
+
+# The results of searches on the indexes of past days can be kept on disk,
+# up to RESULT_CACHE_SIZE bytes. The index of a day is taken as complete
+# RESULT_CACHE_SETTLE seconds after the day ended, once the log indexers
+# caught up.
+RESULT_CACHE_SIZE = 100 * 1024 * 1024
+RESULT_CACHE_SETTLE = 6 * 3600
+
+# The searches about a build only look at the log lines from SEARCH_LOOKBACK
+# seconds before the CI reported it, when the longest jobs started, to
+# SEARCH_LOOKAHEAD seconds after it, to allow for clock skew.
+SEARCH_LOOKBACK = 4 * 3600
+SEARCH_LOOKAHEAD = 900
+
+# Number of builds whose failing test ids are kept in memory.
+TEST_IDS_CACHE_SIZE = 1000
+
+# Query results per build are cached for CLASSIFY_CACHE_TTL seconds, for at
+# most CLASSIFY_CACHE_SIZE build and query pairs.
+CLASSIFY_CACHE_SIZE = 100000
+CLASSIFY_CACHE_TTL = 6 * 3600
+
+# Number of bug queries sent to elastic search in a single multi search
+# request when classifying a build.
+CLASSIFY_BATCH_SIZE = 100
+
+# Max number of log lines fetched for a build when evaluating queries
+# locally. Builds with more lines, like most devstack jobs, are classified
+# by elastic search.
+LOCAL_EVAL_MAX_DOCS = 1000
+
+# How often, in seconds, the bot checks how far behind elastic search
+# indexing is.
+LAG_MONITOR_INTERVAL = 60
+
+# Bounds, in seconds, of the wait between two readiness checks of a failed
+# job, the wait grows exponentially while the logs aren't indexed.
+READY_POLL_MIN = 10
+READY_POLL_MAX = 300
+
+# Finished events are kept in the journal for JOURNAL_RETENTION seconds.
+JOURNAL_RETENTION = 24 * 3600
+
+# Number of worker threads of each stage of the bot, the size of the queue
+# in front of each stage, and how often the stage statistics are logged.
+READINESS_WORKERS = 4
+CLASSIFY_WORKERS = 2
+NOTIFY_WORKERS = 1
+STAGE_QUEUE_SIZE = 100
+STAGE_STATS_INTERVAL = 300
+
+# When more than SHED_BACKLOG events wait for classification, the events
+# older than SHED_AGE seconds are shed according to the shed_policy, which
+# is either 'drop' or 'defer' (only classify them once the backlog is
+# cleared). By default nothing is shed.
+SHED_POLICIES = ('drop', 'defer')
+SHED_BACKLOG = 50
+SHED_AGE = 3600
+
+# Duplicate reports of the same change, patchset and builds within
+# COALESCE_WINDOW seconds are dropped, only the first one is processed.
+COALESCE_WINDOW = 3600
+
+# After being down the bot catches up with the failures of at most the last
+# CATCHUP_MAX_AGE seconds, leaving at most one comment every
+# CATCHUP_COMMENT_INTERVAL seconds.
+CATCHUP_MAX_AGE = 24 * 3600
+CATCHUP_COMMENT_INTERVAL = 30
+# The gerrit projects, names or ^regexes, searched for missed failures.
+CATCHUP_PROJECTS = ['^openstack/.*']
+
 
 class Config(object):
 
@@ -80,7 +170,41 @@ class Config(object):
                  excluded_jobs_regex=None,
                  included_projects_regex=None,
                  uncat_search_size=None,
-                 gerrit_query_file=None):
+                 gerrit_query_file=None,
+                 classify_batch_size=None,
+                 local_eval=False,
+                 local_eval_max_docs=None,
+                 db_pool_size=None,
+                 db_pool_recycle=None,
+                 es_pool_size=None,
+                 es_timeout=None,
+                 search_lookback=None,
+                 search_lookahead=None,
+                 result_cache_db=None,
+                 result_cache_size=None,
+                 test_ids_cache_size=None,
+                 classify_cache_size=None,
+                 classify_cache_ttl=None,
+                 classify_cache_db=None,
+                 lag_monitor_interval=None,
+                 ready_poll_min=None,
+                 ready_poll_max=None,
+                 journal_db=None,
+                 journal_retention=None,
+                 readiness_workers=None,
+                 classify_workers=None,
+                 notify_workers=None,
+                 stage_queue_size=None,
+                 stage_stats_interval=None,
+                 shed_policy=None,
+                 shed_backlog=None,
+                 shed_age=None,
+                 coalesce_window=None,
+                 readiness_feed=None,
+                 catchup=False,
+                 catchup_max_age=None,
+                 catchup_comment_interval=None,
+                 catchup_projects=None):
 
         self.es_url = es_url or ES_URL
         self.ls_url = ls_url or LS_URL
@@ -97,6 +221,43 @@ class Config(object):
             included_projects_regex or INCLUDED_PROJECTS_REGEX
         self.uncat_search_size = uncat_search_size or UNCAT_MAX_SEARCH_SIZE
         self.gerrit_query_file = gerrit_query_file or GERRIT_QUERY_FILE
+        self.classify_batch_size = classify_batch_size or CLASSIFY_BATCH_SIZE
+        self.local_eval = local_eval
+        self.local_eval_max_docs = local_eval_max_docs or LOCAL_EVAL_MAX_DOCS
+        self.db_pool_size = db_pool_size or DB_POOL_SIZE
+        self.db_pool_recycle = db_pool_recycle or DB_POOL_RECYCLE
+        self.es_pool_size = es_pool_size or ES_POOL_SIZE
+        self.es_timeout = es_timeout or ES_TIMEOUT
+        self.search_lookback = search_lookback or SEARCH_LOOKBACK
+        self.search_lookahead = search_lookahead or SEARCH_LOOKAHEAD
+        self.result_cache_db = result_cache_db
+        self.result_cache_size = result_cache_size or RESULT_CACHE_SIZE
+        self.test_ids_cache_size = test_ids_cache_size or TEST_IDS_CACHE_SIZE
+        self.classify_cache_size = classify_cache_size or CLASSIFY_CACHE_SIZE
+        self.classify_cache_ttl = classify_cache_ttl or CLASSIFY_CACHE_TTL
+        self.classify_cache_db = classify_cache_db
+        self.lag_monitor_interval = \
+            lag_monitor_interval or LAG_MONITOR_INTERVAL
+        self.ready_poll_min = ready_poll_min or READY_POLL_MIN
+        self.ready_poll_max = ready_poll_max or READY_POLL_MAX
+        self.journal_db = journal_db
+        self.journal_retention = journal_retention or JOURNAL_RETENTION
+        self.readiness_workers = readiness_workers or READINESS_WORKERS
+        self.classify_workers = classify_workers or CLASSIFY_WORKERS
+        self.notify_workers = notify_workers or NOTIFY_WORKERS
+        self.stage_queue_size = stage_queue_size or STAGE_QUEUE_SIZE
+        self.stage_stats_interval = \
+            stage_stats_interval or STAGE_STATS_INTERVAL
+        self.shed_policy = shed_policy
+        self.shed_backlog = shed_backlog or SHED_BACKLOG
+        self.shed_age = shed_age or SHED_AGE
+        self.coalesce_window = coalesce_window or COALESCE_WINDOW
+        self.readiness_feed = readiness_feed
+        self.catchup = catchup
+        self.catchup_max_age = catchup_max_age or CATCHUP_MAX_AGE
+        self.catchup_comment_interval = \
+            catchup_comment_interval or CATCHUP_COMMENT_INTERVAL
+        self.catchup_projects = catchup_projects or CATCHUP_PROJECTS
 
         if config_file or config_obj:
             if config_obj:
@@ -122,10 +283,110 @@ class Config(object):
                 self.db_uri = config.get('data_source', 'db_uri')
                 self.es_index_format = config.get('data_source',
                                                   'index_format')
+                if config.has_option('data_source', 'db_pool_size'):
+                    self.db_pool_size = config.getint('data_source',
+                                                      'db_pool_size')
+                if config.has_option('data_source', 'db_pool_recycle'):
+                    self.db_pool_recycle = config.getint('data_source',
+                                                         'db_pool_recycle')
+                if config.has_option('data_source', 'es_pool_size'):
+                    self.es_pool_size = config.getint('data_source',
+                                                      'es_pool_size')
+                if config.has_option('data_source', 'es_timeout'):
+                    self.es_timeout = config.getint('data_source',
+                                                    'es_timeout')
+                if config.has_option('data_source', 'search_lookback'):
+                    self.search_lookback = config.getint('data_source',
+                                                         'search_lookback')
+                if config.has_option('data_source', 'search_lookahead'):
+                    self.search_lookahead = config.getint(
+                        'data_source', 'search_lookahead')
+                if config.has_option('data_source', 'result_cache_db'):
+                    self.result_cache_db = os.path.expanduser(config.get(
+                        'data_source', 'result_cache_db'))
+                if config.has_option('data_source', 'result_cache_size'):
+                    self.result_cache_size = config.getint(
+                        'data_source', 'result_cache_size')
 
             if config.has_section('recheckwatch'):
                 self.ci_username = config.get('recheckwatch', 'ci_username')
                 self.jobs_re = config.get('recheckwatch', 'jobs_re')
+                if config.has_option('recheckwatch', 'classify_batch_size'):
+                    self.classify_batch_size = config.getint(
+                        'recheckwatch', 'classify_batch_size')
+                if config.has_option('recheckwatch', 'local_eval'):
+                    self.local_eval = config.getboolean(
+                        'recheckwatch', 'local_eval')
+                if config.has_option('recheckwatch', 'local_eval_max_docs'):
+                    self.local_eval_max_docs = config.getint(
+                        'recheckwatch', 'local_eval_max_docs')
+                if config.has_option('recheckwatch', 'classify_cache_size'):
+                    self.classify_cache_size = config.getint(
+                        'recheckwatch', 'classify_cache_size')
+                if config.has_option('recheckwatch', 'classify_cache_ttl'):
+                    self.classify_cache_ttl = config.getint(
+                        'recheckwatch', 'classify_cache_ttl')
+                if config.has_option('recheckwatch', 'classify_cache_db'):
+                    self.classify_cache_db = os.path.expanduser(config.get(
+                        'recheckwatch', 'classify_cache_db'))
+                if config.has_option('recheckwatch', 'lag_monitor_interval'):
+                    self.lag_monitor_interval = config.getint(
+                        'recheckwatch', 'lag_monitor_interval')
+                if config.has_option('recheckwatch', 'ready_poll_min'):
+                    self.ready_poll_min = config.getint(
+                        'recheckwatch', 'ready_poll_min')
+                if config.has_option('recheckwatch', 'ready_poll_max'):
+                    self.ready_poll_max = config.getint(
+                        'recheckwatch', 'ready_poll_max')
+                if config.has_option('recheckwatch', 'journal_db'):
+                    self.journal_db = os.path.expanduser(config.get(
+                        'recheckwatch', 'journal_db'))
+                if config.has_option('recheckwatch', 'journal_retention'):
+                    self.journal_retention = config.getint(
+                        'recheckwatch', 'journal_retention')
+                if config.has_option('recheckwatch', 'readiness_workers'):
+                    self.readiness_workers = config.getint(
+                        'recheckwatch', 'readiness_workers')
+                if config.has_option('recheckwatch', 'classify_workers'):
+                    self.classify_workers = config.getint(
+                        'recheckwatch', 'classify_workers')
+                if config.has_option('recheckwatch', 'notify_workers'):
+                    self.notify_workers = config.getint(
+                        'recheckwatch', 'notify_workers')
+                if config.has_option('recheckwatch', 'stage_queue_size'):
+                    self.stage_queue_size = config.getint(
+                        'recheckwatch', 'stage_queue_size')
+                if config.has_option('recheckwatch', 'stage_stats_interval'):
+                    self.stage_stats_interval = config.getint(
+                        'recheckwatch', 'stage_stats_interval')
+                if config.has_option('recheckwatch', 'shed_policy'):
+                    self.shed_policy = config.get(
+                        'recheckwatch', 'shed_policy') or None
+                if config.has_option('recheckwatch', 'shed_backlog'):
+                    self.shed_backlog = config.getint(
+                        'recheckwatch', 'shed_backlog')
+                if config.has_option('recheckwatch', 'shed_age'):
+                    self.shed_age = config.getint(
+                        'recheckwatch', 'shed_age')
+                if config.has_option('recheckwatch', 'coalesce_window'):
+                    self.coalesce_window = config.getint(
+                        'recheckwatch', 'coalesce_window')
+                if config.has_option('recheckwatch', 'readiness_feed'):
+                    self.readiness_feed = config.get(
+                        'recheckwatch', 'readiness_feed')
+                if config.has_option('recheckwatch', 'catchup'):
+                    self.catchup = config.getboolean(
+                        'recheckwatch', 'catchup')
+                if config.has_option('recheckwatch', 'catchup_max_age'):
+                    self.catchup_max_age = config.getint(
+                        'recheckwatch', 'catchup_max_age')
+                if config.has_option('recheckwatch',
+                                     'catchup_comment_interval'):
+                    self.catchup_comment_interval = config.getint(
+                        'recheckwatch', 'catchup_comment_interval')
+                if config.has_option('recheckwatch', 'catchup_projects'):
+                    self.catchup_projects = config.get(
+                        'recheckwatch', 'catchup_projects').split()
 
             if config.has_section('gerrit'):
                 self.gerrit_user = config.get('gerrit', 'user')
@@ -154,3 +415,7 @@ class Config(object):
                                                         'channel_config')
             if config.has_option('ircbot', 'log_config'):
                 self.irc_log_config = config.get('ircbot', 'log_config')
+
+        if self.shed_policy not in (None,) + SHED_POLICIES:
+            raise ValueError("Unknown shed_policy %s, expected one of %s" %
+                             (self.shed_policy, ', '.join(SHED_POLICIES)))
@@ -15,21 +15,46 @@
 import dateutil.parser as dp
 import gerritlib.gerrit
 import pyelasticsearch
+import six
 import sqlalchemy
+from sqlalchemy.engine import url as sa_url
 from sqlalchemy import orm
 from subunit2sql.db import api as db_api
+from subunit2sql.db import models
 
+import calendar
+import collections
 import datetime
+import heapq
+import itertools
 import logging
 import re
+import threading
 import time
 
+from elastic_recheck import cache
 import elastic_recheck.config as er_conf
+import elastic_recheck.journal as er_journal
 import elastic_recheck.loader as loader
+from elastic_recheck import matcher
 import elastic_recheck.query_builder as qb
 from elastic_recheck import results
 
 
+# We wait 20 minutes wall time since receiving the event until we treat the
+# logs as missing.
+READY_TIMEOUT = 1200
+# Wait 40 seconds between readiness checks of an event.
+READY_INTERVAL = 40
+
+# What the CI failure comments look like, a "Build failed" comment with a
+# line for every job, the failed ones end with FAILURE.
+BUILD_FAILED = "Build failed"
+FAILURE = "FAILURE"
+NON_VOTING = " (non-voting)"
+FAILED_JOB_RE = re.compile(r"- ([\w-]+)\s*(http://\S+)\s*:\s*FAILURE")
+
+
 def required_files(job):
     files = []
     if re.match("(tempest|grenade)-dsvm", job):
@@ -84,6 +109,10 @@ class FailJob(object):
     build_short_uuid = None
     url = None
     name = None
+    # the files uploaded by the job, once we know they are in elastic search
+    files = None
+    # all the logs of the job are in elastic search
+    ready = False
 
     def __init__(self, name, url):
         self.name = name
@@ -108,14 +137,19 @@ class FailEvent(object):
     build_short_uuids = []
     comment = None
     failed_jobs = []
+    # how far the bot got with the event, one of the journal stages
+    stage = None
 
     def __init__(self, event, failed_jobs, config=None):
+        self.gerrit_event = event
         self.change = int(event['change']['number'])
         self.rev = int(event['patchSet']['number'])
         self.project = event['change']['project']
         self.url = event['change']['url']
         self.comment = event["comment"]
         self.created_on = event["eventCreatedOn"]
+        # number of times we found the logs weren't indexed yet
+        self.ready_checks = 0
         # TODO(jogo): make FailEvent generate the jobs
         self.failed_jobs = failed_jobs
         self.config = config or er_conf.Config()
@@ -126,6 +160,16 @@ class FailEvent(object):
     def name(self):
         return "%d,%d" % (self.change, self.rev)
 
+    def timerange(self):
+        """Return the (start, end) time of the log lines of the builds."""
+        return (self.created_on - self.config.search_lookback,
+                self.created_on + self.config.search_lookahead)
+
+    def key(self):
+        """A unique key for the event, a change can fail more than once."""
+        return "%s,%s" % (self.name(), ','.join(sorted(
+            self.build_short_uuids())))
+
     def bug_urls(self, bugs=None):
         if bugs is None:
             bugs = self.get_all_bugs()
@@ -191,6 +235,188 @@ class FailEvent(object):
                 (self.change, self.rev, self.project, self.url, self.comment))
 
 
+class ReadinessScheduler(object):
+    """Failure events waiting for their logs to show up in ElasticSearch.
+
+    Events are kept in a heap ordered by the time they are due to be
+    checked next, so any number of them can be waiting at once, and each
+    one is handed out as soon as it is due, independent of the others.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # tie breaker, so events due at the same time keep arrival order
+        self._counter = itertools.count()
+        # id(event) -> (counter, due) of its current heap entry, the old
+        # entries of rescheduled events are left in the heap and skipped
+        self._entries = {}
+        self._cond = threading.Condition()
+
+    def _push(self, event, due):
+        count = next(self._counter)
+        heapq.heappush(self._heap, (due, count, event))
+        self._entries[id(event)] = (count, due)
+        self._cond.notify()
+
+    def _head(self):
+        while self._heap:
+            due, count, event = self._heap[0]
+            if self._entries.get(id(event), (None,))[0] == count:
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop(self):
+        event = heapq.heappop(self._heap)[2]
+        del self._entries[id(event)]
+        return event
+
+    def add(self, event, due):
+        with self._cond:
+            self._push(event, due)
+
+    def advance(self, event, due):
+        """Make a scheduled event due at `due`, if that is sooner.
+
+        Returns False if the event isn't scheduled.
+        """
+        with self._cond:
+            if id(event) not in self._entries:
+                return False
+            if due < self._entries[id(event)][1]:
+                self._push(event, due)
+            return True
+
+    def next_due(self):
+        """Return when the next event is due, or None if there is none."""
+        with self._cond:
+            head = self._head()
+            return None if head is None else head[0]
+
+    def pop_due(self, now):
+        """Return the next event due at `now`, or None."""
+        with self._cond:
+            head = self._head()
+            if head is not None and head[0] <= now:
+                return self._pop()
+            return None
+
+    def wait_due(self, timeout=None):
+        """Wait for the next event to be due and return it.
+
+        Returns None if no event is due within `timeout` seconds.
+        """
+        with self._cond:
+            end = None if timeout is None else time.time() + timeout
+            while True:
+                now = time.time()
+                head = self._head()
+                if head is not None and head[0] <= now:
+                    return self._pop()
+                wait = head[0] - now if head is not None else None
+                if end is not None:
+                    if now >= end:
+                        return None
+                    wait = min(wait, end - now) if wait else end - now
+                self._cond.wait(wait)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+
+
+class EventCoalescer(object):
+    """Drops the duplicate reports of a failure.
+
+    The same builds can be reported more than once, by different CI
+    accounts or when results are re-reported. Events are keyed by change,
+    patchset and the set of build_short_uuids, only the first event with a
+    key goes on to readiness, classification and the comment, the
+    duplicates seen within `window` seconds are dropped.
+    """
+
+    def __init__(self, window=er_conf.COALESCE_WINDOW):
+        self.window = window
+        # the number of duplicates dropped
+        self.coalesced = 0
+        # key -> (first seen, event), oldest first
+        self._events = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._events:
+            key, entry = next(iter(self._events.items()))
+            if entry[0] + self.window > now:
+                break
+            del self._events[key]
+
+    def add(self, event):
+        """Track an event.
+
+        Returns None for new events, for duplicates it returns the earlier
+        event with the same key, so the caller can drop the duplicate.
+        """
+        key = event.key()
+        with self._lock:
+            self._expire(time.time())
+            if key not in self._events:
+                self._events[key] = (time.time(), event)
+                return None
+            self.coalesced += 1
+            return self._events[key][1]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._events)
+
+
+class IndexLagMonitor(threading.Thread):
+    """Keeps track of how far behind ElasticSearch indexing is.
+
+    Every `interval` seconds this looks up the most recently indexed log
+    line, `lag` is how many seconds old it was, or None if we don't know.
+    If nothing was indexed in the recent indexes, which hold at least the
+    last RECENT_WINDOW seconds of logs, the lag is at least that.
+    """
+
+    log = logging.getLogger("recheckwatchbot")
+
+    RECENT_WINDOW = 3600
+
+    def __init__(self, classifier, interval=er_conf.LAG_MONITOR_INTERVAL):
+        super(IndexLagMonitor, self).__init__(name='index-lag-monitor')
+        self.daemon = True
+        self.classifier = classifier
+        self.interval = interval
+        self.lag = None
+        self._stopped = threading.Event()
+
+    def check(self):
+        try:
+            last = self.classifier.most_recent(recent=True)
+        except Exception:
+            self.log.exception("Failed to get the indexing lag")
+            self.lag = None
+            return
+        last = calendar.timegm(last.utctimetuple())
+        if last <= 0:
+            self.lag = self.RECENT_WINDOW
+            self.log.warning("Nothing was indexed in the last %ds" %
+                             self.lag)
+        else:
+            self.lag = max(0, time.time() - last)
+            self.log.debug("Elastic search indexing is %ds behind" %
+                           self.lag)
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.check()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
 class Stream(object):
     """Gerrit Stream.
 
@@ -199,54 +425,69 @@ class Stream(object):
 
     log = logging.getLogger("recheckwatchbot")
 
-    def __init__(self, user, host, key, config=None, thread=True):
+    def __init__(self, user, host, key, config=None, thread=True,
+                 lag_monitor=None, journal=None, feed=None):
         self.config = config or er_conf.Config()
         port = 29418
         self.gerrit = gerritlib.gerrit.Gerrit(host, user, port, key)
-        self.es = results.SearchEngine(self.config.es_url)
+        self.es = results.SearchEngine(self.config.es_url,
+                                       pool_size=self.config.es_pool_size,
+                                       timeout=self.config.es_timeout)
+        self.scheduler = ReadinessScheduler()
+        self.coalescer = EventCoalescer(window=self.config.coalesce_window)
+        # an IndexLagMonitor, used to schedule the readiness checks
+        self.lag_monitor = lag_monitor
+        # an EventJournal, to keep track of events across restarts
+        self.journal = journal
+        # build_short_uuid -> waiting event, and the builds the feed said
+        # were indexed before we got their event
+        self._waiting = {}
+        self._indexed = cache.LRUCache(maxsize=10000, ttl=READY_TIMEOUT)
+        self._waiting_lock = threading.Lock()
+        # a feed.IndexedFeed, telling us when the logs of a build are
+        # indexed, so we don't have to wait for the next readiness check
+        self.feed = feed
+        if self.feed is not None:
+            self.feed.subscribe(self.indexed)
+        if self.journal is not None:
+            self._resume()
         if thread:
             self.gerrit.startWatching()
 
     @staticmethod
-    def parse_jenkins_failure(event, ci_username=er_conf.CI_USERNAME):
-        """Is this comment a jenkins failure comment."""
-        if event.get('type', '') != 'comment-added':
-            return False
+    def is_failure_comment(event, ci_username=er_conf.CI_USERNAME):
+        """Cheap check that an event can be a CI failure comment.
 
-        username = event['author'].get('username', '')
-        if (username not in [ci_username, 'zuul']):
+        Almost all the gerrit events are something else, this rejects them
+        before the comment is parsed.
+        """
+        if event.get('type') != 'comment-added':
+            return False
+        username = event.get('author', {}).get('username', '')
+        if username != ci_username and username != 'zuul':
             return False
+        comment = event.get('comment', '')
+        return BUILD_FAILED in comment and FAILURE in comment
 
-        if not ("Build failed" in
-                event['comment']):
+    @staticmethod
+    def parse_jenkins_failure(event, ci_username=er_conf.CI_USERNAME):
+        """Is this comment a jenkins failure comment."""
+        if not Stream.is_failure_comment(event, ci_username=ci_username):
             return False
 
         failed_tests = []
         for line in event['comment'].split("\n"):
             # this is needed to know if we care about categorizing
             # these items. It's orthoginal to non voting ES searching.
-            if " (non-voting)" in line:
+            if FAILURE not in line or NON_VOTING in line:
                 continue
-            m = re.search("- ([\w-]+)\s*(http://\S+)\s*:\s*FAILURE", line)
+            m = FAILED_JOB_RE.search(line)
             if m:
                 failed_tests.append(FailJob(m.group(1), m.group(2)))
         return failed_tests
 
-    def _job_console_uploaded(self, change, patch, name, build_short_uuid):
-        query = qb.result_ready(change, patch, name, build_short_uuid)
-        r = self.es.search(query, size='10', recent=True)
-        if len(r) == 0:
-            msg = ("Console logs not ready for %s %s,%s,%s" %
-                   (name, change, patch, build_short_uuid))
-            raise ConsoleNotReady(msg)
-        else:
-            self.log.debug("Console ready for %s %s,%s,%s" %
-                           (name, change, patch, build_short_uuid))
-
-    def _has_required_files(self, change, patch, name, build_short_uuid):
-        query = qb.files_ready(change, patch, name, build_short_uuid)
-        r = self.es.search(query, size='80', recent=True)
-        files = [x['term'] for x in r.terms]
+    def _check_required_files(self, change, patch, name, build_short_uuid,
+                              files):
         # TODO(dmsimard): Reliably differentiate zuul v2 and v3 jobs
         required = required_files(name)
         missing_files = [x for x in required if x not in files]
@@ -256,14 +497,58 @@ class Stream(object):
                 missing_files, name, change, patch, build_short_uuid))
             raise FilesNotReady(msg)
 
-    def _does_es_have_data(self, event):
-        """Wait till ElasticSearch is ready, but return False if timeout."""
-        # We wait 20 minutes wall time since receiving the event until we
-        # treat the logs as missing
-        timeout = 1200
-        # Wait 40 seconds between queries.
-        sleep_time = 40
-        timed_out = False
+    def _jobs_ready(self, event):
+        """Check the logs of the jobs of an event that aren't ready yet.
+
+        A single facetted search finds which of the jobs have a complete
+        console log, and which files they uploaded. Jobs found ready are
+        remembered, so they are never checked again. Raises ConsoleNotReady
+        or FilesNotReady if any job isn't ready.
+        """
+        jobs = [job for job in event.failed_jobs if not job.ready]
+        if not jobs:
+            return
+        query = qb.jobs_ready(event.change, event.rev,
+                              [job.build_short_uuid for job in jobs])
+        r = self.es.search(query, size=0, timerange=event.timerange())
+        consoles = set(x['term'] for x in r.facet('console'))
+        not_ready = None
+        for job in jobs:
+            if job.build_short_uuid not in consoles:
+                not_ready = not_ready or ConsoleNotReady(
+                    "Console logs not ready for %s %s,%s,%s" %
+                    (job.name, event.change, event.rev,
+                     job.build_short_uuid))
+                continue
+            self.log.debug("Console ready for %s %s,%s,%s" %
+                           (job.name, event.change, event.rev,
+                            job.build_short_uuid))
+            name = 'files-%s' % job.build_short_uuid
+            files = [x['term'] for x in r.facet(name)]
+            try:
+                self._check_required_files(event.change, event.rev, job.name,
+                                           job.build_short_uuid, files)
+            except FilesNotReady as e:
+                not_ready = not_ready or e
+                continue
+            if r.facet_complete(name, qb.JOBS_READY_FACET_SIZE):
+                job.files = files
+            else:
+                # the queries pinned to the files left out would be skipped
+                self.log.info("Not all the files of %s %s are known" %
+                              (job.name, job.build_short_uuid))
+            job.ready = True
+        if not_ready is not None:
+            raise not_ready
+
+    def _does_es_have_data(self, event, wait=True):
+        """Wait till ElasticSearch is ready, but return False if timeout.
+
+        With `wait` False only check once, and return False if the logs
+        aren't there yet, this is what the ReadinessScheduler uses to keep
+        many events in flight. Either way ResultTimedOut is raised once
+        the event is older than READY_TIMEOUT.
+        """
         # This checks that we've got the console log uploaded, need to retry
         # in case ES goes bonkers on cold data, which it does some times.
         # We check at least once so that we can return success if data is
@@ -271,16 +556,7 @@ class Stream(object):
         # the event was received.
         while True:
             try:
-                for job in event.failed_jobs:
-                    # TODO(jogo): if there are three failed jobs and only the
-                    # last one isn't ready we don't need to keep rechecking
-                    # the first two
-                    self._job_console_uploaded(
-                        event.change, event.rev, job.name,
-                        job.build_short_uuid)
-                    self._has_required_files(
-                        event.change, event.rev, job.name,
-                        job.build_short_uuid)
+                self._jobs_ready(event)
                 break
 
             except ConsoleNotReady as e:
@@ -296,17 +572,18 @@ class Stream(object):
             # If we fall through then we had a failure of some sort.
             # Wait until timeout is exceeded.
             now = time.time()
-            if now > event.created_on + timeout:
+            if now > event.created_on + READY_TIMEOUT:
                 # We've waited too long for this event, move on.
-                timed_out = True
-                break
-            time.sleep(sleep_time)
-        if timed_out:
-            elapsed = now - event.created_on
-            msg = ("Required files not ready after %ss for %s %d,%d,%s" %
-                   (elapsed, job.name, event.change, event.rev,
-                       job.build_short_uuid))
-            raise ResultTimedOut(msg)
+                elapsed = now - event.created_on
+                waiting = [x for x in event.failed_jobs if not x.ready]
+                job = (waiting or event.failed_jobs)[0]
+                msg = ("Required files not ready after %ss for %s %d,%d,%s" %
+                       (elapsed, job.name, event.change, event.rev,
+                        job.build_short_uuid))
+                raise ResultTimedOut(msg)
+            if not wait:
+                return False
+            time.sleep(READY_INTERVAL)
 
         self.log.debug(
             "Found hits for change_number: %d, patch_number: %d"
@@ -316,29 +593,211 @@ class Stream(object):
             % (event.change, event.rev))
         return True
 
+    def _next_check(self, event, now):
+        """Return when to check if the logs of an event are ready again.
+
+        Without a lag monitor this is every READY_INTERVAL seconds. With
+        one, the check is scheduled for when the logs should have been
+        indexed given the current lag, and from then on the wait doubles
+        each time, from ready_poll_min to ready_poll_max seconds. If the
+        lag is larger than READY_TIMEOUT the logs can't show up in time,
+        so ResultTimedOut is raised right away.
+        """
+        event.ready_checks += 1
+        if self.lag_monitor is None:
+            return now + READY_INTERVAL
+        deadline = event.created_on + READY_TIMEOUT
+        lag = self.lag_monitor.lag
+        if lag is not None and lag > READY_TIMEOUT:
+            raise ResultTimedOut(
+                "Indexing is %ds behind, giving up on %d,%d" %
+                (lag, event.change, event.rev))
+        wait = min(self.config.ready_poll_min * 2 ** (event.ready_checks - 1),
+                   self.config.ready_poll_max)
+        due = now + wait
+        if lag is not None and event.created_on + lag > now:
+            # the logs can't be there before the indexer catches up
+            due = max(event.created_on + lag, now + self.config.ready_poll_min)
+        # make sure the last check doesn't happen long after the timeout
+        return min(due, max(deadline + 1, now))
+
+    def _get_event(self, timeout=None):
+        """Get the next gerrit event, or None after `timeout` seconds."""
+        event_queue = getattr(self.gerrit, 'event_queue', None)
+        if timeout is None or event_queue is None:
+            return self.gerrit.getEvent()
+        try:
+            return event_queue.get(timeout=timeout)
+        except six.moves.queue.Empty:
+            return None
+
+    def _failure_event(self, event):
+        """Return a FailEvent for a gerrit event we care about, or None."""
+        failed_jobs = Stream.parse_jenkins_failure(
+            event, ci_username=self.config.ci_username)
+        if not failed_jobs:
+            # nothing to see here, lets try the next event
+            return None
+
+        fevent = FailEvent(event, failed_jobs, self.config)
+
+        # bail if the failure is from a project
+        # that hasn't run any of the included jobs
+        if not fevent.is_included_job():
+            return None
+
+        self.log.info("Looking for failures in %d,%d on %s" %
+                      (fevent.change, fevent.rev,
+                       ", ".join(fevent.failed_job_names())))
+        return fevent
+
     def get_failed_tempest(self):
+        """Return the next failure event whose logs are in ElasticSearch.
+
+        Failure events are tracked by the readiness scheduler while their
+        logs are being indexed, so an event that takes long to show up
+        doesn't hold back the ones received after it. Raises ResultTimedOut
+        for events that aren't ready within READY_TIMEOUT.
+        """
         self.log.debug("entering get_failed_tempest")
         while True:
-            event = self.gerrit.getEvent()
-
-            failed_jobs = Stream.parse_jenkins_failure(
-                event, ci_username=self.config.ci_username)
-            if not failed_jobs:
-                # nothing to see here, lets try the next event
+            fevent = self.scheduler.pop_due(time.time())
+            if fevent is not None:
+                if self.check_ready(fevent):
+                    return fevent
                 continue
 
-            fevent = FailEvent(event, failed_jobs, self.config)
-
-            # bail if the failure is from a project
-            # that hasn't run any of the included jobs
-            if not fevent.is_included_job():
+            next_due = self.scheduler.next_due()
+            timeout = None
+            if next_due is not None:
+                timeout = max(0, next_due - time.time())
+            fevent = self.next_failure(timeout)
+            if fevent is not None:
+                self.scheduler.add(fevent, time.time())
+
+    def next_failure(self, timeout=None):
+        """Return the next failure event from gerrit that we care about.
+
+        Returns None if the next gerrit event isn't one, or if there was no
+        event within `timeout` seconds.
+        """
+        event = self._get_event(timeout)
+        if event is None:
+            return None
+        fevent = self._failure_event(event)
+        if fevent is None:
+            return None
+        primary = self.coalescer.add(fevent)
+        if primary is not None:
+            self.log.info("Dropped a duplicate report of %s, the same "
+                          "builds are already being processed" % fevent.name())
+            return None
+        self.mark(fevent, er_journal.WAITING)
+        self._watch(fevent)
+        return fevent
+
+    def check_ready(self, fevent):
+        """Check once if the logs of an event are in ElasticSearch.
+
+        Returns True if they are. If they aren't the next check is added
+        to the scheduler and False is returned. Raises ResultTimedOut if we
+        waited too long for them.
+        """
+        try:
+            if self._does_es_have_data(fevent, wait=False):
+                self._unwatch(fevent)
+                if fevent.stage == er_journal.WAITING:
+                    self.mark(fevent, er_journal.READY)
+                return True
+            self.scheduler.add(fevent, self._next_check(fevent, time.time()))
+            return False
+        except ResultTimedOut:
+            self._unwatch(fevent)
+            self.mark(fevent, er_journal.TIMED_OUT)
+            raise
+
+    def _watch(self, fevent):
+        """Wait for the feed to tell us the logs of an event are indexed."""
+        if self.feed is None:
+            return
+        with self._waiting_lock:
+            for job in fevent.failed_jobs:
+                self._waiting[job.build_short_uuid] = fevent
+        for job in fevent.failed_jobs:
+            files = self._indexed.pop(job.build_short_uuid)
+            if files is not None:
+                self.indexed(job.build_short_uuid, files or None)
+
+    def _unwatch(self, fevent):
+        if self.feed is None:
+            return
+        with self._waiting_lock:
+            for job in fevent.failed_jobs:
+                if self._waiting.get(job.build_short_uuid) is fevent:
+                    del self._waiting[job.build_short_uuid]
+
+    def indexed(self, build_short_uuid, files=None):
+        """The logs of a build are indexed, according to the feed.
+
+        The job is ready, and once all the jobs of its event are, the event
+        is checked right away instead of at its next scheduled check.
+        """
+        with self._waiting_lock:
+            fevent = self._waiting.pop(build_short_uuid, None)
+            if fevent is None:
+                # the event may still be on its way
+                self._indexed.set(build_short_uuid, files or [])
+                return
+        for job in fevent.failed_jobs:
+            if job.build_short_uuid == build_short_uuid:
+                if files:
+                    job.files = files
+                job.ready = True
+        self.log.debug("Logs of %s for %s indexed" %
+                       (build_short_uuid, fevent.name()))
+        if all(job.ready for job in fevent.failed_jobs):
+            self.scheduler.advance(fevent, time.time())
+
+    def mark(self, event, stage):
+        """Record that an event reached a stage of processing.
+
+        If the stream has a journal this is persisted, so the event can be
+        picked up where it was left if the bot restarts.
+        """
+        event.stage = stage
+        if self.journal is None:
+            return
+        if stage == er_journal.WAITING:
+            self.journal.add(event.key(), event.gerrit_event)
+        elif stage == er_journal.CLASSIFIED:
+            bugs = dict((job.build_short_uuid, sorted(job.bugs))
+                        for job in event.failed_jobs)
+            self.journal.update(event.key(), stage, bugs=bugs)
+        else:
+            self.journal.update(event.key(), stage)
+
+    def _resume(self):
+        """Pick up the unfinished events of the journal."""
+        now = time.time()
+        for key, event, stage, bugs in self.journal.pending():
+            fevent = self._failure_event(event)
+            if fevent is None:
+                # like a change of the included jobs, it'd never finish
+                self.journal.update(key, er_journal.FAILED)
                 continue
-
-            self.log.info("Looking for failures in %d,%d on %s" %
-                          (fevent.change, fevent.rev,
-                           ", ".join(fevent.failed_job_names())))
-            if self._does_es_have_data(fevent):
-                return fevent
+            fevent.stage = stage
+            self.coalescer.add(fevent)
+            if stage in (er_journal.READY, er_journal.CLASSIFIED):
+                for job in fevent.failed_jobs:
+                    job.ready = True
+            if stage == er_journal.CLASSIFIED:
+                for job in fevent.failed_jobs:
+                    job.bugs = set(bugs.get(job.build_short_uuid, []))
+            self.scheduler.add(fevent, now)
+            self._watch(fevent)
+        if len(self.scheduler):
+            self.log.info("Resuming %d events from the journal" %
+                          len(self.scheduler))
 
     def leave_comment(self, event, msgs, debug=False):
         parts = []
@@ -358,9 +817,14 @@ class Stream(object):
             self.gerrit.review(event.project, event.name(), msg)
 
 
-def check_failed_test_ids_for_job(build_uuid, test_ids, session):
-    failing_test_ids = db_api.get_failing_test_ids_from_runs_by_key_value(
-        'build_short_uuid', build_uuid, session)
+def check_failed_test_ids_for_job(build_uuid, test_ids, session,
+                                  failing_tests=None):
+    if failing_tests is not None:
+        failing_test_ids = failing_tests.get(build_uuid, session)
+    else:
+        failing_test_ids = (
+            db_api.get_failing_test_ids_from_runs_by_key_value(
+                'build_short_uuid', build_uuid, session))
     for test_id in test_ids:
         if test_id in failing_test_ids:
             return True
@@ -368,6 +832,80 @@ def check_failed_test_ids_for_job(build_uuid, test_ids, session):
         return False
 
 
+def get_failing_test_ids_for_builds(build_uuids, session, chunk_size=500):
+    """Get the failing test_ids for a list of builds in bulk.
+
+    This is the bulk version of subunit2sql's
+    get_failing_test_ids_from_runs_by_key_value for the build_short_uuid
+    key, it runs one query per `chunk_size` builds instead of one per build.
+
+    Returns a dict of build_short_uuid to the set of failing test_ids, with
+    an empty set for builds that have no failures in subunit2sql.
+    """
+    build_uuids = list(set(build_uuids))
+    failing = dict((build_uuid, set()) for build_uuid in build_uuids)
+    for start in range(0, len(build_uuids), chunk_size):
+        chunk = build_uuids[start:start + chunk_size]
+        rows = session.query(
+            models.RunMetadata.value, models.Test.test_id).select_from(
+                models.TestRun).join(
+                    models.Test,
+                    models.TestRun.test_id == models.Test.id).join(
+                        models.RunMetadata,
+                        models.TestRun.run_id == models.RunMetadata.run_id
+                    ).filter(
+                        models.RunMetadata.key == 'build_short_uuid',
+                        models.RunMetadata.value.in_(chunk),
+                        models.TestRun.status == 'fail').distinct()
+        for build_uuid, test_id in rows:
+            failing[build_uuid].add(test_id)
+    return failing
+
+
+class FailingTestIds(object):
+    """A bounded cache of the failing test_ids of builds.
+
+    Several bugs with test_ids can match the same build, this makes sure
+    we only ask subunit2sql for the failing tests of a build once. Builds
+    without failing tests aren't cached, their subunit2sql data may not be
+    uploaded yet.
+    """
+
+    def __init__(self, maxsize=er_conf.TEST_IDS_CACHE_SIZE):
+        self._cache = cache.LRUCache(maxsize)
+
+    def get(self, build_uuid, session):
+        failing = self._cache.get(build_uuid)
+        if failing is None:
+            failing = self.prefetch([build_uuid], session)[build_uuid]
+        return failing
+
+    def prefetch(self, build_uuids, session):
+        """Load the failing test_ids of the builds not already cached."""
+        failing = {}
+        missing = []
+        for build_uuid in build_uuids:
+            cached = self._cache.get(build_uuid)
+            if cached is None:
+                missing.append(build_uuid)
+            else:
+                failing[build_uuid] = cached
+        if missing:
+            fetched = get_failing_test_ids_for_builds(missing, session)
+            for build_uuid, test_ids in fetched.items():
+                if test_ids:
+                    self._cache.set(build_uuid, test_ids)
+            failing.update(fetched)
+        return failing
+
+    def set(self, build_uuid, test_ids):
+        """Store the failing test_ids of a build, if they are known."""
+        self._cache.set(build_uuid, set(test_ids))
+
+    def __contains__(self, build_uuid):
+        return self._cache.get(build_uuid) is not None
+
+
 class Classifier(object):
     """Classify failed tempest-devstack jobs based.
 
@@ -378,11 +916,33 @@ class Classifier(object):
 
     queries = None
 
+    _session_factory = None
+    _session_lock = threading.Lock()
+
     def __init__(self, queries_dir, config=None):
         self.config = config or er_conf.Config()
-        self.es = results.SearchEngine(self.config.es_url)
+        result_cache = None
+        if self.config.result_cache_db:
+            result_cache = cache.IndexResultCache(
+                self.config.result_cache_db,
+                max_bytes=self.config.result_cache_size)
+        self.es = results.SearchEngine(self.config.es_url,
+                                       pool_size=self.config.es_pool_size,
+                                       timeout=self.config.es_timeout,
+                                       result_cache=result_cache)
         self.queries_dir = queries_dir
-        self.queries = loader.load(self.queries_dir)
+        self._registry = loader.QueryRegistry(self.queries_dir)
+        self.queries = self._registry.refresh()
+        self.failing_tests = FailingTestIds(self.config.test_ids_cache_size)
+        self.classify_cache = cache.ClassificationCache(
+            maxsize=self.config.classify_cache_size,
+            ttl=self.config.classify_cache_ttl,
+            path=self.config.classify_cache_db)
+        self._matchers = {}
+        self._index = None
+        self._index_key = None
+        # number of queries skipped because they couldn't match the job
+        self.skipped_queries = 0
 
     def hits_by_query(self, query, queue=None, facet=None, size=100, days=0):
         if queue:
@@ -391,44 +951,341 @@ class Classifier(object):
             es_query = qb.generic(query, facet=facet)
         return self.es.search(es_query, size=size, days=days)
 
-    def most_recent(self):
-        """Return the datetime of the most recently indexed event."""
+    def facets_by_query(self, query, facets, queue=None, days=0, res=3600):
+        """Count the hits of a query per facet, see SearchEngine.aggregate.
+
+        This is what FacetSet.detect_facets() on the hits of hits_by_query
+        would give, with the number of hits instead of the hits.
+        """
+        if queue:
+            es_query = qb.single_queue(query, queue)
+        else:
+            es_query = qb.generic(query)
+        return self.es.aggregate(es_query, facets, res=res, days=days)
+
+    def iter_hits_by_query(self, query, queue=None, facet=None, limit=None,
+                           days=0):
+        """Like hits_by_query, but yield the hits a page at a time.
+
+        Up to `limit` hits are yielded, with a warning if there were more.
+        """
+        if queue:
+            es_query = qb.single_queue(query, queue, facet=facet)
+        else:
+            es_query = qb.generic(query, facet=facet)
+        return self.es.iter_search(es_query, limit=limit, days=days)
+
+    def most_recent(self, recent=False):
+        """Return the datetime of the most recently indexed event.
+
+        With `recent` only the most recent indexes are searched, which is
+        a lot cheaper but finds nothing if nothing was indexed lately.
+        """
         query = qb.most_recent_event()
-        results = self.es.search(query, size='1')
+        results = self.es.search(query, size='1', recent=recent)
         if len(results) > 0:
             last = dp.parse(results[0].timestamp)
             return last
         return datetime.datetime.utcfromtimestamp(0)
 
     def classify(self, change_number, patch_number,
-                 build_short_uuid, recent=False):
-        """Returns either empty list or list with matched bugs."""
+                 build_short_uuid, recent=False, job_name=None, files=None,
+                 queue=None, timerange=None):
+        """Returns either empty list or list with matched bugs.
+
+        If the job name, the files the job uploaded, or the queue it ran in
+        are known, queries pinned to other jobs, files or queues are skipped.
+        With a `timerange`, usually FailEvent.timerange(), only the log
+        lines of that time are searched instead of the `recent` ones.
+        """
+        build = {'change_number': change_number,
+                 'patch_number': patch_number,
+                 'build_short_uuid': build_short_uuid,
+                 'job_name': job_name,
+                 'files': files,
+                 'queue': queue}
+        return self.classify_builds([build], recent=recent,
+                                    timerange=timerange)[0]
+
+    def classify_events(self, events):
+        """Classify all the failed jobs of a list of FailEvents at once.
+
+        The bugs found are set on the jobs. The log lines searched are
+        those of the time of any of the events.
+        """
+        builds = []
+        for event in events:
+            for job in event.failed_jobs:
+                builds.append({'change_number': event.change,
+                               'patch_number': event.rev,
+                               'build_short_uuid': job.build_short_uuid,
+                               'job_name': job.name,
+                               'files': job.files,
+                               'queue': event.queue()})
+        if not builds:
+            return
+        starts, ends = zip(*[event.timerange() for event in events])
+        found = self.classify_builds(builds,
+                                     timerange=(min(starts), max(ends)))
+        jobs = [job for event in events for job in event.failed_jobs]
+        for job, bugs in zip(jobs, found):
+            job.bugs = set(bugs)
+
+    def classify_builds(self, builds, recent=False, timerange=None):
+        """Classify several builds, returns the list of bugs of each one.
+
+        `builds` is a list of dicts of the arguments of classify() for
+        each build. The bug queries of all the builds share multi search
+        requests, and the failing tests of the builds are fetched from
+        subunit2sql in bulk.
+        """
         self.log.debug("Entering classify")
-        # Reload each time
-        self.queries = loader.load(self.queries_dir)
+        # Pick up any query changes, this only re-parses changed files
+        self.queries = self._registry.refresh()
+        all_queries = [x for x in self.queries
+                       if not x.get('suppress-notification')]
+        if timerange is not None:
+            where = {'timerange': timerange}
+        else:
+            where = {'recent': recent}
+        plans = []
+        searches = []
+        for build in builds:
+            build_short_uuid = build['build_short_uuid']
+            queries = self._applicable(all_queries, build_short_uuid,
+                                       job_name=build.get('job_name'),
+                                       files=build.get('files'),
+                                       queue=build.get('queue'))
+            fingerprints = dict((x['bug'], loader.fingerprint(x))
+                                for x in queries)
+            cached = self.classify_cache.get(build_short_uuid,
+                                             list(fingerprints.values()))
+            uncached = [x for x in queries
+                        if fingerprints[x['bug']] not in cached]
+            self.log.debug("%d of %d query results for %s found in cache" %
+                           (len(queries) - len(uncached), len(queries),
+                            build_short_uuid))
+            found = set()
+            remaining = uncached
+            if self.config.local_eval and uncached:
+                found, remaining = self._evaluate_locally(
+                    uncached, build['change_number'], build['patch_number'],
+                    build_short_uuid, **where)
+            plans.append((queries, fingerprints, cached, uncached, found))
+            searches.extend((build, x) for x in remaining)
+        # the set of bugs found of each build
+        found_by_build = dict((build['build_short_uuid'], plan[4])
+                              for build, plan in zip(builds, plans))
+        for (build, x), result_set in self._search_queries(searches,
+                                                           **where):
+            if len(result_set) > 0:
+                found_by_build[build['build_short_uuid']].add(x['bug'])
+
+        # the failing tests of all the builds that need them, at once
+        tested = [build['build_short_uuid']
+                  for build, plan in zip(builds, plans)
+                  if any(x.get('test_ids') and x['bug'] in plan[4]
+                         for x in plan[3])]
+        session = None
+        failing = {}
         bug_matches = []
-        engine = sqlalchemy.create_engine(self.config.db_uri)
-        Session = orm.sessionmaker(bind=engine)
-        session = Session()
-        for x in self.queries:
-            if x.get('suppress-notification'):
+        try:
+            if len(tested) > 1:
+                session = self._db_session()
+                failing = self.failing_tests.prefetch(tested, session)
+            for build, plan in zip(builds, plans):
+                if session is None and build['build_short_uuid'] in tested:
+                    session = self._db_session()
+                bug_matches.append(self._matches(
+                    build['build_short_uuid'], session, failing, *plan))
+        finally:
+            if session is not None:
+                # give the connection back to the pool
+                self._session_factory.remove()
+        return bug_matches
+
+    def _matches(self, build_short_uuid, session, failing, queries,
+                 fingerprints, cached, uncached, found):
+        """Return the bugs matched by a build, caching the new results.
+
+        `failing` has the failing tests of the builds they were fetched
+        for already.
+        """
+        matched = {}
+        # the results that may change once subunit2sql has the build
+        unsettled = set()
+        for x in uncached:
+            matched[fingerprints[x['bug']]] = False
+            if x['bug'] not in found:
                 continue
-            self.log.debug(
-                "Looking for bug: https://bugs.launchpad.net/bugs/%s"
-                % x['bug'])
-            query = qb.single_patch(x['query'], change_number, patch_number,
-                                    build_short_uuid)
-            results = self.es.search(query, size='10', recent=recent)
-            if len(results) > 0:
-                if x.get('test_ids', None):
-                    test_ids = x['test_ids']
-                    self.log.debug(
-                        "For bug %s checking subunit2sql for failures on "
-                        "test_ids: %s" % (x['bug'], test_ids))
-                    if check_failed_test_ids_for_job(build_short_uuid,
-                                                     test_ids, session):
-                        bug_matches.append(x['bug'])
+            if x.get('test_ids', None):
+                test_ids = x['test_ids']
+                self.log.debug(
+                    "For bug %s checking subunit2sql for failures on "
+                    "test_ids: %s" % (x['bug'], test_ids))
+                if build_short_uuid in failing:
+                    hit = bool(failing[build_short_uuid] & set(test_ids))
                 else:
-                    bug_matches.append(x['bug'])
-
-        return bug_matches
+                    hit = check_failed_test_ids_for_job(
+                        build_short_uuid, test_ids, session,
+                        failing_tests=self.failing_tests)
+                if hit:
+                    matched[fingerprints[x['bug']]] = True
+                elif build_short_uuid not in self.failing_tests:
+                    unsettled.add(fingerprints[x['bug']])
+            else:
+                matched[fingerprints[x['bug']]] = True
+        self.classify_cache.set(build_short_uuid, dict(
+            (k, v) for k, v in matched.items() if k not in unsettled))
+        matched.update(cached)
+        return [x['bug'] for x in queries if matched[fingerprints[x['bug']]]]
+
+    def _applicable(self, queries, build_short_uuid, job_name=None,
+                    files=None, queue=None):
+        """Drop the queries that can't match a job."""
+        if job_name is None and files is None and queue is None:
+            return queries
+        index_key = tuple((x['bug'], x['query']) for x in self.queries)
+        if self._index_key != index_key:
+            self._index = matcher.QueryIndex(self.queries)
+            self._index_key = index_key
+        candidates = self._index.candidates(
+            build_name=[job_name] if job_name else None,
+            build_queue=[queue] if queue else None,
+            filename=files,
+            tags=matcher.file_tags(files) if files is not None else None)
+        applicable = [x for x in queries if x['bug'] in candidates]
+        skipped = len(queries) - len(applicable)
+        self.skipped_queries += skipped
+        self.log.info("Skipped %d of %d queries that can't match %s %s" %
+                      (skipped, len(queries), job_name, build_short_uuid))
+        return applicable
+
+    def prefetch_failing_tests(self, build_uuids):
+        """Load the failing test_ids of many builds in bulk.
+
+        Tools that classify a lot of builds should call this first, so that
+        classify() finds the failing tests of each build in the cache
+        instead of asking subunit2sql once per build.
+        """
+        try:
+            self.failing_tests.prefetch(build_uuids, self._db_session())
+        finally:
+            self._session_factory.remove()
+
+    def _db_session(self):
+        """Return a session on the subunit2sql database.
+
+        The engine, and its connection pool, are created the first time a
+        session is needed and then shared by all classify calls, so we only
+        pay for connecting to the database once.
+        """
+        with self._session_lock:
+            if self._session_factory is None:
+                kwargs = {'pool_recycle': self.config.db_pool_recycle}
+                if not sa_url.make_url(
+                        self.config.db_uri).drivername.startswith('sqlite'):
+                    # sqlite doesn't use a QueuePool, so has no pool size
+                    kwargs['pool_size'] = self.config.db_pool_size
+                engine = sqlalchemy.create_engine(self.config.db_uri,
+                                                  **kwargs)
+                # sessions are per thread, so classify can run in parallel
+                self._session_factory = orm.scoped_session(
+                    orm.sessionmaker(bind=engine))
+        return self._session_factory()
+
+    def _matcher(self, query):
+        """Return the compiled matcher for a query, or None."""
+        if query not in self._matchers:
+            try:
+                self._matchers[query] = matcher.compile_query(query)
+            except matcher.UnsupportedQuery as e:
+                self.log.debug("Can't evaluate query locally: %s" % e)
+                self._matchers[query] = None
+        return self._matchers[query]
+
+    def _evaluate_locally(self, queries, change_number, patch_number,
+                          build_short_uuid, **where):
+        """Evaluate bug queries in memory against a build's log lines.
+
+        The log lines of the build are counted, and if there are no more
+        than local_eval_max_docs of them they are fetched from elastic
+        search in a single search, and every query that can be compiled is
+        matched against them locally. Bigger builds are left to elastic
+        search, fetching all their lines would cost more than the searches.
+
+        Returns a tuple of the set of matched bugs, and the list of queries
+        that couldn't be evaluated locally and still need to be searched.
+        """
+        compiled = []
+        remaining = []
+        fields = set()
+        for x in queries:
+            query_matcher = self._matcher(x['query'])
+            if query_matcher is None:
+                remaining.append(x)
+            else:
+                compiled.append((x, query_matcher))
+                fields |= matcher.query_fields(x['query'])
+        if not compiled:
+            return set(), remaining
+
+        query = qb.single_build(change_number, patch_number,
+                                build_short_uuid, fields=fields)
+        count = self.es.search(query, size=0, **where)
+        total = count.hits['total'] if count.hits else 0
+        if total > self.config.local_eval_max_docs:
+            self.log.info(
+                "Build %s has %d log lines, more than the %d we can "
+                "evaluate locally" % (build_short_uuid, total,
+                                      self.config.local_eval_max_docs))
+            return set(), queries
+        docs = []
+        if total:
+            result_set = self.es.search(query, size=total, **where)
+            docs = result_set.hits['hits'] if result_set.hits else []
+
+        found = set()
+        for x, query_matcher in compiled:
+            if any(query_matcher(doc) for doc in docs):
+                found.add(x['bug'])
+        self.log.debug(
+            "Evaluated %d queries locally against %d log lines of %s, "
+            "%d left for elastic search" % (len(compiled), len(docs),
+                                            build_short_uuid, len(remaining)))
+        return found, remaining
+
+    def _search_queries(self, searches, **where):
+        """Search for bug queries against builds.
+
+        `searches` is a list of (build, query) tuples, with builds like
+        those of classify_builds(). The queries are sent to elastic search
+        in batches using the multi search API, instead of doing a round
+        trip per query. Yields a ((build, query), results) tuple for every
+        search.
+        """
+        batch_size = self.config.classify_batch_size
+        for start in range(0, len(searches), batch_size):
+            batch = searches[start:start + batch_size]
+            es_queries = [qb.single_patch(x['query'],
+                                          build['change_number'],
+                                          build['patch_number'],
+                                          build['build_short_uuid'])
+                          for build, x in batch]
+            self.log.debug(
+                "Looking for bugs: %s" % ', '.join(
+                    '%s in %s' % (x['bug'], build['build_short_uuid'])
+                    for build, x in batch))
+            responses = self.es.multi_search(es_queries, size='10',
+                                             **where)
+            for search, es_query, result_set in zip(batch, es_queries,
+                                                    responses):
+                if getattr(result_set, 'error', None):
+                    # elastic search failed to run this query as part of the
+                    # batch, so retry it on its own.
+                    self.log.warning(
+                        "Multi search failed for bug %s, retrying: %s" %
+                        (search[1]['bug'], result_set.error))
+                    result_set = self.es.search(es_query, size='10',
+                                                **where)
+                yield search, result_set
@@ -0,0 +1,184 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Notifications that the logs of a build are indexed.
+
+The log indexing workers can publish a message once all the files of a
+build are in ElasticSearch, so the bot doesn't have to poll for them. A
+message is a JSON object like::
+
+    {"build_short_uuid": "d3fd328", "files": ["job-output.txt", ...]}
+
+where "files" is optional. Messages come from an MQTT topic, or from a
+local unix datagram socket, mostly useful for testing.
+"""
+
+import abc
+import json
+import logging
+import os
+import socket
+import threading
+
+import six
+from six.moves.urllib import parse
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+LOG = logging.getLogger('recheckwatchbot')
+
+MQTT_PORT = 1883
+
+
+def parse_message(payload):
+    """Return the (build_short_uuid, files) of a message, or None."""
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', 'replace')
+    try:
+        message = json.loads(payload)
+        uuid = message['build_short_uuid']
+    except (ValueError, TypeError, KeyError):
+        return None
+    files = message.get('files')
+    if files is not None and not isinstance(files, list):
+        files = None
+    return uuid, files
+
+
+@six.add_metaclass(abc.ABCMeta)
+class IndexedFeed(object):
+    """A feed of indexed builds.
+
+    Once subscribed, callback(build_short_uuid, files) is called for every
+    valid message, from the thread of the feed. Feeds implement start() and
+    stop() to start and stop receiving messages.
+    """
+
+    def __init__(self):
+        self.callback = None
+        self.received = 0
+
+    def subscribe(self, callback):
+        self.callback = callback
+        self.start()
+
+    def _message(self, payload):
+        parsed = parse_message(payload)
+        if parsed is None:
+            LOG.warning("Ignoring invalid readiness message %r" % payload)
+            return
+        self.received += 1
+        try:
+            self.callback(*parsed)
+        except Exception:
+            LOG.exception("Failed to handle readiness message %r" % payload)
+
+    @abc.abstractmethod
+    def start(self):
+        """Start receiving messages."""
+
+    @abc.abstractmethod
+    def stop(self):
+        """Stop receiving messages."""
+
+
+class SocketFeed(IndexedFeed):
+    """Messages sent as datagrams to a unix socket at `path`."""
+
+    def __init__(self, path):
+        super(SocketFeed, self).__init__()
+        self.path = path
+        self._sock = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        # wake up once in a while to notice we were stopped
+        self._sock.settimeout(1)
+        self._thread = threading.Thread(target=self._run,
+                                        name='readiness-feed')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                payload = self._sock.recv(65536)
+            except socket.timeout:
+                continue
+            except socket.error:
+                if not self._stopped.is_set():
+                    LOG.exception("Failed to read the readiness feed")
+                return
+            self._message(payload)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._sock is not None:
+            self._sock.close()
+            os.unlink(self.path)
+
+
+class MQTTFeed(IndexedFeed):
+    """Messages published on an MQTT topic, needs paho-mqtt."""
+
+    def __init__(self, host, port=MQTT_PORT, topic='logs/indexed'):
+        super(MQTTFeed, self).__init__()
+        if mqtt is None:
+            raise ImportError("The MQTT readiness feed needs paho-mqtt")
+        self.host = host
+        self.port = port
+        self.topic = topic
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        else:
+            self.client = mqtt.Client()
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # (re)subscribe on every connection, subscriptions don't survive
+        # reconnecting
+        client.subscribe(self.topic)
+
+    def _on_message(self, client, userdata, msg):
+        self._message(msg.payload)
+
+    def start(self):
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def from_url(url):
+    """Return the feed of a url, mqtt://host[:port]/topic or unix:///path."""
+    parsed = parse.urlparse(url)
+    if parsed.scheme == 'mqtt':
+        return MQTTFeed(parsed.hostname, port=parsed.port or MQTT_PORT,
+                        topic=parsed.path.lstrip('/'))
+    if parsed.scheme == 'unix':
+        return SocketFeed(parsed.path)
+    raise ValueError("Unknown readiness feed %s" % url)
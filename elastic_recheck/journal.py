@@ -0,0 +1,170 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Journal of the failure events the bot is working on.
+
+The bot records every failure event it accepts, and how far it got with
+it, in a small sqlite database. When the bot is restarted it picks the
+unfinished events up again, without redoing the stages they already went
+through.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# Stages of an event, in order.
+WAITING = 'waiting'
+READY = 'ready'
+CLASSIFIED = 'classified'
+COMMENTED = 'commented'
+# Events whose logs never showed up.
+TIMED_OUT = 'timed_out'
+# Events dropped by the bot because it was too far behind.
+SHED = 'shed'
+# Events the bot gave up on, because processing them failed or they were
+# rejected when resumed.
+FAILED = 'failed'
+
+STAGES = (WAITING, READY, CLASSIFIED, COMMENTED, TIMED_OUT, SHED, FAILED)
+FINISHED = (COMMENTED, TIMED_OUT, SHED, FAILED)
+
+LOG = logging.getLogger('recheckwatchbot')
+
+
+def _marks(values):
+    return ', '.join('?' * len(values))
+
+
+class EventJournal(object):
+    """A sqlite journal of failure events and their stage.
+
+    Finished events are kept for `retention` seconds and then removed by
+    compact(), which start_compaction() runs every `interval` seconds in a
+    background thread.
+    """
+
+    def __init__(self, path, retention=24 * 3600):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._compactor = None
+        self._stopped = threading.Event()
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'key TEXT PRIMARY KEY, event TEXT, stage TEXT, bugs TEXT, '
+                'created REAL, updated REAL)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS state ('
+                'name TEXT PRIMARY KEY, value REAL)')
+
+    def add(self, key, event):
+        """Record a new gerrit event, unless it is already known."""
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, json.dumps(event), WAITING, None, now, now))
+                if 'eventCreatedOn' in event:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO state VALUES ('last_seen', "
+                        "MAX(?, COALESCE((SELECT value FROM state "
+                        "WHERE name = 'last_seen'), 0)))",
+                        (event['eventCreatedOn'],))
+
+    def last_seen(self):
+        """Return when the most recent event recorded was created, or None.
+
+        This is where the bot has to catch up from after it was down.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE name = 'last_seen'").fetchone()
+        return row[0] if row else None
+
+    def update(self, key, stage, bugs=None):
+        """Move an event to a new stage.
+
+        `bugs` is a dict of build_short_uuid to the list of bugs found for
+        that job, it is kept from the classified stage on.
+        """
+        if stage not in STAGES:
+            raise ValueError("Unknown stage %s" % stage)
+        with self._lock:
+            with self._db:
+                if bugs is None:
+                    self._db.execute(
+                        'UPDATE events SET stage = ?, updated = ? '
+                        'WHERE key = ?', (stage, time.time(), key))
+                else:
+                    self._db.execute(
+                        'UPDATE events SET stage = ?, bugs = ?, updated = ? '
+                        'WHERE key = ?',
+                        (stage, json.dumps(bugs), time.time(), key))
+
+    def stage(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT stage FROM events WHERE key = ?',
+                                   (key,)).fetchone()
+        return row[0] if row else None
+
+    def pending(self):
+        """Return the unfinished events, oldest first.
+
+        Returns a list of (key, gerrit event, stage, bugs) tuples.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, event, stage, bugs FROM events '
+                'WHERE stage NOT IN (%s) ORDER BY created' % _marks(FINISHED),
+                FINISHED).fetchall()
+        return [(key, json.loads(event), stage,
+                 json.loads(bugs) if bugs else None)
+                for key, event, stage, bugs in rows]
+
+    def compact(self):
+        """Remove the events that were finished more than retention ago."""
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    'DELETE FROM events WHERE stage IN (%s) '
+                    'AND updated < ?' % _marks(FINISHED),
+                    FINISHED + (time.time() - self.retention,))
+        LOG.debug("Removed %d finished events from the journal" %
+                  cursor.rowcount)
+        return cursor.rowcount
+
+    def start_compaction(self, interval=3600):
+        """Compact the journal every `interval` seconds in the background."""
+        def compact():
+            while not self._stopped.wait(interval):
+                try:
+                    self.compact()
+                except Exception:
+                    LOG.exception("Failed to compact the journal")
+
+        self._compactor = threading.Thread(target=compact,
+                                           name='journal-compaction')
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            self._db.close()
@@ -18,22 +18,94 @@ A set of utility methods to load queries for elastic recheck.
 """
 
 import glob
+import hashlib
 import os.path
+import threading
+
 import yaml
 
 
+def _parse(fname, data):
+    bugnum = os.path.basename(fname).rstrip('.yaml')
+    query = yaml.safe_load(data)
+    query['bug'] = bugnum
+    # By default we filter out non-voting jobs, but in certain cases we
+    # want to show failures for non-voting jobs in the graph while we
+    # stabilize a job, so check for a special 'allow-nonvoting' key.
+    if not query.get('allow-nonvoting', False):
+        query['query'] = "%s AND voting:1" % query['query'].rstrip()
+    return query
+
+
+def fingerprint(query):
+    """Return a fingerprint of everything that decides if a query matches.
+
+    Whitespace in the query string is normalized, so reformatting a query
+    file doesn't change its fingerprint.
+    """
+    data = ' '.join(query['query'].split())
+    if query.get('test_ids'):
+        data += '\n' + '\n'.join(sorted(query['test_ids']))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
 def load(directory='queries'):
     """Load queries from a set of yaml files in a directory."""
     bugs = glob.glob("%s/*.yaml" % directory)
     data = []
     for fname in bugs:
-        bugnum = os.path.basename(fname).rstrip('.yaml')
-        query = yaml.safe_load(open(fname).read())
-        query['bug'] = bugnum
-        # By default we filter out non-voting jobs, but in certain cases we
-        # want to show failures for non-voting jobs in the graph while we
-        # stabilize a job, so check for a special 'allow-nonvoting' key.
-        if not query.get('allow-nonvoting', False):
-            query['query'] = "%s AND voting:1" % query['query'].rstrip()
-        data.append(query)
+        data.append(_parse(fname, open(fname).read()))
     return data
+
+
+class QueryRegistry(object):
+    """The queries of a directory, kept up to date incrementally.
+
+    Long running users, like the bot, want to pick up query changes without
+    re-parsing every yaml file each time they look at the queries. refresh()
+    only re-parses files whose mtime or size changed (and whose content
+    actually differs), drops queries whose file was deleted, and then swaps
+    in the new list of queries in one go.
+    """
+
+    def __init__(self, directory='queries'):
+        self.directory = directory
+        # file name -> ((mtime, size), sha1 of the content, parsed query)
+        self._files = {}
+        self._queries = []
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Pick up changes in the directory and return the queries."""
+        with self._lock:
+            files = {}
+            changed = False
+            for fname in glob.glob("%s/*.yaml" % self.directory):
+                try:
+                    st = os.stat(fname)
+                    stat_key = (st.st_mtime, st.st_size)
+                    old = self._files.get(fname)
+                    if old and old[0] == stat_key:
+                        files[fname] = old
+                        continue
+                    with open(fname, 'rb') as f:
+                        data = f.read()
+                except (IOError, OSError):
+                    # deleted while we were looking at it
+                    continue
+                digest = hashlib.sha1(data).hexdigest()
+                if old and old[1] == digest:
+                    files[fname] = (stat_key, digest, old[2])
+                    continue
+                files[fname] = (stat_key, digest,
+                                _parse(fname, data.decode('utf-8')))
+                changed = True
+            if changed or set(files) != set(self._files):
+                self._queries = [files[fname][2] for fname in sorted(files)]
+            self._files = files
+        return self.queries
+
+    @property
+    def queries(self):
+        # hand out copies, callers like the graph command modify them
+        return [dict(query) for query in self._queries]
@@ -0,0 +1,412 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Local evaluation of elastic recheck queries.
+
+The queries in the queries directory use a small subset of the Lucene
+query_string syntax: quoted phrases and plain terms on named fields,
+combined with AND, OR, NOT and parentheses. This module compiles that
+subset into python matchers, so a query can be evaluated against log
+documents that have already been fetched from elastic search, instead of
+sending one search per query.
+
+The matchers approximate the logstash mapping. The message field is
+analyzed, so a phrase matches if its words show up next to each other in
+the message, ignoring case. Words are split the way the standard analyzer
+of elastic search splits them, "foo.bar" or "don't" are a single word but
+"foo-bar" is two. All other fields are matched exactly, with * and ?
+wildcards allowed in unquoted lower case terms.
+
+Anything outside of that subset raises UnsupportedQuery, and the caller is
+expected to fall back to running the query in elastic search.
+"""
+
+import fnmatch
+import re
+
+import six
+
+ANALYZED_FIELDS = ('message',)
+
+# The tags the log indexers give to the lines of a file, for the tags we
+# know the files of. Queries pinned to any other tag are never skipped.
+TAG_FILES = {
+    'console': ('console.html', 'job-output.txt'),
+    'console.html': ('console.html',),
+    'job-output.txt': ('job-output.txt',),
+    'syslog.txt': ('syslog.txt',),
+    'grenade.sh.txt': ('grenade.sh.txt',),
+    'screen-c-api.txt': ('screen-c-api.txt',),
+    'screen-c-vol.txt': ('screen-c-vol.txt',),
+    'screen-g-api.txt': ('screen-g-api.txt',),
+    'screen-n-api.txt': ('screen-n-api.txt',),
+    'screen-n-cpu.txt': ('screen-n-cpu.txt',),
+    'screen-n-net.txt': ('screen-n-net.txt',),
+    'screen-n-sch.txt': ('screen-n-sch.txt',),
+    'screen-q-svc.txt': ('screen-q-svc.txt',),
+}
+
+_TOKEN_RE = re.compile(r'\s*(?:'
+                       r'(?P<lparen>\()|'
+                       r'(?P<rparen>\))|'
+                       r'(?P<phrase>"(?:[^"\\]|\\.)*")|'
+                       r'(?P<word>(?:[^\s()"\\:]|\\.)+)(?P<colon>:)?'
+                       r')')
+# The words of the standard analyzer (unicode text segmentation): runs of
+# letters, digits and underscores, that go on across a . : or ' between
+# two letters, and a . , ; or ' between two digits.
+_WORD_RE = re.compile(r"\w+(?:(?:(?<=[^\W\d_])[.:'](?=[^\W\d_])|"
+                      r"(?<=\d)[.,;'](?=\d))\w+)*", re.UNICODE)
+# Analyzed query values have to be printable ascii, the segmentation of
+# anything else, like other scripts, isn't checked against elastic search.
+_SAFE_TEXT_RE = re.compile(r'^[\s\x21-\x7e]*$')
+_ESCAPE_RE = re.compile(r'\\(.)')
+
+
+class UnsupportedQuery(Exception):
+    """The query uses syntax that can't be evaluated locally."""
+
+
+def _unescape(value):
+    return _ESCAPE_RE.sub(r'\1', value)
+
+
+def _words(text):
+    return _WORD_RE.findall(text.lower())
+
+
+def _tokenize(raw_query):
+    tokens = []
+    pos = 0
+    raw_query = raw_query.strip()
+    while pos < len(raw_query):
+        m = _TOKEN_RE.match(raw_query, pos)
+        if not m or m.end() == pos:
+            raise UnsupportedQuery("Can't parse %r at position %d" %
+                                   (raw_query, pos))
+        pos = m.end()
+        if m.group('lparen'):
+            tokens.append(('(', None))
+        elif m.group('rparen'):
+            tokens.append((')', None))
+        elif m.group('phrase'):
+            tokens.append(('phrase', _unescape(m.group('phrase')[1:-1])))
+        elif m.group('colon'):
+            tokens.append(('field', m.group('word')))
+        elif m.group('word') in ('AND', 'OR', 'NOT'):
+            tokens.append((m.group('word'), None))
+        else:
+            tokens.append(('term', m.group('word')))
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser building a tree of matchers."""
+
+    def __init__(self, raw_query):
+        self.raw_query = raw_query
+        self.tokens = _tokenize(raw_query)
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise UnsupportedQuery("Empty query")
+        node = self._or()
+        if self._peek() is not None:
+            raise UnsupportedQuery("Unexpected %r in %r" %
+                                   (self._peek(), self.raw_query))
+        return node
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._peek() == 'OR':
+            self._next()
+            nodes.append(self._and())
+        if len(nodes) == 1:
+            return nodes[0]
+        return Or(nodes)
+
+    def _and(self):
+        nodes = [self._not()]
+        while self._peek() == 'AND':
+            self._next()
+            nodes.append(self._not())
+        if self._peek() not in (None, 'OR', ')'):
+            # terms next to each other without an operator use the
+            # default_operator of the query, don't guess what that is.
+            raise UnsupportedQuery("Implicit operator in %r" %
+                                   self.raw_query)
+        if len(nodes) == 1:
+            return nodes[0]
+        return And(nodes)
+
+    def _not(self):
+        if self._peek() == 'NOT':
+            self._next()
+            return Not(self._not())
+        return self._primary()
+
+    def _primary(self):
+        kind = self._peek()
+        if kind == '(':
+            self._next()
+            node = self._or()
+            if self._peek() != ')':
+                raise UnsupportedQuery("Unbalanced parentheses in %r" %
+                                       self.raw_query)
+            self._next()
+            return node
+        if kind == 'field':
+            field = self._next()[1]
+            if self._peek() not in ('phrase', 'term'):
+                raise UnsupportedQuery("Unsupported value for %s in %r" %
+                                       (field, self.raw_query))
+            value_kind, value = self._next()
+            return Field(field, value, quoted=(value_kind == 'phrase'))
+        raise UnsupportedQuery("Unsupported token %r in %r" %
+                               (kind, self.raw_query))
+
+
+class And(object):
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def __call__(self, doc):
+        return all(node(doc) for node in self.nodes)
+
+
+class Or(object):
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def __call__(self, doc):
+        return any(node(doc) for node in self.nodes)
+
+
+class Not(object):
+    def __init__(self, node):
+        self.node = node
+
+    def __call__(self, doc):
+        return not self.node(doc)
+
+
+class Field(object):
+    """Match a single field:value clause against a document."""
+
+    def __init__(self, field, value, quoted=False):
+        self.field = field
+        self.value = value
+        self.quoted = quoted
+        self.wildcard = not quoted and ('*' in value or '?' in value)
+        if field in ANALYZED_FIELDS:
+            if self.wildcard:
+                raise UnsupportedQuery(
+                    "Wildcards are not supported on %s" % field)
+            if not _SAFE_TEXT_RE.match(value):
+                raise UnsupportedQuery(
+                    "Can't split %r into words like elastic search" % value)
+            words = _words(value)
+            if not words:
+                raise UnsupportedQuery("No words to match in %r" % value)
+            if not quoted and len(words) > 1:
+                # elastic search doesn't make a phrase of these
+                raise UnsupportedQuery(
+                    "Unquoted term %r of more than one word" % value)
+            # surround with spaces so we only match whole words
+            self.words = ' %s ' % ' '.join(words)
+        elif not quoted:
+            if value.startswith(('[', '{')):
+                raise UnsupportedQuery("Ranges are not supported")
+            if self.wildcard and value != value.lower():
+                # query_string lower cases wildcard terms, but not the
+                # values they are matched against
+                raise UnsupportedQuery(
+                    "Upper case wildcard term %r" % value)
+            self.value = _unescape(value)
+
+    def _match(self, value):
+        if self.field in ANALYZED_FIELDS:
+            return self.words in ' %s ' % ' '.join(_words(value))
+        if self.wildcard:
+            return fnmatch.fnmatchcase(value, self.value)
+        return value == self.value
+
+    def __call__(self, doc):
+        for value in field_values(doc, self.field):
+            if value is None:
+                continue
+            if not isinstance(value, six.string_types):
+                value = six.text_type(value)
+            if self._match(value):
+                return True
+        return False
+
+
+def field_values(doc, field):
+    """Return the list of values of a field in a logstash document.
+
+    This handles both new style documents, with a flat _source, and old
+    style documents that use @attr and @fields[attr], the same way
+    results.Hit does.
+    """
+    source = doc.get('_source', doc)
+    if field in source:
+        value = source[field]
+    elif '@%s' % field in source:
+        value = source['@%s' % field]
+    elif field in source.get('@fields', {}):
+        value = source['@fields'][field]
+    else:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def compile_query(raw_query):
+    """Compile a query_string into a python matcher.
+
+    The returned callable takes a single elastic search document (a hit,
+    or just its _source) and returns True if the query matches it.
+
+    Raises UnsupportedQuery if the query uses syntax outside of the
+    supported subset.
+    """
+    return _Parser(raw_query).parse()
+
+
+def query_fields(raw_query):
+    """Return the set of fields referenced by a query."""
+    return set(token[1] for token in _tokenize(raw_query)
+               if token[0] == 'field')
+
+
+def _constraints(node):
+    """Return the field clauses a document has to match for node to match.
+
+    The result maps field names to lists of Field nodes, a document can
+    only match if, for every field, it matches one of the listed clauses.
+    This is a necessary condition, not a sufficient one.
+    """
+    if isinstance(node, Field):
+        return {node.field: [node]}
+    if isinstance(node, And):
+        found = {}
+        for child in node.nodes:
+            for field, clauses in _constraints(child).items():
+                # any one of the AND-ed clauses is a valid constraint, keep
+                # the first one we find.
+                found.setdefault(field, clauses)
+        return found
+    if isinstance(node, Or):
+        children = [_constraints(child) for child in node.nodes]
+        found = {}
+        for field in children[0]:
+            if all(field in child for child in children):
+                found[field] = [clause for child in children
+                                for clause in child[field]]
+        return found
+    # nothing can be said about what NOT matches
+    return {}
+
+
+class QueryIndex(object):
+    """Index of queries by the job attributes they are pinned to.
+
+    A lot of queries can only match log lines of some jobs, or some files,
+    like tags:"screen-n-cpu.txt" or build_name:"tempest-slow". This indexes
+    the queries by those fields so the queries that can't possibly match a
+    job can be skipped without asking elastic search.
+
+    Queries that can't be compiled, or whose constraints can't be
+    indexed, are always candidates.
+    """
+
+    FIELDS = ('build_name', 'build_queue', 'filename', 'tags')
+
+    def __init__(self, queries):
+        # field -> value -> set of bugs, for exact values
+        self._exact = dict((field, {}) for field in self.FIELDS)
+        # field -> list of (bug, Field) for wildcard values
+        self._wildcard = dict((field, []) for field in self.FIELDS)
+        # field -> set of bugs constrained on that field
+        self._constrained = dict((field, set()) for field in self.FIELDS)
+        self.bugs = set()
+        for query in queries:
+            self._add(query['bug'], query['query'])
+
+    def _add(self, bug, raw_query):
+        self.bugs.add(bug)
+        try:
+            constraints = _constraints(compile_query(raw_query))
+        except UnsupportedQuery:
+            return
+        for field in self.FIELDS:
+            clauses = constraints.get(field)
+            if not clauses:
+                continue
+            if field == 'tags' and not all(c.value in TAG_FILES
+                                           for c in clauses):
+                # we can't tell from the files of a job if it has these
+                continue
+            self._constrained[field].add(bug)
+            for clause in clauses:
+                if clause.wildcard:
+                    self._wildcard[field].append((bug, clause))
+                else:
+                    self._exact[field].setdefault(
+                        clause.value, set()).add(bug)
+
+    def candidates(self, **values):
+        """Return the set of bugs whose queries could match a job.
+
+        Takes a list of values for any of the indexed fields, for example
+        build_name=['tempest-full'] or filename=['job-output.txt', ...].
+        Fields that aren't passed, or are None, don't restrict anything.
+        """
+        bugs = set(self.bugs)
+        for field in self.FIELDS:
+            if values.get(field) is None:
+                continue
+            allowed = self.bugs - self._constrained[field]
+            for value in values[field]:
+                allowed |= self._exact[field].get(value, set())
+            for bug, clause in self._wildcard[field]:
+                if any(clause._match(value) for value in values[field]):
+                    allowed.add(bug)
+            bugs &= allowed
+        return bugs
+
+
+def file_tags(files):
+    """Return the tags of TAG_FILES the lines of a list of files have."""
+    basenames = set()
+    for fname in files:
+        basename = fname.split('/')[-1]
+        if basename.endswith('.gz'):
+            basename = basename[:-len('.gz')]
+        basenames.add(basename)
+    return set(tag for tag, names in TAG_FILES.items()
+               if basenames.intersection(names))
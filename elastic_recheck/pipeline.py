@@ -0,0 +1,208 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Stages of worker threads joined by bounded queues.
+
+The bot processes failure events in stages (readiness, classification,
+notification). Each stage has its own queue and pool of workers, so a slow
+event only holds up one worker of one stage. Queues are bounded, when a
+stage falls behind putting more work in its queue blocks, which pushes
+back on the stages feeding it.
+"""
+
+import collections
+import itertools
+import logging
+import math
+import threading
+import time
+
+from six.moves import queue
+
+LOG = logging.getLogger('recheckwatchbot')
+
+_STOP = object()
+
+# What a shed function can do with an item.
+DROP = 'drop'
+DEFER = 'defer'
+
+# Queue tiers, deferred items go after all the others.
+_NORMAL = 0
+_DEFERRED = 1
+_LAST = 2
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values, using the nearest rank."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Stage(object):
+    """A pool of workers running `func` on the items of a bounded queue.
+
+    Whatever `func` returns, other than None, is put in the queue of
+    `next_stage`. Exceptions are logged and counted, and the item is
+    dropped, after calling `on_error` with it if there is one.
+
+    Items are worked on in the order they are queued, unless there is a
+    `priority` function, then the items with the lowest priority(item) go
+    first. A `shed` function is called with every item queued, and the
+    number of items already queued, and can return DROP to throw the item
+    away, or DEFER to only work on it once nothing else is queued.
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=100, next_stage=None,
+                 priority=None, shed=None, on_error=None):
+        self.name = name
+        self.func = func
+        self.on_error = on_error
+        self.workers = workers
+        self.next_stage = next_stage
+        self.priority = priority
+        self.shed = shed
+        self.queue = queue.PriorityQueue(maxsize)
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.deferred = 0
+        # the latencies of the most recent items, in seconds
+        self.latencies = collections.deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._threads = []
+        # keeps the queue order stable for items of the same priority
+        self._counter = itertools.count()
+
+    def put(self, item, timeout=None):
+        """Queue an item, blocking while the queue is full."""
+        tier = _NORMAL
+        if self.shed is not None:
+            action = self.shed(item, self.queue.qsize())
+            if action == DROP:
+                with self._lock:
+                    self.dropped += 1
+                return
+            if action == DEFER:
+                with self._lock:
+                    self.deferred += 1
+                tier = _DEFERRED
+        key = self.priority(item) if self.priority is not None else 0
+        self.queue.put((tier, key, next(self._counter), item),
+                       timeout=timeout)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop the workers once they are done with the queued items."""
+        for thread in self._threads:
+            self.queue.put((_LAST, 0, next(self._counter), _STOP))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            item = self.queue.get()[3]
+            if item is _STOP:
+                return
+            start = time.time()
+            try:
+                result = self.func(item)
+            except Exception:
+                LOG.exception("Failed to process %s in the %s stage" %
+                              (item, self.name))
+                with self._lock:
+                    self.errors += 1
+                self._error(item)
+                continue
+            finally:
+                with self._lock:
+                    self.latencies.append(time.time() - start)
+            with self._lock:
+                self.processed += 1
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(result)
+
+    def _error(self, item):
+        if self.on_error is None:
+            return
+        try:
+            self.on_error(item)
+        except Exception:
+            LOG.exception("Failed to handle the failure of %s in the %s "
+                          "stage" % (item, self.name))
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self.latencies)
+            processed = self.processed
+            errors = self.errors
+            dropped = self.dropped
+            deferred = self.deferred
+        return {
+            'depth': self.queue.qsize(),
+            'workers': self.workers,
+            'processed': processed,
+            'errors': errors,
+            'dropped': dropped,
+            'deferred': deferred,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+        }
+
+
+class Pipeline(object):
+    """An ordered list of stages, feeding into each other."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def put(self, item, timeout=None):
+        self.stages[0].put(item, timeout=timeout)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        """Return the queue depth, counters and latencies of every stage."""
+        return collections.OrderedDict(
+            (stage.name, stage.stats()) for stage in self.stages)
+
+    def log_stats(self):
+        for name, stats in self.stats().items():
+            LOG.info("Stage %s: %d queued, %d workers, %d processed, "
+                     "%d errors, %d dropped, %d deferred, latency p50 %.2fs "
+                     "p90 %.2fs p99 %.2fs" %
+                     (name, stats['depth'], stats['workers'],
+                      stats['processed'], stats['errors'], stats['dropped'],
+                      stats['deferred'], stats['p50'], stats['p90'],
+                      stats['p99']))
@@ -21,6 +21,19 @@ by elastic recheck to talk with elastic search.
 import json
 from six.moves.urllib.parse import quote as urlquote
 
+# The lines that show up at the end of the console log of a job.
+# TODO(dmsimard): Revisit this query once Zuul v2 is no longer supported
+# Let's value legibility over pep8 line width here...
+CONSOLE_DONE = (
+    '(filename:"job-output.txt" AND message:"POST-RUN END" AND message:"project-config/playbooks/base/post-ssh.yaml")'  # flake8: noqa
+    ' OR '
+    '(filename:"console.html" AND (message:"[Zuul] Job complete" OR message:"[SCP] Copying console log" OR message:"Grabbing consoleLog"))'  # flake8: noqa
+)
+
+# The number of terms of the facets of jobs_ready, a facet with more terms
+# only has the most frequent ones.
+JOBS_READY_FACET_SIZE = 200
+
 
 def generic(raw_query, facet=None):
     """Base query builder
@@ -75,12 +88,8 @@ def result_ready(change, patchset, name, short_uuid):
     This is looking for a particular FAILURE line in the console log, which
     lets us know that we've got results waiting that we need to process.
     """
-    # TODO(dmsimard): Revisit this query once Zuul v2 is no longer supported
-    # Let's value legibility over pep8 line width here...
     query = (
-        '((filename:"job-output.txt" AND message:"POST-RUN END" AND message:"project-config/playbooks/base/post-ssh.yaml")'  # flake8: noqa
-        ' OR '
-        '(filename:"console.html" AND (message:"[Zuul] Job complete" OR message:"[SCP] Copying console log" OR message:"Grabbing consoleLog")))'  # flake8: noqa
+        '(' + CONSOLE_DONE + ')'
         ' AND build_status:"FAILURE"'
         ' AND build_change:"{change}"'
         ' AND build_patchset:"{patchset}"'
@@ -95,6 +104,38 @@ def result_ready(change, patchset, name, short_uuid):
     ))
 
 
+def jobs_ready(change, patchset, build_short_uuids):
+    """A facetted query to check if the logs of several jobs are ready.
+
+    This folds result_ready and files_ready for all the jobs of a change
+    into a single query. The "console" facet lists the build_short_uuids of
+    the jobs whose console log is complete, and there is a "files-<uuid>"
+    facet per job with the files it uploaded.
+    """
+    query = generic('build_status:"FAILURE" '
+                    'AND build_change:"%s" '
+                    'AND build_patchset:"%s" '
+                    'AND (%s)' %
+                    (change, patchset,
+                     ' OR '.join('build_short_uuid:"%s"' % uuid
+                                 for uuid in build_short_uuids)))
+    query['facets'] = {
+        "console": {
+            "terms": dict(field="build_short_uuid",
+                          size=JOBS_READY_FACET_SIZE),
+            "facet_filter": {
+                "query": {"query_string": {"query": CONSOLE_DONE}}
+                }
+            }
+        }
+    for uuid in build_short_uuids:
+        query['facets']['files-%s' % uuid] = {
+            "terms": dict(field="filename", size=JOBS_READY_FACET_SIZE),
+            "facet_filter": {"term": {"build_short_uuid": uuid}}
+            }
+    return query
+
+
 def files_ready(review, patch, name, build_short_uuid):
     """A facetted query to ensure all the required files exist.
 
@@ -125,6 +166,82 @@ def single_patch(query, review, patch, build_short_uuid):
                    (query, review, patch, build_short_uuid))
 
 
+def single_build(review, patch, build_short_uuid, fields=None):
+    """A query for all the log lines of a single build.
+
+    This is used to fetch the documents of a build once, so that the bug
+    queries can be evaluated against them locally. If `fields` is given
+    only those fields are returned for each document.
+    """
+    query = generic('build_change:"%s" '
+                    'AND build_patchset:"%s" '
+                    'AND build_short_uuid:%s' %
+                    (review, patch, build_short_uuid))
+    if fields:
+        # logstash documents can keep fields as attr, @attr or
+        # @fields.attr depending on their age, so ask for all of them.
+        source = set()
+        for field in fields:
+            source.update([field, '@%s' % field, '@fields.%s' % field])
+        query['_source'] = sorted(source)
+    return query
+
+
+def time_range(query, start, end):
+    """Restrict a query to the log lines between `start` and `end`.
+
+    The times are in seconds since the epoch. The range is a filter on
+    @timestamp rather than part of the query string, so elastic search
+    can cache it and skip the segments outside of the range without
+    scoring them.
+    """
+    query = dict(query)
+    query['query'] = {
+        "filtered": {
+            "query": query['query'],
+            "filter": {
+                "range": {
+                    "@timestamp": {
+                        "gte": int(start * 1000),
+                        "lte": int(end * 1000)
+                        }
+                    }
+                }
+            }
+        }
+    return query
+
+
+def aggregations(query, facets, res=3600):
+    """Turn a query into one that counts its hits per facet.
+
+    The hits are bucketed on each of the facets in turn, with a terms
+    aggregation, or a date_histogram of `res` seconds for "timestamp", the
+    way FacetSet buckets them. Elastic search then only returns the
+    number of hits of each bucket, not the hits.
+    """
+    aggs = None
+    for facet in reversed(facets):
+        if facet == "timestamp":
+            agg = {
+                "date_histogram": {
+                    "field": "@timestamp",
+                    "interval": "%ds" % res
+                    }
+                }
+        else:
+            # a size of 0 returns all the terms
+            agg = {"terms": {"field": facet, "size": 0}}
+        if aggs is not None:
+            agg["aggs"] = aggs
+        aggs = {facet: agg}
+    query = dict(query)
+    query.pop('facets', None)
+    query.pop('sort', None)
+    query['aggs'] = aggs
+    return query
+
+
 def most_recent_event():
     return generic(
         '(filename:"console.html" OR filename:"job-output.txt") '
@@ -14,38 +14,252 @@
 
 """Elastic search wrapper to make handling results easier."""
 
+import array
+import bisect
 import calendar
-import copy
+import collections
+import contextlib
 import datetime
+import itertools
+import json
+import logging
+import operator
 import pprint
+import threading
+import time
 
 import dateutil.parser as dp
 import pyelasticsearch
 import pytz
+import requests
+from requests import adapters
+
+import elastic_recheck.config as er_conf
+import elastic_recheck.query_builder as qb
 
 
 pp = pprint.PrettyPrinter()
 
+LOG = logging.getLogger('recheckwatchbot')
+
+# how long elastic search keeps a scroll between two pages
+SCROLL_KEEPALIVE = '1m'
+
+# (client class, url) -> the elasticsearch client shared by the process
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class _Session(requests.Session):
+    """A requests session whose timeout can be overridden per thread."""
+
+    def __init__(self):
+        super(_Session, self).__init__()
+        self.local = threading.local()
+
+    def request(self, method, url, **kwargs):
+        timeout = getattr(self.local, 'timeout', None)
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return super(_Session, self).request(method, url, **kwargs)
+
+
+def get_client(url, pool_size=er_conf.ES_POOL_SIZE,
+               timeout=er_conf.ES_TIMEOUT):
+    """Return the elasticsearch client of `url`, shared by the process.
+
+    The client keeps up to `pool_size` keep-alive connections to every
+    server, and asks for gzip compressed responses. The pool size and
+    timeout of the first call for a url are the ones used.
+    """
+    cls = pyelasticsearch.ElasticSearch
+    with _clients_lock:
+        client = _clients.get((cls, url))
+        if client is None:
+            client = cls(url)
+            client.timeout = timeout
+            if isinstance(getattr(client, 'session', None),
+                          requests.Session):
+                session = _Session()
+                adapter = adapters.HTTPAdapter(pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip'
+                client.session = session
+            _clients[(cls, url)] = client
+        return client
+
+
+def connections(client):
+    """Return how many connections a shared client opened, and requests."""
+    opened = 0
+    requested = 0
+    session = getattr(client, 'session', None)
+    # the same adapter is mounted for http and https
+    for adapter in set(getattr(session, 'adapters', {}).values()):
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            opened += pool.num_connections
+            requested += pool.num_requests
+    return opened, requested
+
+
+@contextlib.contextmanager
+def _timeout(client, timeout):
+    session = getattr(client, 'session', None)
+    if timeout is None or not isinstance(session, _Session):
+        yield
+        return
+    session.local.timeout = timeout
+    try:
+        yield
+    finally:
+        session.local.timeout = None
+
+
+class IndexCache(object):
+    """The indexes of the elasticsearch servers, listed in one request.
+
+    The listing of a server is kept for `ttl` seconds, and never past UTC
+    midnight, when the next daily index is created. An index missing from
+    the listing makes it refreshed if it is older than `negative_ttl`
+    seconds. Servers that can't list their indexes are asked about every
+    index, and the answers are kept the same way.
+    """
+
+    def __init__(self, ttl=er_conf.INDEX_CACHE_TTL,
+                 negative_ttl=er_conf.INDEX_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # url -> (fetched, expires, set of index names or None)
+        self._listings = {}
+        # (url, index) -> (exists, expires)
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    def _expires(self, now, exists):
+        if not exists:
+            return now + self.negative_ttl
+        midnight = (int(now) // 86400 + 1) * 86400
+        return min(now + self.ttl, midnight)
+
+    def _refresh(self, es, url, now):
+        try:
+            names = set(es.send_request('GET', ['_aliases']))
+        except pyelasticsearch.exceptions.ElasticHttpError:
+            names = None
+        listing = (now, self._expires(now, True), names)
+        with self._lock:
+            self._listings[url] = listing
+        return listing
+
+    def _probe(self, es, index):
+        try:
+            es.status(index=index)
+            return True
+        except pyelasticsearch.exceptions.ElasticHttpNotFoundError:
+            return False
+
+    def exists(self, es, url, index):
+        """Return whether `index` exists on the server `es` at `url`."""
+        now = time.time()
+        with self._lock:
+            listing = self._listings.get(url)
+        if listing is None or now >= listing[1]:
+            listing = self._refresh(es, url, now)
+        elif listing[2] is not None and index not in listing[2]:
+            # the index may have been created since the listing
+            if now >= listing[0] + self.negative_ttl:
+                listing = self._refresh(es, url, now)
+        if listing[2] is not None:
+            return index in listing[2]
+
+        with self._lock:
+            answer = self._answers.get((url, index))
+        if answer is not None and now < answer[1]:
+            return answer[0]
+        exists = self._probe(es, index)
+        with self._lock:
+            self._answers[(url, index)] = (exists,
+                                           self._expires(now, exists))
+        return exists
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self._answers.clear()
+
+
+# shared by all the SearchEngines of the process
+index_cache = IndexCache()
+
 
 class SearchEngine(object):
     """Wrapper for pyelasticsearch so that it returns result sets."""
-    def __init__(self, url, indexfmt='logstash-%Y.%m.%d'):
+    def __init__(self, url, indexfmt='logstash-%Y.%m.%d',
+                 client_factory=None, pool_size=er_conf.ES_POOL_SIZE,
+                 timeout=er_conf.ES_TIMEOUT, result_cache=None,
+                 settle=er_conf.RESULT_CACHE_SETTLE):
         self._url = url
         self._indexfmt = indexfmt
-        self.index_cache = {}
+        # called with the url to get an elasticsearch client, tools like
+        # the replay benchmark use this to record or fake the traffic.
+        self._client_factory = client_factory
+        self._pool_size = pool_size
+        self._timeout = timeout
+        # a cache.IndexResultCache for the indexes of past days
+        self._result_cache = result_cache
+        self._settle = settle
+
+    def _client(self):
+        if self._client_factory is not None:
+            return self._client_factory(self._url)
+        return get_client(self._url, pool_size=self._pool_size,
+                          timeout=self._timeout)
 
     def _is_valid_index(self, es, index):
-        if index in self.index_cache:
-            return self.index_cache[index]
+        return index_cache.exists(es, self._url, index)
+
+    def _route(self, es, start, end):
+        """Return the existing daily indexes with log lines from start to end.
 
+        `start` and `end` are UTC datetimes, the most recent index comes
+        first.
+        """
+        indexes = []
+        day = end
+        while day.date() >= start.date():
+            index = day.strftime(self._indexfmt)
+            if index not in indexes and self._is_valid_index(es, index):
+                indexes.append(index)
+            day -= datetime.timedelta(days=1)
+        return indexes
+
+    def _is_complete(self, index, now):
+        """Return whether an index is of a past day, so won't change."""
         try:
-            es.status(index=index)
-            self.index_cache[index] = True
-            return True
-        except pyelasticsearch.exceptions.ElasticHttpNotFoundError:
+            day = datetime.datetime.strptime(index, self._indexfmt)
+        except ValueError:
             return False
+        done = day + datetime.timedelta(days=1, seconds=self._settle)
+        return now >= done
+
+    def _indexes(self, es, recent=False, days=0, timerange=None):
+        """Return the list of existing indexes to search."""
+        now = datetime.datetime.utcnow()
+        if timerange is not None:
+            start = datetime.datetime.utcfromtimestamp(timerange[0])
+            # there is no index for the future yet
+            end = min(datetime.datetime.utcfromtimestamp(timerange[1]), now)
+            return self._route(es, start, end)
+        if recent:
+            start = now - datetime.timedelta(hours=1)
+        else:
+            start = now - datetime.timedelta(days=max(days, 1) - 1)
+        return self._route(es, start, now)
 
-    def search(self, query, size=1000, recent=False, days=0):
+    def search(self, query, size=1000, recent=False, days=0, timeout=None,
+               timerange=None):
         """Search an elasticsearch server.
 
         `query` parameter is the complicated query structure that
@@ -62,35 +276,209 @@ class SearchEngine(object):
 
         `days` search only the last number of days.
 
+        `timeout` overrides the timeout of the client for this search.
+
+        `timerange` is a (start, end) tuple of seconds since the epoch, like
+        the time a build ran. Only the daily indexes that can hold log lines
+        of that time are searched, and the query is filtered on the range.
+
         The returned result is a ResultSet query.
 
         """
-        es = pyelasticsearch.ElasticSearch(self._url)
+        es = self._client()
         args = {'size': size}
-        if recent or days:
-            # today's index
-            datefmt = self._indexfmt
-            now = datetime.datetime.utcnow()
-            indexes = []
-            latest_index = now.strftime(datefmt)
-            if self._is_valid_index(es, latest_index):
-                indexes.append(latest_index)
-            if recent:
-                lasthr = now - datetime.timedelta(hours=1)
-                lasthr_index = lasthr.strftime(datefmt)
-                if lasthr_index != latest_index:
-                    if self._is_valid_index(es, lasthr_index):
-                        indexes.append(lasthr.strftime(datefmt))
-            for day in range(1, days):
-                lastday = now - datetime.timedelta(days=day)
-                index_name = lastday.strftime(datefmt)
-                if self._is_valid_index(es, index_name):
-                    indexes.append(index_name)
-            args['index'] = indexes
-
-        results = es.search(query, **args)
+        if timerange is not None:
+            args['index'] = self._indexes(es, timerange=timerange)
+            if not args['index']:
+                return ResultSet()
+            query = qb.time_range(query, *timerange)
+        elif recent or days:
+            args['index'] = self._indexes(es, recent=recent, days=days)
+
+        with _timeout(es, timeout):
+            results = es.search(query, **args)
         return ResultSet(results)
 
+    def multi_search(self, queries, size=1000, recent=False, days=0,
+                     timeout=None, timerange=None):
+        """Run a list of queries against elasticsearch in a single request.
+
+        This uses the elasticsearch multi search API, so that evaluating a
+        large number of queries (like the whole set of bug queries against
+        a single build) only costs one round trip.
+
+        `size`, `recent`, `days`, `timeout` and `timerange` have the same
+        meaning as for search(), and apply to every query in the list.
+
+        The returned result is a list of ResultSets, in the same order as
+        `queries`. If elasticsearch failed to run one of the queries the
+        matching ResultSet will have an `error` attribute set.
+        """
+        if not queries:
+            return []
+        es = self._client()
+        header = {}
+        if timerange is not None:
+            indexes = self._indexes(es, timerange=timerange)
+            if not indexes:
+                return [ResultSet() for query in queries]
+            header['index'] = ','.join(indexes)
+            queries = [qb.time_range(query, *timerange) for query in queries]
+        elif recent or days:
+            indexes = self._indexes(es, recent=recent, days=days)
+            if indexes:
+                header['index'] = ','.join(indexes)
+        lines = []
+        for query in queries:
+            body = dict(query, size=size)
+            lines.append(json.dumps(header))
+            lines.append(json.dumps(body))
+        # the multi search body is newline delimited json, and has to end
+        # with a newline.
+        body = '\n'.join(lines) + '\n'
+        with _timeout(es, timeout):
+            response = es.send_request('GET', ['_msearch'], body,
+                                       encode_body=False)
+        return [ResultSet(results) for results in response['responses']]
+
+    def aggregate(self, query, facets, res=3600, recent=False, days=0,
+                  timeout=None, timerange=None):
+        """Count the hits of a search per facet, without fetching them.
+
+        Returns the nested FacetSet that FacetSet.detect_facets() would
+        build for the hits, with the number of hits as leaves instead of
+        the hits. The counting is done by elastic search with nested
+        aggregations, or on the client, with the hits of an iter_search(),
+        if the server doesn't know about aggregations.
+
+        `recent`, `days`, `timeout` and `timerange` have the same meaning
+        as for search(). With a result cache, a search over `days` is
+        split per index, and the counts of the indexes of past days come
+        from the cache once they were counted.
+        """
+        per_index = days and not recent and timerange is None
+        try:
+            if per_index and self._result_cache is not None:
+                return self._aggregate_days(query, facets, res, days,
+                                            timeout)
+            results = self.search(qb.aggregations(query, facets, res=res),
+                                  size=0, recent=recent, days=days,
+                                  timeout=timeout, timerange=timerange)
+        except pyelasticsearch.exceptions.ElasticHttpError as e:
+            if e.status_code != 400:
+                raise
+            LOG.warning("Counting the hits on the client, the server can't "
+                        "aggregate them: %s" % e)
+            hits = self.iter_search(query, recent=recent, days=days,
+                                    timeout=timeout, timerange=timerange)
+            counts = ColumnarResultSet(hits, columns=facets).counts(
+                facets, res=res)
+            return FacetSet.from_groups(counts)
+        if not results.aggregations:
+            return FacetSet()
+        return FacetSet.from_aggregations(results.aggregations, facets)
+
+    def _aggregate_days(self, query, facets, res, days, timeout):
+        """Aggregate per index, taking past days from the result cache."""
+        es = self._client()
+        query = qb.aggregations(query, facets, res=res)
+        fingerprint = self._result_cache.fingerprint(query)
+        now = datetime.datetime.utcnow()
+        counts = FacetSet()
+        missing = []
+        for index in self._indexes(es, days=days):
+            cached = None
+            if self._is_complete(index, now):
+                cached = self._result_cache.get(fingerprint, index)
+            if cached is None:
+                missing.append(index)
+            else:
+                counts.merge(FacetSet.from_aggregations(cached, facets))
+        if not missing:
+            return counts
+        # the other indexes are searched in a single request
+        lines = []
+        for index in missing:
+            lines.append(json.dumps({'index': index}))
+            lines.append(json.dumps(dict(query, size=0)))
+        with _timeout(es, timeout):
+            response = es.send_request('GET', ['_msearch'],
+                                       '\n'.join(lines) + '\n',
+                                       encode_body=False)
+        for index, results in zip(missing, response['responses']):
+            if 'error' in results:
+                # retry on its own, to get the error of the server
+                with _timeout(es, timeout):
+                    results = es.search(query, index=[index], size=0)
+            aggregations = results.get('aggregations')
+            if not aggregations:
+                continue
+            if self._is_complete(index, now):
+                self._result_cache.set(fingerprint, index, aggregations)
+            counts.merge(FacetSet.from_aggregations(aggregations, facets))
+        return counts
+
+    def iter_search(self, query, page_size=er_conf.SCROLL_PAGE_SIZE,
+                    limit=None, recent=False, days=0, timeout=None,
+                    timerange=None):
+        """Search an elasticsearch server, yielding every Hit.
+
+        The hits are fetched `page_size` at a time with a scroll, so only
+        one page is held in memory, however many hits there are. At most
+        `limit` hits are yielded, if there were more a warning is logged.
+
+        `recent`, `days`, `timeout` and `timerange` have the same meaning
+        as for search().
+        """
+        es = self._client()
+        args = {'size': page_size, 'es_scroll': SCROLL_KEEPALIVE}
+        if timerange is not None:
+            args['index'] = self._indexes(es, timerange=timerange)
+            if not args['index']:
+                return
+            query = qb.time_range(query, *timerange)
+        elif recent or days:
+            args['index'] = self._indexes(es, recent=recent, days=days)
+
+        with _timeout(es, timeout):
+            page = es.search(query, **args)
+        scroll_id = None
+        count = 0
+        try:
+            while True:
+                # the scroll id can change from one page to the next
+                scroll_id = page.get('_scroll_id', scroll_id)
+                hits = page['hits']['hits']
+                if not hits:
+                    return
+                for hit in hits:
+                    if limit is not None and count >= limit:
+                        break
+                    count += 1
+                    yield Hit(hit)
+                if limit is not None and count >= limit:
+                    if page['hits']['total'] > count:
+                        LOG.warning("Stopped after %d of the %d hits of %s" %
+                                    (count, page['hits']['total'],
+                                     json.dumps(query)))
+                    return
+                with _timeout(es, timeout):
+                    page = es.send_request(
+                        'GET', ['_search', 'scroll'], scroll_id,
+                        query_params={'scroll': SCROLL_KEEPALIVE},
+                        encode_body=False)
+        finally:
+            if scroll_id is not None:
+                self._clear_scroll(es, scroll_id)
+
+    def _clear_scroll(self, es, scroll_id):
+        # the scroll would time out anyway, this only frees it sooner
+        try:
+            es.send_request('DELETE', ['_search', 'scroll'], scroll_id,
+                            encode_body=False)
+        except Exception:
+            LOG.debug("Failed to clear scroll %s" % scroll_id, exc_info=True)
+
 
 class ResultSet(list):
     """An easy iterator object for handling elasticsearch results.
@@ -140,6 +528,22 @@ class ResultSet(list):
         if attr in self._results:
             return self._results[attr]
 
+    def facet(self, name):
+        """Return the terms of a named facet, or [] if it's missing."""
+        facets = self._results.get('facets', {})
+        return facets.get(name, {}).get('terms', [])
+
+    def facet_complete(self, name, size):
+        """Return whether a terms facet of `size` terms has all the terms.
+
+        A facet that got as many terms as it asked for, or that counts
+        hits in its "other" terms, may have left some out.
+        """
+        facet = self._results.get('facets', {}).get(name, {})
+        if facet.get('other'):
+            return False
+        return len(facet.get('terms', [])) < size
+
 
 class FacetSet(dict):
     """A dictionary like collection for creating faceted ResultSets.
@@ -152,8 +556,58 @@ class FacetSet(dict):
     of FaceSets with ResultSet as the leaves.
 
     Treat this basically like a dictionary (which it inherits from).
+
+    The hits are gone through once, so they can come from
+    SearchEngine.iter_search() without ever being all fetched at once.
+
+    Elastic search facets can't nest, but its aggregations can. When only
+    the counts are needed, SearchEngine.aggregate() returns the same
+    nesting of FacetSets, built by from_aggregations(), with the number of
+    hits as leaves, and the hits never leave the server.
     """
-    def _histogram(self, data, facet, res=3600):
+    @classmethod
+    def from_groups(cls, groups):
+        """Nest the groups of ColumnarResultSet.group_by() and the like.
+
+        `groups` maps tuples of the values of each facet to the leaves.
+        """
+        top = cls()
+        for key, leaf in groups.items():
+            node = top
+            for value in key[:-1]:
+                if value not in node:
+                    dict.__setitem__(node, value, cls())
+                node = node[value]
+            dict.__setitem__(node, key[-1], leaf)
+        return top
+
+    @classmethod
+    def from_aggregations(cls, aggregations, facets):
+        """Nest the buckets of the aggregations of qb.aggregations().
+
+        The leaves are the number of hits of each bucket.
+        """
+        top = cls()
+        for bucket in aggregations[facets[0]]['buckets']:
+            if len(facets) > 1:
+                leaf = cls.from_aggregations(bucket, facets[1:])
+            else:
+                leaf = bucket['doc_count']
+            dict.__setitem__(top, bucket['key'], leaf)
+        return top
+
+    def merge(self, other):
+        """Add the counts of another FacetSet of counts to this one."""
+        for key, value in other.items():
+            if key not in self:
+                dict.__setitem__(self, key, value)
+            elif isinstance(value, FacetSet):
+                self[key].merge(value)
+            else:
+                dict.__setitem__(self, key, self[key] + value)
+
+    @staticmethod
+    def _histogram(data, facet, res=3600):
         """A preprocessor for data should we want to bucket it."""
         # NOTE(mriedem): We sometimes hit a case where the @timestamp attribute
         # is too large and ES won't return it. At some point we should probably
@@ -172,25 +626,192 @@ class FacetSet(dict):
         else:
             return data
 
+    def add(self, hit, facets, res=3600):
+        """Add a single hit, under its value of each of the facets."""
+        node = self
+        for i, facet in enumerate(facets):
+            attr = self._histogram(hit[facet], facet, res=res)
+            if attr not in node:
+                if i == len(facets) - 1:
+                    dict.__setitem__(node, attr, ResultSet())
+                else:
+                    dict.__setitem__(node, attr, FacetSet())
+            node = node[attr]
+        node.append(hit)
+
     def detect_facets(self, results, facets, res=3600):
         if len(facets) > 0:
-            facet = facets.pop(0)
+            if isinstance(results, ColumnarResultSet):
+                self.update(results.facets(facets, res=res))
+                return
             for hit in results:
-                attr = self._histogram(hit[facet], facet)
-                if attr not in self:
-                    dict.setdefault(self, attr, ResultSet())
-                    self[attr].append(hit)
-                else:
-                    self[attr].append(hit)
-
-            # if we still have more facets to go, recurse down
-            if len(facets) > 0:
-                newkeys = {}
-                for key in self:
-                    fs = FacetSet()
-                    fs.detect_facets(self[key], copy.deepcopy(facets), res=res)
-                    newkeys[key] = fs
-                self.update(newkeys)
+                self.add(hit, facets, res=res)
+
+
+class Column(object):
+    """A dictionary encoded column of values.
+
+    Every distinct value is kept once, in `values`, and each row only holds
+    the number of its value in `codes`.
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = array.array('l')
+        self._index = {}
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class Row(object):
+    """A row of a ColumnarResultSet, its columns read like a Hit."""
+    __slots__ = ('_results', '_row')
+
+    def __init__(self, results, row):
+        self._results = results
+        self._row = row
+
+    def __getitem__(self, key):
+        return self.__getattr__(key)
+
+    def __getattr__(self, attr):
+        column = self._results.columns.get(attr)
+        if column is None:
+            raise AttributeError("%s isn't one of the columns" % attr)
+        return column[self._row]
+
+    def __repr__(self):
+        return pp.pformat(dict((name, column[self._row]) for name, column
+                               in self._results.columns.items()))
+
+
+class ColumnarResultSet(object):
+    """The hits of a search, as a few dictionary encoded columns.
+
+    Only the `columns` the facets and reports need are kept, instead of the
+    whole document of every hit, and a value shared by many hits, like a
+    build_uuid or build_status, is stored once. The hits are read once, so
+    they can come from SearchEngine.iter_search().
+
+    group_by() and counts() combine the integer codes of several columns
+    into one integer key per row and sort or count those, and facets() turns
+    that into the nested FacetSet that FacetSet.detect_facets() would build,
+    with Rows as the leaves.
+    """
+    COLUMNS = ('build_uuid', 'build_name', 'build_status', 'project',
+               'timestamp')
+
+    def __init__(self, hits=(), columns=COLUMNS):
+        self.columns = collections.OrderedDict(
+            (name, Column()) for name in columns)
+        self._len = 0
+        for hit in hits:
+            self.append(hit)
+
+    def append(self, hit):
+        for name, column in self.columns.items():
+            column.append(hit[name])
+        self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, row):
+        if not -self._len <= row < self._len:
+            raise IndexError(row)
+        return Row(self, row % self._len)
+
+    def __iter__(self):
+        for row in range(self._len):
+            yield Row(self, row)
+
+    def _keys(self, facet, res):
+        """Return the codes of the rows for a facet, and their values."""
+        column = self.columns[facet]
+        if facet != 'timestamp':
+            return column.codes, column.values
+        # bucket each distinct timestamp once, not once per row
+        values = []
+        index = {}
+        remap = []
+        for value in column.values:
+            bucket = FacetSet._histogram(value, facet, res=res)
+            if bucket not in index:
+                index[bucket] = len(values)
+                values.append(bucket)
+            remap.append(index[bucket])
+        return list(map(remap.__getitem__, column.codes)), values
+
+    def _encode(self, facets, res):
+        """Return one integer key per row for the values of the facets.
+
+        The codes of the facets are combined into a single mixed radix
+        number, so rows are compared, counted and sorted on plain integers,
+        and the work per row stays in map(), Counter and sorted().
+        """
+        keys = [self._keys(facet, res) for facet in facets]
+        composite = keys[0][0] if keys else [0] * self._len
+        for codes, values in keys[1:]:
+            radix = itertools.repeat(len(values))
+            composite = list(map(operator.add,
+                                 map(operator.mul, composite, radix), codes))
+
+        def decode(key):
+            codes = []
+            for _, values in reversed(keys[1:]):
+                key, code = divmod(key, len(values))
+                codes.append(code)
+            codes.append(key)
+            return tuple(values[code] for (_, values), code
+                         in zip(keys, reversed(codes)))
+        return composite, decode
+
+    def group_by(self, facets, res=3600):
+        """Group the rows by their values of the facets.
+
+        Returns an OrderedDict of the tuples of values to the array of the
+        numbers of their rows, in the order the tuples were first seen.
+        """
+        composite, decode = self._encode(facets, res)
+        # a stable sort of the row numbers on their keys leaves the rows of
+        # each key in one slice, in order, and its first row first
+        order = sorted(range(self._len), key=composite.__getitem__)
+        ordered = list(map(composite.__getitem__, order))
+        slices = []
+        for key in sorted(set(composite)):
+            start = bisect.bisect_left(ordered, key)
+            slices.append((order[start], key, start,
+                           bisect.bisect_right(ordered, key, start)))
+        slices.sort()
+        return collections.OrderedDict(
+            (decode(key), array.array('l', order[start:stop]))
+            for _, key, start, stop in slices)
+
+    def counts(self, facets, res=3600):
+        """Return the number of rows of each tuple of values of facets."""
+        composite, decode = self._encode(facets, res)
+        counts = collections.Counter(composite)
+        return collections.OrderedDict(
+            (decode(key), counts[key])
+            for key in collections.OrderedDict.fromkeys(composite))
+
+    def facets(self, facets, res=3600):
+        """Return the rows faceted like FacetSet.detect_facets() does."""
+        groups = collections.OrderedDict()
+        for key, rows in self.group_by(facets, res=res).items():
+            leaf = groups[key] = ResultSet()
+            leaf.extend(Row(self, row) for row in rows)
+        return FacetSet.from_groups(groups)
 
 
 class Hit(object):
@@ -0,0 +1,90 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+import fixtures
+import yaml
+
+from elastic_recheck.cmd import replay
+from elastic_recheck import loader
+import elastic_recheck.query_builder as qb
+from elastic_recheck import tests
+from elastic_recheck.tests import unit
+
+
+class TestReplay(tests.TestCase):
+
+    def setUp(self):
+        super(TestReplay, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        with open('elastic_recheck/tests/unit/gerrit/events.json') as f:
+            events = json.load(f)
+        recording = replay.Recording(self.path)
+        recording.events = events
+        # make the jobs of 64749,6 ready, and have one of them hit a bug
+        uuids = ['d3fd328', '5dd41fe']
+        facets = {'console': {'terms': [{'term': uuid, 'count': 1}
+                                        for uuid in uuids]}}
+        for uuid in uuids:
+            facets['files-%s' % uuid] = {'terms': [
+                {'term': 'job-output.txt', 'count': 10}]}
+        recording.add_response(
+            qb.jobs_ready(64749, 6, uuids),
+            dict(unit.load_empty(), facets=facets))
+        query = [x['query'] for x in
+                 loader.load('elastic_recheck/tests/unit/queries')
+                 if x['bug'] == '1229475'][0]
+        recording.add_response(
+            qb.single_patch(query, 64749, 6, 'd3fd328'),
+            unit.load_by_bug(1229475))
+        recording.save()
+        with open('recheckwatchbot.yaml') as f:
+            self.msgs = yaml.safe_load(f)['messages']
+
+    def test_replay(self):
+        recording = replay.Recording(self.path).load()
+        self.assertEqual(11, len(recording.events))
+        stats, stream, counts, elapsed = replay.benchmark(
+            recording, 'elastic_recheck/tests/unit/queries', self.msgs)
+        self.assertEqual(11, stream.gerrit.consumed)
+        # only 64749,6 was ready in elastic search
+        self.assertEqual(1, len(stream.gerrit.reviews))
+        self.assertIn('https://bugs.launchpad.net/bugs/1229475',
+                      stream.gerrit.reviews[0]['msg'])
+        self.assertEqual(2, len(stats.timings['classify']))
+        self.assertEqual(1, len(stats.timings['comment']))
+        self.assertTrue(counts['_msearch'] > 0)
+        self.assertTrue(counts['misses'] > 0)
+
+        report = stats.report(stream.gerrit.consumed, elapsed, counts)
+        self.assertIn('Replayed 11 gerrit events', report)
+        self.assertIn('_msearch=', report)
+
+    def test_recording_round_trip(self):
+        recording = replay.Recording(self.path).load()
+        recording.failing_tests['d3fd328'] = set(['test1'])
+        recording.save()
+        loaded = replay.Recording(self.path).load()
+        self.assertEqual({'d3fd328': ['test1']}, loaded.failing_tests)
+        self.assertEqual(list(recording.responses),
+                         list(loaded.responses))
+
+    def test_benchmark_prefilter(self):
+        recording = replay.Recording(self.path).load()
+        prefilter, parse, failures = replay.benchmark_prefilter(
+            recording.events, rounds=2)
+        self.assertEqual(4, failures)
+        self.assertTrue(prefilter > 0)
+        self.assertTrue(parse > 0)
@@ -49,8 +49,8 @@ class TestUncategorizedFails(testtools.TestCase):
                            log_url='http://logs.openstack.org/3/console.html'),
         ]
         classifier = mock.MagicMock()
-        query_mock = mock.Mock(return_value=results)
-        classifier.hits_by_query = query_mock
+        query_mock = mock.Mock(return_value=iter(results))
+        classifier.iter_hits_by_query = query_mock
         all_fails = fails.all_fails(classifier)
         # assert that we only have the single result
         self.assertThat(all_fails,
@@ -13,6 +13,7 @@
 #    under the License.
 
 from six.moves import configparser
+import time
 import unittest
 import yaml
 
@@ -22,6 +23,8 @@ import mock
 from elastic_recheck import bot
 import elastic_recheck.config as er_conf
 from elastic_recheck import elasticRecheck
+from elastic_recheck import journal
+from elastic_recheck import pipeline
 from elastic_recheck import tests
 import elastic_recheck.tests.unit.fake_gerrit as fg
 
@@ -145,3 +148,122 @@ class TestBotWithTestTools(tests.TestCase):
         data = {'messages': {'test': 'message'}}
         config = bot.MessageConfig(data)
         self.assertEqual(config['test'], data['messages']['test'])
+
+
+class TestBotStages(tests.TestCase):
+
+    def setUp(self):
+        super(TestBotStages, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'gerritlib.gerrit.Gerrit',
+            fg.Gerrit))
+        fake_config = configparser.ConfigParser(
+            {'server_password': None},
+            allow_no_value=True)
+        _set_fake_config(fake_config)
+        config = er_conf.Config(config_obj=fake_config)
+        with open('recheckwatchbot.yaml') as f:
+            data = yaml.safe_load(f)
+        with mock.patch('launchpadlib.launchpad.Launchpad'):
+            self.recheck_watch = bot.RecheckWatch(
+                None,
+                bot.ChannelConfig(data),
+                bot.MessageConfig(data),
+                config=config,
+                commenting=False)
+        with mock.patch.object(elasticRecheck.Stream, '_does_es_have_data',
+                               return_value=True):
+            self.stream = elasticRecheck.Stream("", "", "")
+            self.event = self.stream.get_failed_tempest()
+
+    def test_classify(self):
+        classifier = mock.Mock()
+        classifier.classify.return_value = ['123456']
+        self.assertIs(self.event, self.recheck_watch._classify(
+            classifier, self.stream, self.event))
+        self.assertEqual(2, classifier.classify.call_count)
+        self.assertEqual(['123456'], self.event.get_all_bugs())
+        self.assertEqual(journal.CLASSIFIED, self.event.stage)
+
+        # events resumed from the journal aren't classified again
+        classifier.reset_mock()
+        self.recheck_watch._classify(classifier, self.stream, self.event)
+        self.assertFalse(classifier.classify.called)
+
+    def test_notify(self):
+        with mock.patch.object(self.recheck_watch, '_read') as read:
+            with mock.patch.object(self.stream, 'leave_comment') as comment:
+                self.recheck_watch._notify(self.stream, self.event)
+        read.assert_called_once_with(self.event)
+        # no bugs, no comment
+        self.assertFalse(comment.called)
+        self.assertEqual(journal.COMMENTED, self.event.stage)
+
+    def test_ready_timed_out(self):
+        with mock.patch.object(
+                self.stream, 'check_ready',
+                side_effect=elasticRecheck.ResultTimedOut('too slow')):
+            with mock.patch.object(self.recheck_watch, '_read') as read:
+                self.assertIsNone(
+                    self.recheck_watch._ready(self.stream, self.event))
+        read.assert_called_once_with(msg='too slow')
+
+    def test_read_one_at_a_time(self):
+        # the irc connection and launchpad aren't thread safe
+        lock = self.recheck_watch._output_lock
+
+        def print_msg(channel, msg):
+            self.assertTrue(lock.locked())
+
+        with mock.patch.object(self.recheck_watch, 'print_msg',
+                               side_effect=print_msg) as print_mock:
+            self.recheck_watch._read(msg='too slow')
+        self.assertTrue(print_mock.called)
+        self.assertFalse(lock.locked())
+
+    def test_failed(self):
+        self.recheck_watch._failed(self.stream, self.event)
+        self.assertEqual(journal.FAILED, self.event.stage)
+
+    def test_ready(self):
+        with mock.patch.object(self.stream, 'check_ready',
+                               side_effect=[False, True]):
+            self.assertIsNone(
+                self.recheck_watch._ready(self.stream, self.event))
+            self.assertIs(self.event,
+                          self.recheck_watch._ready(self.stream, self.event))
+
+    def test_priority(self):
+        with mock.patch.object(elasticRecheck.Stream, '_does_es_have_data',
+                               return_value=True):
+            check = self.stream.get_failed_tempest()
+        self.assertEqual('gate', self.event.queue())
+        self.assertEqual('check', check.queue())
+        # gate first, even when it is more recent
+        check.created_on = self.event.created_on - 60
+        events = sorted([check, self.event], key=bot.RecheckWatch._priority)
+        self.assertEqual([self.event, check], events)
+
+    def test_shed(self):
+        config = self.recheck_watch.config
+        config.shed_backlog = 10
+        config.shed_age = 600
+        self.event.created_on = time.time() - 3600
+        shed = self.recheck_watch._shed
+        # nothing is shed without a policy
+        self.assertIsNone(shed(self.stream, self.event, 100))
+
+        config.shed_policy = 'defer'
+        self.assertEqual(pipeline.DEFER, shed(self.stream, self.event, 100))
+        self.assertIsNone(shed(self.stream, self.event, 5))
+        self.event.created_on = time.time()
+        self.assertIsNone(shed(self.stream, self.event, 100))
+        self.assertEqual(journal.READY, self.event.stage)
+
+        config.shed_policy = 'drop'
+        self.event.created_on = time.time() - 3600
+        self.assertEqual(pipeline.DROP, shed(self.stream, self.event, 100))
+        self.assertEqual(journal.SHED, self.event.stage)
+
+    def test_unknown_shed_policy(self):
+        self.assertRaises(ValueError, er_conf.Config, shed_policy='ignore')
@@ -0,0 +1,138 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import fixtures
+import mock
+
+from elastic_recheck import cache
+from elastic_recheck import tests
+
+
+class TestLRUCache(tests.TestCase):
+
+    def test_eviction(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(1, lru.get('a'))
+        lru.set('c', 3)
+        # b was the least recently used
+        self.assertNotIn('b', lru)
+        self.assertEqual(1, lru.get('a'))
+        self.assertEqual(3, lru.get('c'))
+        self.assertEqual(2, len(lru))
+
+    @mock.patch('time.time')
+    def test_ttl(self, time_mock):
+        time_mock.return_value = 1000
+        lru = cache.LRUCache(maxsize=2, ttl=10)
+        lru.set('a', 1)
+        time_mock.return_value = 1010
+        self.assertEqual(1, lru.get('a'))
+        time_mock.return_value = 1011
+        self.assertIsNone(lru.get('a'))
+        self.assertNotIn('a', lru)
+
+
+class TestClassificationCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestClassificationCache, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'cache.db')
+
+    def test_memory_only(self):
+        c = cache.ClassificationCache()
+        c.set('uuid', {'fp1': True, 'fp2': False})
+        self.assertEqual({'fp1': True, 'fp2': False},
+                         c.get('uuid', ['fp1', 'fp2', 'fp3']))
+        self.assertEqual({}, c.get('other', ['fp1']))
+
+    def test_disk(self):
+        c = cache.ClassificationCache(path=self.path)
+        c.set('uuid', {'fp1': True, 'fp2': False})
+        c = cache.ClassificationCache(path=self.path)
+        self.assertEqual({'fp1': True, 'fp2': False},
+                         c.get('uuid', ['fp1', 'fp2', 'fp3']))
+
+    @mock.patch('time.time')
+    def test_disk_ttl(self, time_mock):
+        time_mock.return_value = 1000
+        c = cache.ClassificationCache(ttl=10, path=self.path)
+        c.set('uuid', {'fp1': True})
+        time_mock.return_value = 1011
+        c = cache.ClassificationCache(ttl=10, path=self.path)
+        self.assertEqual({}, c.get('uuid', ['fp1']))
+
+    def test_disk_maxsize(self):
+        c = cache.ClassificationCache(maxsize=150, path=self.path)
+        for i in range(200):
+            c.set('uuid%d' % i, {'fp': True})
+        c = cache.ClassificationCache(maxsize=150, path=self.path)
+        # expiring runs every 100 writes
+        self.assertEqual({}, c.get('uuid0', ['fp']))
+        self.assertEqual({'fp': True}, c.get('uuid199', ['fp']))
+
+
+class TestIndexResultCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestIndexResultCache, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'results.db')
+
+    def test_disk(self):
+        c = cache.IndexResultCache(self.path)
+        fp = c.fingerprint({'query': {'query_string': {'query': 'foo'}}})
+        self.assertEqual(fp, c.fingerprint(
+            {'query': {'query_string': {'query': 'foo'}}}))
+        self.assertIsNone(c.get(fp, 'logstash-2014.06.11'))
+        c.set(fp, 'logstash-2014.06.11', {'buckets': [1, 2]})
+        c = cache.IndexResultCache(self.path)
+        self.assertEqual({'buckets': [1, 2]},
+                         c.get(fp, 'logstash-2014.06.11'))
+        self.assertIsNone(c.get(fp, 'logstash-2014.06.10'))
+        self.assertIsNone(c.get('other', 'logstash-2014.06.11'))
+        self.assertEqual((1, 2), (c.hits, c.misses))
+
+    @mock.patch('time.time')
+    def test_eviction(self, time_mock):
+        time_mock.return_value = 1000
+        # room for two entries
+        c = cache.IndexResultCache(self.path, max_bytes=25)
+        c.set('fp', 'a', 'x' * 8)
+        time_mock.return_value += 1
+        c.set('fp', 'b', 'x' * 8)
+        time_mock.return_value += 1
+        c.get('fp', 'a')
+        time_mock.return_value += 1
+        c.set('fp', 'c', 'x' * 8)
+        # b was the least recently used
+        self.assertIsNone(c.get('fp', 'b'))
+        self.assertIsNotNone(c.get('fp', 'a'))
+        self.assertIsNotNone(c.get('fp', 'c'))
+        self.assertEqual((2, 20), c.size())
+
+    def test_purge(self):
+        c = cache.IndexResultCache(self.path)
+        for index in ('a', 'b'):
+            c.set('fp1', index, {})
+            c.set('fp2', index, {})
+        self.assertEqual(2, c.purge(index='a'))
+        self.assertIsNone(c.get('fp1', 'a'))
+        self.assertEqual({}, c.get('fp1', 'b'))
+        self.assertEqual(2, c.purge())
+        self.assertEqual((0, 0), c.size())
@@ -0,0 +1,177 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+import fixtures
+import mock
+
+from elastic_recheck import catchup
+import elastic_recheck.config as er_conf
+from elastic_recheck import elasticRecheck
+from elastic_recheck import journal
+from elastic_recheck import tests
+import elastic_recheck.tests.unit.fake_gerrit as fg
+
+MSGS = {'found_bug': 'found %(bugs)s', 'recheck_instructions': 'recheck',
+        'unrecognized': 'unrecognized', 'footer': 'footer',
+        'no_bugs_found': 'none'}
+
+
+def _failures():
+    with open('elastic_recheck/tests/unit/gerrit/events.json') as f:
+        events = json.load(f)
+    return dict((int(x['change']['number']), x) for x in events
+                if elasticRecheck.Stream.parse_jenkins_failure(x))
+
+
+def _change(event, comments, patchsets=None):
+    patchset = int(event['patchSet']['number'])
+    return {
+        'number': event['change']['number'],
+        'project': event['change']['project'],
+        'url': event['change']['url'],
+        'patchSets': [{'number': x} for x in
+                      (patchsets or range(1, patchset + 1))],
+        'comments': comments,
+    }
+
+
+def _comment(username, patchset, message, timestamp):
+    return {'reviewer': {'username': username},
+            'message': 'Patch Set %d:\n\n%s' % (patchset, message),
+            'timestamp': timestamp}
+
+
+class TestCatchUp(tests.TestCase):
+
+    def setUp(self):
+        super(TestCatchUp, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'gerritlib.gerrit.Gerrit',
+            fg.Gerrit))
+        self.config = er_conf.Config(catchup_comment_interval=60)
+        self.config.gerrit_user = 'elastic-recheck'
+        self.journal = journal.EventJournal(':memory:')
+        self.stream = elasticRecheck.Stream("", "", "", config=self.config,
+                                            journal=self.journal)
+        self.failures = _failures()
+        self.gate = self.failures[64750]
+        self.check = self.failures[64749]
+
+    def _query(self, *changes):
+        rows = list(changes) + [{'type': 'stats', 'rowCount': len(changes)}]
+        self.stream.gerrit.bulk_query = mock.Mock(return_value=rows)
+
+    def test_comment_event(self):
+        change = _change(self.gate, [])
+        comment = _comment('jenkins', 6, self.gate['comment'], 1000)
+        event = catchup.comment_event(change, comment, 6)
+        fevent = self.stream._failure_event(event)
+        self.assertEqual('64750,6', fevent.name())
+        self.assertEqual(1000, fevent.created_on)
+        self.assertEqual('gate', fevent.queue())
+
+    def test_failures(self):
+        self._query(
+            # failed on the latest patch set
+            _change(self.gate, [
+                _comment('jenkins', 6, self.gate['comment'], 2000)]),
+            # a later patch set was uploaded
+            _change(self.check, [
+                _comment('jenkins', 6, self.check['comment'], 2000)],
+                patchsets=[5, 6, 7]),
+            # rechecked and passed
+            _change(self.failures[63078], [
+                _comment('jenkins', 19, self.failures[63078]['comment'],
+                         2000),
+                _comment('jenkins', 19, 'Build succeeded.', 2100)]),
+            # already reported
+            _change(self.failures[65361], [
+                _comment('jenkins', 2, self.failures[65361]['comment'],
+                         2000),
+                _comment('elastic-recheck', 2, 'I noticed', 2050)]))
+        events = catchup.CatchUp(self.stream, mock.Mock(),
+                                 config=self.config).failures(1000)
+        self.assertEqual(['64750,6'], [x.name() for x in events])
+        # failures from before we went down were seen already
+        self.assertEqual([], catchup.CatchUp(
+            self.stream, mock.Mock(), config=self.config).failures(3000))
+
+    def test_query_pages(self):
+        first = [_change(self.gate, []),
+                 {'type': 'stats', 'rowCount': 1, 'moreChanges': True}]
+        second = [_change(self.check, []),
+                  {'type': 'stats', 'rowCount': 1, 'moreChanges': False}]
+        self.stream.gerrit.bulk_query = mock.Mock(side_effect=[first, second])
+        changes = catchup.CatchUp(self.stream, mock.Mock(),
+                                  config=self.config)._query(0)
+        self.assertEqual(2, len(changes))
+        query = self.stream.gerrit.bulk_query.call_args[0][0]
+        self.assertIn('--start 1 ', query)
+        # only the changes of the watched projects CI commented on
+        self.assertIn('(project:^openstack/.*) '
+                      '(commentby:jenkins OR commentby:zuul)', query)
+
+    def test_run_failed(self):
+        self._query(
+            _change(self.gate, [
+                _comment('jenkins', 6, self.gate['comment'], 2000)]))
+        classifier = mock.Mock()
+        classifier.classify_events.side_effect = Exception('boom')
+        self.useFixture(fixtures.FakeLogger())
+        with mock.patch.object(self.stream, 'leave_comment') as comment:
+            self.assertEqual([], catchup.CatchUp(
+                self.stream, classifier, config=self.config).run(MSGS, 1000))
+        self.assertFalse(comment.called)
+        self.assertEqual([], self.journal.pending())
+
+    @mock.patch('time.sleep')
+    def test_run(self, sleep):
+        self._query(
+            _change(self.gate, [
+                _comment('jenkins', 6, self.gate['comment'], 2000)]),
+            _change(self.check, [
+                _comment('jenkins', 6, self.check['comment'], 2001)]))
+        classifier = mock.Mock()
+
+        def classify_events(events):
+            for fevent in events:
+                for job in fevent.failed_jobs:
+                    job.bugs = set(['123456'])
+
+        classifier.classify_events.side_effect = classify_events
+        with mock.patch.object(self.stream, 'leave_comment') as comment:
+            done = catchup.CatchUp(self.stream, classifier,
+                                   config=self.config).run(MSGS, 1000)
+        self.assertEqual(['64750,6', '64749,6'], [x.name() for x in done])
+        # all the failures are classified at once
+        classifier.classify_events.assert_called_once_with(done)
+        self.assertEqual(2, comment.call_count)
+        # the second comment waits for the interval
+        self.assertEqual(1, sleep.call_count)
+        self.assertTrue(0 < sleep.call_args[0][0] <= 60)
+        for fevent in done:
+            self.assertEqual(['123456'], fevent.get_all_bugs())
+            self.assertTrue(all(job.ready for job in fevent.failed_jobs))
+            self.assertEqual(journal.COMMENTED,
+                             self.journal.stage(fevent.key()))
+        # no readiness check for any of them
+        self.assertEqual(0, len(self.stream.scheduler))
+
+        # running again, everything was handled
+        with mock.patch.object(self.stream, 'leave_comment') as comment:
+            self.assertEqual([], catchup.CatchUp(
+                self.stream, classifier, config=self.config).run(MSGS, 1000))
+        self.assertFalse(comment.called)
@@ -12,9 +12,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
+import fixtures
 import mock
+import sqlalchemy
+from sqlalchemy import orm
+from subunit2sql.db import models
 
+import elastic_recheck.config as er_conf
 from elastic_recheck import elasticRecheck as er
+from elastic_recheck import results
 from elastic_recheck.tests import unit
 
 
@@ -35,6 +43,193 @@ class TestElasticRecheck(unit.UnitTestCase):
         self.assertEqual(results.took, 46)
         self.assertEqual(results.timed_out, False)
 
+    def test_classify_batches_queries(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        c.config.classify_batch_size = 10
+        queries = [x for x in c.queries
+                   if not x.get('suppress-notification')]
+        bug_query = [x['query'] for x in queries if x['bug'] == '1226337'][0]
+
+        def fake_multi_search(es_queries, **kwargs):
+            # only the query for bug 1226337 has hits
+            return [[1] if q['query']['query_string']['query'].startswith(
+                bug_query) else [] for q in es_queries]
+
+        with mock.patch.object(c.es, 'multi_search',
+                               side_effect=fake_multi_search) as ms:
+            res = c.classify(1234, 1, 'fake')
+        self.assertEqual(['1226337'], res)
+        # 10 queries per multi search request
+        self.assertEqual((len(queries) + 9) // 10, ms.call_count)
+        for call in ms.call_args_list:
+            self.assertLessEqual(len(call[0][0]), 10)
+            self.assertEqual({'size': '10', 'recent': False}, call[1])
+
+    def test_classify_builds_share_requests(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        queries = [x for x in c.queries
+                   if not x.get('suppress-notification')]
+        bug_query = [x['query'] for x in queries if x['bug'] == '1226337'][0]
+
+        def fake_multi_search(es_queries, **kwargs):
+            # only build b has a hit, for bug 1226337
+            return [[1] if (q['query']['query_string']['query'].startswith(
+                bug_query) and 'build_short_uuid:b' in
+                q['query']['query_string']['query']) else []
+                for q in es_queries]
+
+        builds = [{'change_number': 1234, 'patch_number': 1,
+                   'build_short_uuid': uuid} for uuid in ('a', 'b')]
+        with mock.patch.object(c.es, 'multi_search',
+                               side_effect=fake_multi_search) as ms:
+            res = c.classify_builds(builds, timerange=(100, 200))
+        self.assertEqual([[], ['1226337']], res)
+        ms.assert_called_once()
+        self.assertEqual(2 * len(queries), len(ms.call_args[0][0]))
+
+    def test_classify_timerange(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        with mock.patch.object(c.es, 'multi_search',
+                               return_value=[]) as ms:
+            c.classify(1234, 1, 'fake', timerange=(100, 200))
+        for call in ms.call_args_list:
+            self.assertEqual({'size': '10', 'timerange': (100, 200)},
+                             call[1])
+
+    def test_classify_retries_failed_batch_entry(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
+        error = results.ResultSet({'error': 'SearchPhaseExecutionException'})
+        with mock.patch.object(c.es, 'multi_search', return_value=[error]):
+            with mock.patch.object(c.es, 'search',
+                                   return_value=[1]) as search_mock:
+                with mock.patch.object(er, 'check_failed_test_ids_for_job',
+                                       return_value=True):
+                    res = c.classify(1234, 1, 'fake')
+        self.assertEqual(['1234567'], res)
+        search_mock.assert_called_once()
+
+    def test_classify_local_eval(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        c.config.local_eval = True
+        docs = {'hits': {'total': 1, 'hits': [{'_source': {
+            'message': "Cannot 'createImage' while instance is in task_state",
+            'filename': 'console.html',
+            'tags': ['console.html', 'console'],
+            'voting': '1'}}]}}
+        unsupported = {'bug': '42', 'query': 'error_pr:["-1000.0" TO "-1"]'}
+        with mock.patch.object(c._registry, 'refresh',
+                               return_value=c.queries + [unsupported]):
+            with mock.patch.object(
+                    c.es, 'search',
+                    return_value=results.ResultSet(docs)) as search_mock:
+                with mock.patch.object(
+                        c.es, 'multi_search',
+                        return_value=[[]]) as multi_search_mock:
+                    res = c.classify(1234, 1, 'fake')
+        self.assertEqual(['1218391'], res)
+        # the lines are counted before they are fetched
+        self.assertEqual([0, 1], [x[1]['size']
+                                  for x in search_mock.call_args_list])
+        es_query = search_mock.call_args[0][0]
+        self.assertIn('build_short_uuid:fake',
+                      es_query['query']['query_string']['query'])
+        self.assertIn('message', es_query['_source'])
+        # only the query that couldn't be compiled goes to elastic search
+        multi_search_mock.assert_called_once()
+        self.assertEqual(1, len(multi_search_mock.call_args[0][0]))
+
+    def test_classify_local_eval_truncated(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        c.config.local_eval = True
+        c.config.local_eval_max_docs = 1
+        docs = {'hits': {'total': 2, 'hits': []}}
+        with mock.patch.object(c.es, 'search',
+                               return_value=results.ResultSet(
+                                   docs)) as search_mock:
+            with mock.patch.object(
+                    c.es, 'multi_search',
+                    side_effect=lambda queries, **kwargs: [[]] * len(
+                        queries)) as multi_search_mock:
+                res = c.classify(1234, 1, 'fake')
+        self.assertEqual([], res)
+        # only the lines were counted, none were fetched
+        search_mock.assert_called_once()
+        self.assertEqual(0, search_mock.call_args[1]['size'])
+        # everything falls back to elastic search
+        self.assertEqual(
+            len([x for x in c.queries
+                 if not x.get('suppress-notification')]),
+            len(multi_search_mock.call_args[0][0]))
+
+    def test_classify_skips_queries_for_other_files(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        queries = [x for x in c.queries
+                   if not x.get('suppress-notification')]
+        with mock.patch.object(
+                c.es, 'multi_search',
+                side_effect=lambda queries, **kwargs: [[1]] * len(queries)):
+            res = c.classify(1234, 1, 'fake', job_name='tempest-full',
+                             files=['console.html'], queue='gate')
+        # none of the queries pinned to other files should be run
+        self.assertIn('1218391', res)
+        self.assertNotIn('1226337', res)
+        self.assertTrue(all(
+            'logs/' not in x['query'] for x in queries
+            if x['bug'] in res))
+        self.assertEqual(len(queries) - len(res), c.skipped_queries)
+
+
+class TestClassificationCache(unit.UnitTestCase):
+
+    def _classify(self, c, hits, build_short_uuid='fake'):
+        with mock.patch.object(
+                c.es, 'multi_search',
+                side_effect=lambda queries, **kwargs: [
+                    hits(q) for q in queries]) as ms:
+            res = c.classify(1234, 1, build_short_uuid)
+        return res, sum(len(call[0][0]) for call in ms.call_args_list)
+
+    def test_classify_cached(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        queries = len([x for x in c.queries
+                       if not x.get('suppress-notification')])
+        res, searched = self._classify(c, lambda q: [1])
+        self.assertEqual(queries, len(res))
+        self.assertEqual(queries, searched)
+        # the same build again is served from the cache, even if elastic
+        # search changed its mind
+        self.assertEqual((res, 0), self._classify(c, lambda q: []))
+        # but another build isn't
+        self.assertEqual(([], queries),
+                         self._classify(c, lambda q: [], 'other'))
+
+    def test_changed_query_invalidates_only_itself(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        self._classify(c, lambda q: [])
+        changed = [dict(x) for x in c.queries]
+        changed[0]['query'] = 'message:"changed" AND voting:1'
+        with mock.patch.object(c._registry, 'refresh',
+                               return_value=changed):
+            res, searched = self._classify(c, lambda q: [1])
+        self.assertEqual(([changed[0]['bug']], 1), (res, searched))
+        # reformatting the query doesn't change its fingerprint
+        changed[0]['query'] = 'message:"changed"\n   AND voting:1 '
+        with mock.patch.object(c._registry, 'refresh',
+                               return_value=changed):
+            self.assertEqual(([changed[0]['bug']], 0),
+                             self._classify(c, lambda q: []))
+
+    def test_disk_cache_survives_restart(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'cache.db')
+        config = er_conf.Config(classify_cache_db=path)
+        c = er.Classifier('./elastic_recheck/tests/unit/queries',
+                          config=config)
+        res, _ = self._classify(c, lambda q: [1])
+        c = er.Classifier('./elastic_recheck/tests/unit/queries',
+                          config=config)
+        self.assertEqual((res, 0), self._classify(c, lambda q: []))
+
 
 class TestSubunit2sqlCrossover(unit.UnitTestCase):
 
@@ -59,7 +254,9 @@ class TestSubunit2sqlCrossover(unit.UnitTestCase):
     @mock.patch.object(er, 'check_failed_test_ids_for_job', return_value=True)
     def test_classify_with_test_id_filter_match(self, mock_id_check):
         c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
-        es_mock = mock.patch.object(c.es, 'search', return_value=[1, 2, 3])
+        es_mock = mock.patch.object(
+            c.es, 'multi_search',
+            side_effect=lambda queries, **kwargs: [[1, 2, 3]] * len(queries))
         es_mock.start()
         self.addCleanup(es_mock.stop)
         res = c.classify(1234, 1, 'fake')
@@ -70,10 +267,188 @@ class TestSubunit2sqlCrossover(unit.UnitTestCase):
     @mock.patch.object(er, 'check_failed_test_ids_for_job', return_value=False)
     def test_classify_with_test_id_filter_no_match(self, mock_id_check):
         c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
-        es_mock = mock.patch.object(c.es, 'search', return_value=[1, 2, 3])
+        es_mock = mock.patch.object(
+            c.es, 'multi_search',
+            side_effect=lambda queries, **kwargs: [[1, 2, 3]] * len(queries))
         es_mock.start()
         self.addCleanup(es_mock.stop)
         res = c.classify(1234, 1, 'fake')
         self.assertEqual(res, [],
                          "classify() returned bug matches %s when none should "
                          "have been found" % res)
+
+    def _classify_with_hits(self, c, build_short_uuid='fake'):
+        es_mock = mock.patch.object(
+            c.es, 'multi_search',
+            side_effect=lambda queries, **kwargs: [[1]] * len(queries))
+        with es_mock:
+            return c.classify(1234, 1, build_short_uuid)
+
+    def test_classify_reuses_db_engine(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
+        db_path = self.useFixture(fixtures.TempDir()).path
+        c.config.db_uri = 'sqlite:///%s/subunit2sql.db' % db_path
+        sessions = []
+
+        def fake_check(build_uuid, test_ids, session, **kwargs):
+            sessions.append(session)
+            session.execute(sqlalchemy.text('SELECT 1'))
+            return True
+
+        with mock.patch.object(er, 'check_failed_test_ids_for_job',
+                               side_effect=fake_check):
+            with mock.patch('sqlalchemy.create_engine',
+                            wraps=sqlalchemy.create_engine) as engine_mock:
+                self.assertEqual(['1234567'],
+                                 self._classify_with_hits(c, 'fake1'))
+                self.assertEqual(['1234567'],
+                                 self._classify_with_hits(c, 'fake2'))
+        engine_mock.assert_called_once_with(
+            c.config.db_uri, pool_recycle=c.config.db_pool_recycle)
+        self.assertEqual(2, len(sessions))
+        self.assertIs(sessions[0].get_bind(), sessions[1].get_bind())
+
+    def test_classify_db_pool_settings(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
+        c.config.db_pool_size = 3
+        with mock.patch.object(er, 'check_failed_test_ids_for_job',
+                               return_value=True):
+            with mock.patch('sqlalchemy.create_engine') as engine_mock:
+                self._classify_with_hits(c)
+        engine_mock.assert_called_once_with(
+            c.config.db_uri, pool_recycle=c.config.db_pool_recycle,
+            pool_size=3)
+
+    def test_classify_without_test_ids_skips_db(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries')
+        with mock.patch('sqlalchemy.create_engine') as engine_mock:
+            self.assertNotEqual([], self._classify_with_hits(c))
+        engine_mock.assert_not_called()
+
+
+class TestFailingTestIds(unit.UnitTestCase):
+    """Tests the failing test_ids lookups against a sqlite subunit2sql db."""
+
+    def setUp(self):
+        super(TestFailingTestIds, self).setUp()
+        db_path = self.useFixture(fixtures.TempDir()).path
+        self.db_uri = 'sqlite:///%s/subunit2sql.db' % db_path
+        engine = sqlalchemy.create_engine(self.db_uri)
+        models.BASE.metadata.create_all(engine)
+        self.session = orm.sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        runs = {'uuid1': {'test1': 'fail', 'test2': 'success'},
+                'uuid2': {'test2': 'fail', 'test3': 'fail'},
+                'uuid3': {'test1': 'success'}}
+        tests = {}
+        for run_id, build_uuid in enumerate(sorted(runs), 1):
+            self.session.add(models.Run(id=run_id, artifacts=build_uuid))
+            self.session.add(models.RunMetadata(
+                id=run_id, run_id=run_id,
+                key='build_short_uuid', value=build_uuid))
+            for test_id, status in sorted(runs[build_uuid].items()):
+                if test_id not in tests:
+                    tests[test_id] = len(tests) + 1
+                    self.session.add(models.Test(id=tests[test_id],
+                                                 test_id=test_id))
+                self.session.add(models.TestRun(
+                    id=run_id * 10 + tests[test_id], run_id=run_id,
+                    test_id=tests[test_id], status=status))
+        self.session.commit()
+
+    def test_bulk_lookup(self):
+        failing = er.get_failing_test_ids_for_builds(
+            ['uuid1', 'uuid2', 'uuid3', 'missing'], self.session,
+            chunk_size=2)
+        self.assertEqual({'uuid1': set(['test1']),
+                          'uuid2': set(['test2', 'test3']),
+                          'uuid3': set(),
+                          'missing': set()}, failing)
+
+    def test_cache_fetches_once(self):
+        failing_tests = er.FailingTestIds(maxsize=2)
+        with mock.patch.object(
+                er, 'get_failing_test_ids_for_builds',
+                wraps=er.get_failing_test_ids_for_builds) as bulk_mock:
+            failing_tests.prefetch(['uuid1', 'uuid2'], self.session)
+            self.assertEqual(set(['test1']),
+                             failing_tests.get('uuid1', self.session))
+            self.assertEqual(set(['test2', 'test3']),
+                             failing_tests.get('uuid2', self.session))
+            self.assertEqual(1, bulk_mock.call_count)
+            # uuid4 evicts the least recently used entry, uuid1
+            failing_tests.set('uuid4', ['test4'])
+            failing_tests.get('uuid2', self.session)
+            self.assertEqual(1, bulk_mock.call_count)
+            failing_tests.get('uuid1', self.session)
+            self.assertEqual(2, bulk_mock.call_count)
+
+    def test_cache_skips_builds_without_failures(self):
+        # their results may not be in subunit2sql yet
+        failing_tests = er.FailingTestIds()
+        with mock.patch.object(
+                er, 'get_failing_test_ids_for_builds',
+                wraps=er.get_failing_test_ids_for_builds) as bulk_mock:
+            failing_tests.prefetch(['uuid1', 'uuid3'], self.session)
+            self.assertEqual(set(), failing_tests.get('uuid3', self.session))
+            self.assertEqual(2, bulk_mock.call_count)
+            bulk_mock.assert_called_with(['uuid3'], self.session)
+
+    def test_classify_checks_db_once_per_build(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
+        c.config.db_uri = self.db_uri
+        other = dict(c.queries[0], bug='7654321', test_ids=['test3'])
+        c.queries[0]['test_ids'] = ['test1']
+        es_mock = mock.patch.object(
+            c.es, 'multi_search',
+            side_effect=lambda queries, **kwargs: [[1]] * len(queries))
+        with es_mock:
+            with mock.patch.object(c._registry, 'refresh',
+                                   return_value=[c.queries[0], other]):
+                with mock.patch.object(
+                        er, 'get_failing_test_ids_for_builds',
+                        wraps=er.get_failing_test_ids_for_builds) as bulk:
+                    self.assertEqual(['1234567'],
+                                     c.classify(1234, 1, 'uuid1'))
+                    self.assertEqual(['7654321'],
+                                     c.classify(1234, 1, 'uuid2'))
+                    self.assertEqual(['1234567'],
+                                     c.classify(1234, 1, 'uuid1'))
+        self.assertEqual(2, bulk.call_count)
+
+    def test_classify_builds_fetches_failing_tests_once(self):
+        c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
+        c.config.db_uri = self.db_uri
+        c.queries[0]['test_ids'] = ['test1']
+        builds = [{'change_number': 1234, 'patch_number': 1,
+                   'build_short_uuid': uuid}
+                  for uuid in ('uuid1', 'uuid2', 'uuid3')]
+        with mock.patch.object(
+                c.es, 'multi_search',
+                side_effect=lambda queries, **kwargs: [[1]] * len(queries)):
+            with mock.patch.object(c._registry, 'refresh',
+                                   return_value=[c.queries[0]]):
+                with mock.patch.object(
+                        er, 'get_failing_test_ids_for_builds',
+                        wraps=er.get_failing_test_ids_for_builds) as bulk:
+                    self.assertEqual([['1234567'], [], []],
+                                     c.classify_builds(builds))
+        bulk.assert_called_once()
+
+    def test_classify_rechecks_builds_without_failures(self):
+        # the subunit2sql results of uuid3 may not be uploaded yet, so
+        # that it didn't match isn't remembered
+        c = er.Classifier('./elastic_recheck/tests/unit/queries_with_filters')
+        c.config.db_uri = self.db_uri
+        c.queries[0]['test_ids'] = ['test1']
+        with mock.patch.object(
+                c.es, 'multi_search',
+                side_effect=lambda queries, **kwargs: [[1]] * len(queries)):
+            with mock.patch.object(c._registry, 'refresh',
+                                   return_value=[c.queries[0]]):
+                with mock.patch.object(
+                        er, 'get_failing_test_ids_for_builds',
+                        wraps=er.get_failing_test_ids_for_builds) as bulk:
+                    self.assertEqual([], c.classify(1234, 1, 'uuid3'))
+                    self.assertEqual([], c.classify(1234, 1, 'uuid3'))
+        self.assertEqual(2, bulk.call_count)
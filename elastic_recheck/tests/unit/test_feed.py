@@ -0,0 +1,87 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import socket
+import threading
+
+import fixtures
+import mock
+
+from elastic_recheck import feed
+from elastic_recheck import tests
+
+
+class TestFeed(tests.TestCase):
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, feed.IndexedFeed)
+
+    def test_parse_message(self):
+        self.assertEqual(('abc', None),
+                         feed.parse_message('{"build_short_uuid": "abc"}'))
+        self.assertEqual(
+            ('abc', ['job-output.txt']),
+            feed.parse_message(b'{"build_short_uuid": "abc", '
+                               b'"files": ["job-output.txt"]}'))
+        self.assertEqual(('abc', None), feed.parse_message(
+            '{"build_short_uuid": "abc", "files": "job-output.txt"}'))
+        self.assertIsNone(feed.parse_message('{"build_uuid": "abc"}'))
+        self.assertIsNone(feed.parse_message('not json'))
+        self.assertIsNone(feed.parse_message('[]'))
+
+    def test_socket_feed(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'indexed.sock')
+        received = []
+        done = threading.Event()
+
+        def callback(uuid, files):
+            received.append((uuid, files))
+            if len(received) == 2:
+                done.set()
+
+        sock_feed = feed.from_url('unix://%s' % path)
+        sock_feed.subscribe(callback)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for message in [{'build_short_uuid': 'abc'}, {'bogus': 1},
+                        {'build_short_uuid': 'def', 'files': ['a']}]:
+            client.sendto(json.dumps(message).encode('utf-8'), path)
+        client.close()
+        self.assertTrue(done.wait(5))
+        sock_feed.stop()
+        self.assertEqual([('abc', None), ('def', ['a'])], received)
+        self.assertEqual(2, sock_feed.received)
+        self.assertFalse(os.path.exists(path))
+
+    def test_mqtt_needs_paho(self):
+        with mock.patch.object(feed, 'mqtt', None):
+            self.assertRaises(ImportError, feed.from_url,
+                              'mqtt://localhost/logs/indexed')
+
+    def test_mqtt_url(self):
+        with mock.patch.object(feed, 'mqtt') as mqtt:
+            del mqtt.CallbackAPIVersion
+            mqtt_feed = feed.from_url('mqtt://firehose:1884/logs/indexed')
+        self.assertEqual('firehose', mqtt_feed.host)
+        self.assertEqual(1884, mqtt_feed.port)
+        self.assertEqual('logs/indexed', mqtt_feed.topic)
+        message = mock.Mock(payload=b'{"build_short_uuid": "abc"}')
+        mqtt_feed.callback = mock.Mock()
+        mqtt_feed._on_message(None, None, message)
+        mqtt_feed.callback.assert_called_once_with('abc', None)
+
+    def test_unknown_url(self):
+        self.assertRaises(ValueError, feed.from_url, 'http://localhost/')
@@ -0,0 +1,83 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import fixtures
+import mock
+
+from elastic_recheck import journal
+from elastic_recheck import tests
+
+
+class TestEventJournal(tests.TestCase):
+
+    def setUp(self):
+        super(TestEventJournal, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'journal.db')
+
+    def test_stages(self):
+        j = journal.EventJournal(self.path)
+        j.add('1,1,a', {'change': 1})
+        j.add('2,1,b', {'change': 2})
+        j.update('2,1,b', journal.CLASSIFIED, bugs={'b': ['123']})
+        self.assertEqual(journal.WAITING, j.stage('1,1,a'))
+        # adding again doesn't reset the stage
+        j.add('2,1,b', {'change': 2})
+        self.assertEqual(journal.CLASSIFIED, j.stage('2,1,b'))
+        self.assertRaises(ValueError, j.update, '1,1,a', 'bogus')
+
+        # survives a restart
+        j.close()
+        j = journal.EventJournal(self.path)
+        self.assertEqual(
+            [('1,1,a', {'change': 1}, journal.WAITING, None),
+             ('2,1,b', {'change': 2}, journal.CLASSIFIED, {'b': ['123']})],
+            j.pending())
+        j.update('1,1,a', journal.COMMENTED)
+        j.update('2,1,b', journal.TIMED_OUT)
+        self.assertEqual([], j.pending())
+        j.add('3,1,c', {'change': 3})
+        j.update('3,1,c', journal.SHED)
+        self.assertEqual([], j.pending())
+        j.add('4,1,d', {'change': 4})
+        j.update('4,1,d', journal.FAILED)
+        self.assertEqual([], j.pending())
+
+    @mock.patch('time.time')
+    def test_compact(self, time_mock):
+        time_mock.return_value = 1000
+        j = journal.EventJournal(self.path, retention=100)
+        j.add('done', {})
+        j.add('waiting', {})
+        j.add('shed', {})
+        j.add('failed', {})
+        j.update('done', journal.COMMENTED)
+        j.update('shed', journal.SHED)
+        j.update('failed', journal.FAILED)
+        time_mock.return_value = 1050
+        self.assertEqual(0, j.compact())
+        time_mock.return_value = 1101
+        self.assertEqual(3, j.compact())
+        self.assertIsNone(j.stage('done'))
+        self.assertEqual(journal.WAITING, j.stage('waiting'))
+
+    def test_last_seen(self):
+        j = journal.EventJournal(self.path)
+        self.assertIsNone(j.last_seen())
+        j.add('1,1,a', {'eventCreatedOn': 200})
+        j.add('2,1,b', {'eventCreatedOn': 100})
+        j.add('3,1,c', {})
+        self.assertEqual(200, j.last_seen())
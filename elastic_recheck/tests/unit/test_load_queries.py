@@ -12,6 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
+import fixtures
+import mock
+import yaml
+
 from elastic_recheck import loader
 from elastic_recheck import tests
 
@@ -45,3 +51,66 @@ class TestLoadQueries(tests.TestCase):
             # Use assertTrue because you can specify a custom message
             self.assertTrue("filename:\"logs/screen-" not in q['query'],
                             msg=("for bug %s" % q['bug']))
+
+
+class TestQueryRegistry(tests.TestCase):
+    """Test that the registry only re-parses the query files that changed."""
+
+    def setUp(self):
+        super(TestQueryRegistry, self).setUp()
+        self.dir = self.useFixture(fixtures.TempDir()).path
+        self._write('1234', 'message:"foo"')
+        self._write('5678', 'message:"bar"')
+        self.registry = loader.QueryRegistry(self.dir)
+
+    def _write(self, bug, query, mtime=None):
+        fname = os.path.join(self.dir, '%s.yaml' % bug)
+        with open(fname, 'w') as f:
+            f.write('query: >\n  %s\n' % query)
+        if mtime:
+            os.utime(fname, (mtime, mtime))
+
+    def _queries(self):
+        return dict((q['bug'], q['query']) for q in self.registry.refresh())
+
+    def test_initial_load(self):
+        self.assertEqual({'1234': 'message:"foo" AND voting:1',
+                          '5678': 'message:"bar" AND voting:1'},
+                         self._queries())
+
+    def test_unchanged_files_not_parsed(self):
+        self._queries()
+        with mock.patch('yaml.safe_load') as load_mock:
+            self._queries()
+        load_mock.assert_not_called()
+
+    def test_touched_file_same_content_not_parsed(self):
+        self._queries()
+        self._write('1234', 'message:"foo"', mtime=1000)
+        with mock.patch('yaml.safe_load') as load_mock:
+            self.assertEqual('message:"foo" AND voting:1',
+                             self._queries()['1234'])
+        load_mock.assert_not_called()
+
+    def test_changed_file(self):
+        self._queries()
+        self._write('1234', 'message:"changed"', mtime=1000)
+        with mock.patch('yaml.safe_load',
+                        wraps=yaml.safe_load) as load_mock:
+            queries = self._queries()
+        self.assertEqual(1, load_mock.call_count)
+        self.assertEqual('message:"changed" AND voting:1', queries['1234'])
+        self.assertEqual('message:"bar" AND voting:1', queries['5678'])
+
+    def test_added_and_deleted_files(self):
+        self._queries()
+        os.unlink(os.path.join(self.dir, '5678.yaml'))
+        self._write('9999', 'message:"new"')
+        self.assertEqual({'1234': 'message:"foo" AND voting:1',
+                          '9999': 'message:"new" AND voting:1'},
+                         self._queries())
+
+    def test_returns_copies(self):
+        queries = self.registry.refresh()
+        queries[0]['query'] += ' AND build_queue:gate'
+        self.assertNotIn('build_queue', self.registry.refresh()[0]['query'])
@@ -0,0 +1,204 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+from elastic_recheck import loader
+from elastic_recheck import matcher
+from elastic_recheck import tests
+
+
+def _doc(message, filename='job-output.txt', tags=None, **fields):
+    source = dict(message=message, filename=filename,
+                  tags=tags or ['job-output.txt', 'console'],
+                  voting='1', build_name='tempest-full')
+    source.update(fields)
+    return {'_source': source}
+
+
+class TestMatcher(tests.TestCase):
+
+    def test_phrase(self):
+        m = matcher.compile_query('message:"No valid host was found."')
+        self.assertTrue(m(_doc('ERROR: No valid host was found. There are')))
+        self.assertTrue(m(_doc('no  VALID host, was found')))
+        self.assertFalse(m(_doc('No valid hosts was found.')))
+        self.assertFalse(m(_doc('was found. No valid host')))
+
+    def test_exact_fields(self):
+        m = matcher.compile_query(
+            'message:"Hash Sum mismatch" AND tags:console AND voting:1')
+        self.assertTrue(m(_doc('E: Hash Sum mismatch')))
+        self.assertFalse(m(_doc('E: Hash Sum mismatch', tags=['syslog'])))
+        self.assertTrue(m(_doc('E: Hash Sum mismatch', voting=1)))
+        self.assertFalse(m(_doc('E: Hash Sum mismatch', voting=0)))
+
+        m = matcher.compile_query('build_name:"tempest-full"')
+        self.assertTrue(m(_doc('x')))
+        self.assertFalse(m(_doc('x', build_name='tempest-full-py3')))
+
+    def test_wildcard(self):
+        m = matcher.compile_query(
+            'message:"oops" AND filename:logs*screen-n-cpu.txt')
+        self.assertTrue(m(_doc('oops', filename='logs/screen-n-cpu.txt')))
+        self.assertTrue(
+            m(_doc('oops', filename='logs/new/screen-n-cpu.txt')))
+        self.assertFalse(m(_doc('oops', filename='logs/screen-n-api.txt')))
+
+    def test_boolean_operators(self):
+        m = matcher.compile_query(
+            '(message: "FAILED with status: 137" OR '
+            'message: "RUN END RESULT_TIMED_OUT") AND '
+            'NOT message:"POST-RUN END RESULT_TIMED_OUT" AND tags: "console"')
+        self.assertTrue(m(_doc('cmd FAILED with status: 137')))
+        self.assertTrue(m(_doc('RUN END RESULT_TIMED_OUT')))
+        self.assertFalse(m(_doc('POST-RUN END RESULT_TIMED_OUT')))
+        self.assertFalse(m(_doc('all good')))
+
+    def test_escaped_quotes(self):
+        m = matcher.compile_query(
+            r'message:"\"code\": \"placement.concurrent_update\""')
+        self.assertTrue(
+            m(_doc('{"code": "placement.concurrent_update", "title"')))
+
+    def test_old_style_documents(self):
+        m = matcher.compile_query('message:"boom" AND build_name:"foo"')
+        doc = {'_source': {'@message': 'boom', '@fields': {
+            'build_name': ['foo']}}}
+        self.assertTrue(m(doc))
+
+    def test_words_like_elastic_search(self):
+        # what the _analyze API of elastic search gives with the standard
+        # analyzer
+        for text, tokens in (
+                ('nova.compute.manager', ['nova.compute.manager']),
+                ('foo-bar', ['foo', 'bar']),
+                ("Don't PANIC", ["don't", 'panic']),
+                ('10.0.0.1:8774', ['10.0.0.1', '8774']),
+                ('1,000 v1.2 foo.1', ['1,000', 'v1.2', 'foo', '1']),
+                ('[req-1234] x_y=z/w.', ['req', '1234', 'x_y', 'z', 'w']),
+                ('host:port', ['host:port'])):
+            self.assertEqual(tokens, matcher._words(text))
+
+    def test_punctuation(self):
+        m = matcher.compile_query('message:"bar baz"')
+        self.assertFalse(m(_doc('foo.bar baz')))
+        self.assertTrue(m(_doc('foo-bar baz')))
+        m = matcher.compile_query('message:"nova.compute"')
+        self.assertTrue(m(_doc('in nova.compute: boom')))
+        self.assertFalse(m(_doc('in nova.compute.manager')))
+        self.assertFalse(m(_doc('nova compute')))
+
+    def test_unsupported(self):
+        for query in ('error_pr:["-1000.0" TO "-10.0"]',
+                      'message:"foo" bar',
+                      '"no field"',
+                      'message:foo* AND tags:console',
+                      '(message:"foo"',
+                      'message:"foo" NOT tags:console',
+                      'message:foo-bar',
+                      u'message:"\u00e9chec"',
+                      'build_name:Tempest*',
+                      ''):
+            self.assertRaises(matcher.UnsupportedQuery,
+                              matcher.compile_query, query)
+
+    def test_query_fields(self):
+        self.assertEqual(
+            set(['message', 'tags', 'voting']),
+            matcher.query_fields(
+                'message:"a:b" AND (tags:"x" OR tags:y) AND voting:1'))
+
+    def test_production_queries_compile(self):
+        # all the production queries should be able to run locally, if one
+        # of them can't this is not an error but it should be a conscious
+        # decision.
+        for q in loader.load('queries'):
+            matcher.compile_query(q['query'])
+
+    def test_sample_hits(self):
+        with open('elastic_recheck/tests/unit/samples/bug-1226337.json') as f:
+            hits = json.load(f)['hits']['hits']
+        m = matcher.compile_query('build_status:"FAILURE"')
+        self.assertEqual(202, len([h for h in hits if m(h)]))
+
+
+class TestQueryIndex(tests.TestCase):
+
+    def setUp(self):
+        super(TestQueryIndex, self).setUp()
+        self.index = matcher.QueryIndex([
+            {'bug': 'any', 'query': 'message:"boom"'},
+            {'bug': 'cpu', 'query':
+             'message:"boom" AND tags:"screen-n-cpu.txt"'},
+            {'bug': 'console', 'query': 'message:"boom" AND tags:console'},
+            {'bug': 'slow', 'query':
+             'message:"boom" AND (build_name:"tempest-slow" OR '
+             'build_name:"tempest-slow-py3")'},
+            {'bug': 'either', 'query':
+             'message:"boom" AND (build_name:"tempest-slow" OR '
+             'tags:"syslog.txt")'},
+            {'bug': 'not', 'query':
+             'message:"boom" AND NOT build_name:"tempest-slow"'},
+            {'bug': 'gate', 'query': 'message:"boom" AND build_queue:gate'},
+            {'bug': 'grenade', 'query':
+             'message:"boom" AND build_name:grenade*'},
+            {'bug': 'screen', 'query': 'message:"boom" AND tags:screen'},
+            {'bug': 'range', 'query': 'error_pr:["-1000.0" TO "-10.0"]'},
+            {'bug': 'oslofmt', 'query': 'message:"boom" AND tags:oslofmt'},
+            {'bug': 'bak', 'query':
+             'message:"boom" AND tags:"screen-c-bak.txt"'},
+        ])
+
+    def test_no_restrictions(self):
+        self.assertEqual(self.index.bugs, self.index.candidates())
+
+    def test_build_name(self):
+        self.assertEqual(
+            set(['any', 'cpu', 'console', 'either', 'not', 'gate', 'screen',
+                 'range', 'oslofmt', 'bak']),
+            self.index.candidates(build_name=['tempest-full']))
+        self.assertIn('slow',
+                      self.index.candidates(build_name=['tempest-slow-py3']))
+        self.assertIn('grenade',
+                      self.index.candidates(build_name=['grenade-py3']))
+
+    def test_files(self):
+        files = ['job-output.txt', 'logs/screen-n-api.txt']
+        candidates = self.index.candidates(
+            filename=files, tags=matcher.file_tags(files),
+            build_queue=['check'], build_name=['tempest-full'])
+        # either can't be indexed, it's pinned to different fields
+        self.assertEqual(
+            set(['any', 'console', 'either', 'not', 'screen', 'range',
+                 'oslofmt', 'bak']),
+            candidates)
+
+    def test_unknown_tags(self):
+        # tags that aren't a file name, or whose files we don't know, can
+        # be on the lines of any file, the queries are never skipped
+        for files in ([], ['job-output.txt'], ['logs/screen-c-bak.txt']):
+            candidates = self.index.candidates(
+                filename=files, tags=matcher.file_tags(files))
+            self.assertIn('oslofmt', candidates)
+            self.assertIn('bak', candidates)
+
+    def test_file_tags(self):
+        self.assertEqual(
+            set(['job-output.txt', 'console', 'screen-n-cpu.txt']),
+            matcher.file_tags(['job-output.txt', 'logs/screen-n-cpu.txt']))
+        self.assertEqual(
+            set(['console', 'console.html', 'screen-n-cpu.txt']),
+            matcher.file_tags(['console.html.gz', 'logs/screen-n-cpu.txt.gz',
+                               'logs/screen-c-bak.txt']))
@@ -0,0 +1,154 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+from six.moves import queue
+
+from elastic_recheck import elasticRecheck
+from elastic_recheck import pipeline
+from elastic_recheck import tests
+
+
+class TestPipeline(tests.TestCase):
+
+    def test_stages(self):
+        done = []
+        failed = []
+
+        def fail_odd(item):
+            if item % 2:
+                raise Exception('odd')
+            return item
+
+        p = pipeline.Pipeline([
+            pipeline.Stage('double', lambda x: x * 2, workers=2),
+            pipeline.Stage('odd', lambda x: None if x == 4 else x + 1),
+            pipeline.Stage('even', fail_odd, workers=3,
+                           on_error=failed.append),
+            pipeline.Stage('done', done.append),
+        ])
+        p.start()
+        for x in range(5):
+            p.put(x)
+        p.stop()
+        # 4 is dropped by 'odd', everything else is odd and fails 'even'
+        self.assertEqual([], done)
+        self.assertEqual([1, 3, 7, 9], sorted(failed))
+        stats = p.stats()
+        self.assertEqual(['double', 'odd', 'even', 'done'], list(stats))
+        self.assertEqual(5, stats['double']['processed'])
+        self.assertEqual(5, stats['odd']['processed'])
+        self.assertEqual(0, stats['even']['processed'])
+        self.assertEqual(4, stats['even']['errors'])
+        self.assertEqual(3, stats['even']['workers'])
+        self.assertEqual(0, stats['double']['depth'])
+
+    def test_results_flow(self):
+        done = []
+        p = pipeline.Pipeline([
+            pipeline.Stage('double', lambda x: x * 2, workers=4),
+            pipeline.Stage('done', done.append),
+        ])
+        p.start()
+        for x in range(10):
+            p.put(x)
+        p.stop()
+        self.assertEqual([x * 2 for x in range(10)], sorted(done))
+        self.assertTrue(p.stats()['double']['p99'] >= 0)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        stage = pipeline.Stage('blocked', lambda x: release.wait(),
+                               maxsize=1)
+        stage.start()
+        stage.put(1)
+        stage.put(2, timeout=1)
+        # one item is being worked on, the queue holds one more
+        self.assertRaises(queue.Full, stage.put, 3, timeout=0.01)
+        release.set()
+        stage.stop()
+        self.assertEqual(2, stage.stats()['processed'])
+
+    def _blocked_stage(self, **kwargs):
+        # hold the only worker up, so everything else stays queued
+        release = threading.Event()
+        done = []
+
+        def work(item):
+            if item == 'block':
+                release.wait()
+            else:
+                done.append(item)
+
+        stage = pipeline.Stage('blocked', work, **kwargs)
+        stage.start()
+        stage.put('block')
+        while stage.stats()['depth']:
+            release.wait(0.001)
+        return stage, release, done
+
+    def test_priority(self):
+        stage, release, done = self._blocked_stage(priority=lambda x: x[0])
+        for item in [(2, 'a'), (1, 'b'), (2, 'c'), (0, 'd')]:
+            stage.put(item)
+        release.set()
+        stage.stop()
+        # lowest priority first, in the order they were queued otherwise
+        self.assertEqual([(0, 'd'), (1, 'b'), (2, 'a'), (2, 'c')], done)
+
+    def test_shed(self):
+        backlogs = []
+
+        def shed(item, backlog):
+            backlogs.append(backlog)
+            if item.startswith('drop'):
+                return pipeline.DROP
+            if item.startswith('defer'):
+                return pipeline.DEFER
+            return None
+
+        stage, release, done = self._blocked_stage(shed=shed)
+        for item in ['defer-1', 'a', 'drop-1', 'b', 'defer-2']:
+            stage.put(item)
+        release.set()
+        stage.stop()
+        self.assertEqual(['a', 'b', 'defer-1', 'defer-2'], done)
+        self.assertEqual([0, 0, 1, 2, 2, 3], backlogs)
+        stats = stage.stats()
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(2, stats['deferred'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, pipeline.percentile(values, 50))
+        self.assertEqual(99, pipeline.percentile(values, 99))
+        self.assertEqual(0.0, pipeline.percentile([], 50))
+
+
+class TestSchedulerWait(tests.TestCase):
+
+    def test_wait_due(self):
+        scheduler = elasticRecheck.ReadinessScheduler()
+        self.assertIsNone(scheduler.wait_due(timeout=0.01))
+        scheduler.add('event', 0)
+        self.assertEqual('event', scheduler.wait_due(timeout=0.01))
+
+        def add():
+            scheduler.add('later', 0)
+
+        timer = threading.Timer(0.05, add)
+        timer.start()
+        self.assertEqual('later', scheduler.wait_due(timeout=5))
+        timer.join()
@@ -12,12 +12,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import calendar
+import collections
 import datetime
 import json
+import threading
 
+import fixtures
 import mock
 import pyelasticsearch
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
 
+from elastic_recheck import cache
 from elastic_recheck import results
 from elastic_recheck import tests
 
@@ -80,6 +87,18 @@ class TestBasicParsing(tests.TestCase):
         self.assertEqual(len(facets['FAILURE'].keys()), 12)
         self.assertEqual(len(facets['SUCCESS'].keys()), 3)
 
+    def test_facet_single_pass(self):
+        # the hits can come from a generator, like iter_search
+        data = load_sample(1226337)
+        result_set = results.ResultSet(data)
+        facets = results.FacetSet()
+        facets.detect_facets(iter(result_set), ["build_status", "build_uuid"])
+        self.assertEqual(12, len(facets['FAILURE'].keys()))
+        self.assertEqual(202, sum(len(x) for x in facets['FAILURE'].values()))
+        self.assertIsInstance(facets['FAILURE'], results.FacetSet)
+        self.assertIsInstance(list(facets['FAILURE'].values())[0],
+                              results.ResultSet)
+
     def test_facet_histogram(self):
         data = load_sample(1226337)
         result_set = results.ResultSet(data)
@@ -93,6 +112,68 @@ class TestBasicParsing(tests.TestCase):
         self.assertEqual(list(facets[1382101200000].keys()), ["FAILURE"])
 
 
+class TestColumnarResultSet(tests.TestCase):
+
+    def setUp(self):
+        super(TestColumnarResultSet, self).setUp()
+        self.result_set = results.ResultSet(load_sample(1226337))
+        self.columns = results.ColumnarResultSet(iter(self.result_set))
+
+    def test_columns(self):
+        self.assertEqual(len(self.result_set), len(self.columns))
+        # every distinct value is stored once
+        self.assertEqual(['FAILURE', 'SUCCESS'],
+                         sorted(self.columns.columns['build_status'].values))
+        for hit, row in zip(self.result_set, self.columns):
+            for name in results.ColumnarResultSet.COLUMNS:
+                self.assertEqual(hit[name], row[name])
+        self.assertEqual(self.result_set[-1].build_uuid,
+                         self.columns[-1].build_uuid)
+        self.assertRaises(AttributeError, getattr, self.columns[0],
+                          'message')
+
+    def test_group_by(self):
+        counts = self.columns.counts(["build_status"])
+        self.assertEqual({('FAILURE',): 202, ('SUCCESS',): 27}, counts)
+        groups = self.columns.group_by(["build_status", "build_uuid"])
+        self.assertEqual(15, len(groups))
+        self.assertEqual(len(self.columns),
+                         sum(len(rows) for rows in groups.values()))
+        # the same groups, in the same order, as grouping row by row
+        expected = collections.OrderedDict()
+        for row, hit in enumerate(self.result_set):
+            expected.setdefault((hit.build_status, hit.build_uuid),
+                                []).append(row)
+        self.assertEqual(list(expected.items()),
+                         [(key, list(rows)) for key, rows in groups.items()])
+        self.assertEqual(
+            [(key, len(rows)) for key, rows in expected.items()],
+            list(self.columns.counts(["build_status",
+                                      "build_uuid"]).items()))
+
+    def _assert_same_facets(self, expected, actual):
+        self.assertEqual(list(expected.keys()), list(actual.keys()))
+        for key in expected:
+            if isinstance(expected[key], results.FacetSet):
+                self.assertIsInstance(actual[key], results.FacetSet)
+                self._assert_same_facets(expected[key], actual[key])
+            else:
+                self.assertEqual([x.build_uuid for x in expected[key]],
+                                 [x.build_uuid for x in actual[key]])
+
+    def test_facets(self):
+        for facets in (["build_uuid"],
+                       ["build_status", "build_uuid"],
+                       ["timestamp", "build_status", "build_uuid"]):
+            expected = results.FacetSet()
+            expected.detect_facets(self.result_set, list(facets))
+            self._assert_same_facets(expected, self.columns.facets(facets))
+            # FacetSet takes them too
+            actual = results.FacetSet()
+            actual.detect_facets(self.columns, list(facets))
+            self._assert_same_facets(expected, actual)
+
+
 # NOTE(mriedem): We can't mock built-ins so we have to override utcnow().
 class MockDatetimeToday(datetime.datetime):
 
@@ -120,6 +201,14 @@ class TestSearchEngine(tests.TestCase):
         super(TestSearchEngine, self).setUp()
         self.engine = results.SearchEngine('http://fake-url')
         self.query = 'message:"foo" AND tags:"console"'
+        results.index_cache.clear()
+        self.addCleanup(results.index_cache.clear)
+
+    def _aliases(self, *indexes):
+        # the listing of the indexes of the server
+        return mock.patch.object(
+            pyelasticsearch.ElasticSearch, 'send_request',
+            return_value=dict((index, {'aliases': {}}) for index in indexes))
 
     def test_search_not_recent(self, search_mock):
         # Tests a basic search with recent=False.
@@ -139,9 +228,7 @@ class TestSearchEngine(tests.TestCase):
         # The search index comparison goes back one hour and cuts off by day,
         # so test that we're one hour and one second into today so we only have
         # one index in the search call.
-        with mock.patch.object(
-                pyelasticsearch.ElasticSearch, 'status') as mock_data:
-            mock_data.return_value = "Not an exception"
+        with self._aliases('logstash-2014.06.12', 'logstash-2014.06.11'):
             self._test_search_recent(search_mock, MockDatetimeToday,
                                      expected_indexes=['logstash-2014.06.12'])
 
@@ -149,27 +236,29 @@ class TestSearchEngine(tests.TestCase):
         # The search index comparison goes back one hour and cuts off by day,
         # so test that we're 59 minutes and 59 seconds into today so that we
         # have an index for today and yesterday in the search call.
-        with mock.patch.object(
-                pyelasticsearch.ElasticSearch, 'status') as mock_data:
-            mock_data.return_value = "Not an exception"
+        with self._aliases('logstash-2014.06.12', 'logstash-2014.06.11'):
             self._test_search_recent(search_mock, MockDatetimeYesterday,
                                      expected_indexes=['logstash-2014.06.12',
                                                        'logstash-2014.06.11'])
 
     def test_search_no_indexes(self, search_mock):
-        # Test when no indexes are valid
+        # Test when no indexes are valid, on a server that can't list its
+        # indexes
         with mock.patch.object(
-                pyelasticsearch.ElasticSearch, 'status') as mock_data:
-            mock_data.side_effect = pyelasticsearch.exceptions.\
-                ElasticHttpNotFoundError()
-            self._test_search_recent(search_mock, MockDatetimeYesterday,
-                                     expected_indexes=[])
+                pyelasticsearch.ElasticSearch, 'send_request',
+                side_effect=pyelasticsearch.exceptions.
+                ElasticHttpNotFoundError()):
+            with mock.patch.object(
+                    pyelasticsearch.ElasticSearch, 'status') as mock_data:
+                mock_data.side_effect = pyelasticsearch.exceptions.\
+                    ElasticHttpNotFoundError()
+                self._test_search_recent(search_mock, MockDatetimeYesterday,
+                                         expected_indexes=[])
 
     def test_search_days(self, search_mock):
         # Test when specific days are used.
-        with mock.patch.object(
-                pyelasticsearch.ElasticSearch, 'status') as mock_data:
-            mock_data.return_value = "Not an exception"
+        with self._aliases('logstash-2014.06.12', 'logstash-2014.06.11',
+                           'logstash-2014.06.10'):
             datetime.datetime = MockDatetimeYesterday
             result_set = self.engine.search(self.query, size=10, days=3,
                                             recent=False)
@@ -178,3 +267,383 @@ class TestSearchEngine(tests.TestCase):
                                                 index=['logstash-2014.06.12',
                                                        'logstash-2014.06.11',
                                                        'logstash-2014.06.10'])
+
+    def test_multi_search(self, search_mock):
+        # Tests that all queries are sent in a single multi search request
+        # and each response is mapped back to its query.
+        responses = {'responses': [load_sample(1218391),
+                                   {'error': 'SearchPhaseExecutionException'}]}
+        queries = [{'query': {'query_string': {'query': 'foo'}}},
+                   {'query': {'query_string': {'query': 'bar'}}}]
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request',
+                return_value=responses) as send_mock:
+            result_sets = self.engine.multi_search(queries, size=10)
+        self.assertEqual(1, send_mock.call_count)
+        args, kwargs = send_mock.call_args
+        self.assertEqual(('GET', ['_msearch']), args[:2])
+        self.assertFalse(kwargs['encode_body'])
+        lines = args[2].split('\n')
+        self.assertEqual('', lines[-1])
+        self.assertEqual([{}, dict(queries[0], size=10),
+                          {}, dict(queries[1], size=10)],
+                         [json.loads(line) for line in lines[:-1]])
+        self.assertEqual(2, len(result_sets))
+        self.assertEqual(load_sample(1218391)['hits']['total'],
+                         len(result_sets[0]))
+        self.assertIsNone(result_sets[0].error)
+        self.assertEqual(0, len(result_sets[1]))
+        self.assertEqual('SearchPhaseExecutionException',
+                         result_sets[1].error)
+        search_mock.assert_not_called()
+
+    def test_multi_search_recent(self, search_mock):
+        def send_request(method, path, body='', **kwargs):
+            if path == ['_aliases']:
+                return {'logstash-2014.06.12': {}, 'logstash-2014.06.11': {}}
+            return {'responses': [{}]}
+
+        datetime.datetime = MockDatetimeYesterday
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request',
+                side_effect=send_request) as send_mock:
+            self.engine.multi_search([{}], size=10, recent=True)
+        header = json.loads(send_mock.call_args[0][2].split('\n')[0])
+        self.assertEqual(
+            {'index': 'logstash-2014.06.12,logstash-2014.06.11'}, header)
+
+    def test_search_timerange(self, search_mock):
+        # A build reported just before midnight, its logs can be in the
+        # indexes of both days, and there is no index for tomorrow yet.
+        datetime.datetime = MockDatetimeToday
+        start = calendar.timegm((2014, 6, 11, 20, 0, 0))
+        end = calendar.timegm((2014, 6, 13, 0, 15, 0))
+        query = {'query': {'query_string': {'query': self.query}}}
+        with self._aliases('logstash-2014.06.12', 'logstash-2014.06.11',
+                           'logstash-2014.06.10'):
+            self.engine.search(query, size=10, timerange=(start, end))
+        search_mock.assert_called_once_with(
+            {'query': {'filtered': {
+                'query': query['query'],
+                'filter': {'range': {'@timestamp': {
+                    'gte': start * 1000, 'lte': end * 1000}}}}}},
+            size=10, index=['logstash-2014.06.12', 'logstash-2014.06.11'])
+
+    def test_search_timerange_no_indexes(self, search_mock):
+        datetime.datetime = MockDatetimeToday
+        start = calendar.timegm((2014, 6, 9, 20, 0, 0))
+        end = calendar.timegm((2014, 6, 9, 23, 0, 0))
+        with self._aliases('logstash-2014.06.12', 'logstash-2014.06.11'):
+            result_set = self.engine.search({'query': {}},
+                                            timerange=(start, end))
+        # no index can have the logs, so there is nothing to search
+        self.assertEqual(0, len(result_set))
+        search_mock.assert_not_called()
+
+    def test_multi_search_timerange(self, search_mock):
+        def send_request(method, path, body='', **kwargs):
+            if path == ['_aliases']:
+                return {'logstash-2014.06.12': {}, 'logstash-2014.06.11': {}}
+            return {'responses': [{}]}
+
+        datetime.datetime = MockDatetimeToday
+        start = calendar.timegm((2014, 6, 11, 23, 0, 0))
+        end = calendar.timegm((2014, 6, 11, 23, 30, 0))
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request',
+                side_effect=send_request) as send_mock:
+            self.engine.multi_search([{'query': {}}], size=10,
+                                     timerange=(start, end))
+        header, query = [json.loads(line) for line in
+                         send_mock.call_args[0][2].split('\n')[:2]]
+        self.assertEqual({'index': 'logstash-2014.06.11'}, header)
+        self.assertEqual({'gte': start * 1000, 'lte': end * 1000},
+                         query['query']['filtered']['filter']['range'][
+                             '@timestamp'])
+
+    def _page(self, uuids, total, scroll_id='scroll'):
+        return {'_scroll_id': scroll_id,
+                'hits': {'total': total,
+                         'hits': [{'_source': {'build_uuid': uuid}}
+                                  for uuid in uuids]}}
+
+    def test_iter_search(self, search_mock):
+        search_mock.return_value = self._page(['a', 'b'], 3)
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request',
+                side_effect=[self._page(['c'], 3, scroll_id='scroll2'),
+                             self._page([], 3, scroll_id='scroll3'),
+                             {}]) as send_mock:
+            hits = self.engine.iter_search({'query': {}}, page_size=2)
+            # nothing is fetched before the hits are asked for
+            search_mock.assert_not_called()
+            self.assertEqual(['a', 'b', 'c'],
+                             [hit.build_uuid for hit in hits])
+        search_mock.assert_called_once_with({'query': {}}, size=2,
+                                            es_scroll='1m')
+        self.assertEqual(
+            [mock.call('GET', ['_search', 'scroll'], 'scroll',
+                       query_params={'scroll': '1m'}, encode_body=False),
+             mock.call('GET', ['_search', 'scroll'], 'scroll2',
+                       query_params={'scroll': '1m'}, encode_body=False),
+             mock.call('DELETE', ['_search', 'scroll'], 'scroll3',
+                       encode_body=False)],
+            send_mock.call_args_list)
+
+    def test_iter_search_limit(self, search_mock):
+        search_mock.return_value = self._page(['a', 'b'], 3)
+        logger = self.useFixture(fixtures.FakeLogger())
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request',
+                return_value={}) as send_mock:
+            hits = list(self.engine.iter_search({'query': {}}, limit=1))
+        self.assertEqual(['a'], [hit.build_uuid for hit in hits])
+        # it isn't silently truncated
+        self.assertIn('Stopped after 1 of the 3 hits', logger.output)
+        send_mock.assert_called_once_with('DELETE', ['_search', 'scroll'],
+                                          'scroll', encode_body=False)
+
+    def test_aggregate(self, search_mock):
+        search_mock.return_value = {
+            'hits': {'hits': [], 'total': 3},
+            'aggregations': {'build_status': {'buckets': [
+                {'key': 'FAILURE', 'doc_count': 3,
+                 'timestamp': {'buckets': [
+                     {'key': 1402534800000, 'doc_count': 3,
+                      'build_uuid': {'buckets': [
+                          {'key': 'a', 'doc_count': 2},
+                          {'key': 'b', 'doc_count': 1}]}}]}}]}}}
+        facets = ['build_status', 'timestamp', 'build_uuid']
+        counts = self.engine.aggregate({'query': {}, 'sort': {}}, facets)
+        self.assertEqual({'FAILURE': {1402534800000: {'a': 2, 'b': 1}}},
+                         counts)
+        self.assertIsInstance(counts['FAILURE'], results.FacetSet)
+        search_mock.assert_called_once_with(
+            {'query': {}, 'aggs': {'build_status': {
+                'terms': {'field': 'build_status', 'size': 0},
+                'aggs': {'timestamp': {
+                    'date_histogram': {'field': '@timestamp',
+                                       'interval': '3600s'},
+                    'aggs': {'build_uuid': {
+                        'terms': {'field': 'build_uuid', 'size': 0}}}}}}}},
+            size=0)
+
+    def test_aggregate_fallback(self, search_mock):
+        # a server without aggregations, the hits are counted on the client
+        hits = [{'_source': {'build_status': status, 'build_uuid': uuid}}
+                for status, uuid in (('FAILURE', 'a'), ('FAILURE', 'a'),
+                                     ('FAILURE', 'b'), ('SUCCESS', 'c'))]
+        search_mock.side_effect = [
+            pyelasticsearch.exceptions.ElasticHttpError(
+                400, 'SearchParseException'),
+            {'_scroll_id': 'scroll',
+             'hits': {'hits': hits, 'total': 4}}]
+        self.useFixture(fixtures.FakeLogger())
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request',
+                return_value={'hits': {'hits': [], 'total': 4}}):
+            counts = self.engine.aggregate({'query': {}},
+                                           ['build_status', 'build_uuid'])
+        self.assertEqual({'FAILURE': {'a': 2, 'b': 1}, 'SUCCESS': {'c': 1}},
+                         counts)
+
+    def test_aggregate_cached(self, search_mock):
+        # the counts of the indexes of past days come from the result cache
+        datetime.datetime = MockDatetimeToday
+        path = self.useFixture(fixtures.TempDir()).path
+        engine = results.SearchEngine(
+            'http://fake-url', settle=3600,
+            result_cache=cache.IndexResultCache(path + '/results.db'))
+        indexes = ['logstash-2014.06.12', 'logstash-2014.06.11',
+                   'logstash-2014.06.10']
+        listing = dict((index, {'aliases': {}}) for index in indexes)
+
+        def send_request(method, path, body=None, **kwargs):
+            if path != ['_msearch']:
+                return listing
+            searched = [json.loads(line)['index']
+                        for line in body.splitlines()[::2]]
+            requests.append(searched)
+            return {'responses': [
+                {'aggregations': {'build_status': {'buckets': [
+                    {'key': 'FAILURE', 'doc_count': 1}]}}}
+                for index in searched]}
+
+        requests = []
+        with mock.patch.object(pyelasticsearch.ElasticSearch, 'send_request',
+                               side_effect=send_request):
+            for i in range(2):
+                counts = engine.aggregate({'query': {}}, ['build_status'],
+                                          days=3)
+                self.assertEqual({'FAILURE': 3}, counts)
+        # 06.11 is done for an hour, so only the index of today is searched
+        # again
+        self.assertEqual([indexes, ['logstash-2014.06.12']], requests)
+        search_mock.assert_not_called()
+
+    def test_multi_search_no_queries(self, search_mock):
+        with mock.patch.object(
+                pyelasticsearch.ElasticSearch, 'send_request') as send_mock:
+            self.assertEqual([], self.engine.multi_search([]))
+        send_mock.assert_not_called()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+    # or the response body waits for the ack of the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.encodings.append(self.headers.get('Accept-Encoding'))
+        body = json.dumps({'hits': {'hits': [], 'total': 0}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestSharedClient(tests.TestCase):
+
+    def setUp(self):
+        super(TestSharedClient, self).setUp()
+        patcher = mock.patch.dict(results._clients, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _server(self):
+        server = _Server(('127.0.0.1', 0), _Handler)
+        server.encodings = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def test_shared(self):
+        client = results.get_client('http://fake-url', pool_size=3,
+                                    timeout=5)
+        self.assertIs(client, results.get_client('http://fake-url'))
+        self.assertIsNot(client, results.get_client('http://other-url'))
+        engine = results.SearchEngine('http://fake-url')
+        self.assertIs(client, engine._client())
+        self.assertEqual(5, client.timeout)
+        self.assertEqual('gzip', client.session.headers['Accept-Encoding'])
+        adapter = client.session.get_adapter('http://fake-url')
+        self.assertEqual(3, adapter._pool_maxsize)
+
+    def test_client_factory(self):
+        engine = results.SearchEngine('http://fake-url',
+                                      client_factory=lambda url: 'fake')
+        self.assertEqual('fake', engine._client())
+        self.assertEqual({}, results._clients)
+
+    def test_connections_are_reused(self):
+        server, url = self._server()
+        engine = results.SearchEngine(url)
+        self.addCleanup(engine._client().session.close)
+        for i in range(20):
+            engine.search('foo')
+        opened, requested = results.connections(engine._client())
+        self.assertEqual(1, opened)
+        self.assertEqual(20, requested)
+        self.assertEqual(['gzip'] * 20, server.encodings)
+
+    def test_timeout(self):
+        engine = results.SearchEngine('http://fake-url', timeout=7)
+        session = engine._client().session
+        with mock.patch('requests.Session.request',
+                        side_effect=Exception('stop')) as request:
+            self.assertRaises(Exception, engine.search, 'foo', timeout=2)
+            self.assertEqual(2, request.call_args[1]['timeout'])
+            self.assertRaises(Exception, engine.search, 'foo')
+            self.assertEqual(7, request.call_args[1]['timeout'])
+        self.assertIsNone(session.local.timeout)
+
+
+class TestIndexCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestIndexCache, self).setUp()
+        self.cache = results.IndexCache(ttl=3600, negative_ttl=60)
+        self.es = mock.Mock()
+        self.es.send_request.return_value = {'logstash-2014.06.12': {},
+                                             'logstash-2014.06.11': {}}
+
+    @mock.patch('time.time')
+    def test_listing(self, time_mock):
+        # 2014-06-12 10:00 UTC
+        time_mock.return_value = 1402567200
+        exists = self.cache.exists
+        self.assertTrue(exists(self.es, 'url', 'logstash-2014.06.12'))
+        self.assertTrue(exists(self.es, 'url', 'logstash-2014.06.11'))
+        self.assertFalse(exists(self.es, 'url', 'logstash-2014.06.10'))
+        self.es.send_request.assert_called_once_with('GET', ['_aliases'])
+        self.assertFalse(self.es.status.called)
+
+        # missing indexes are looked for again after the negative ttl
+        time_mock.return_value += 61
+        self.assertTrue(exists(self.es, 'url', 'logstash-2014.06.12'))
+        self.assertEqual(1, self.es.send_request.call_count)
+        self.assertFalse(exists(self.es, 'url', 'logstash-2014.06.10'))
+        self.assertEqual(2, self.es.send_request.call_count)
+
+        # the listing expires after the ttl
+        time_mock.return_value += 3600
+        self.assertTrue(exists(self.es, 'url', 'logstash-2014.06.12'))
+        self.assertEqual(3, self.es.send_request.call_count)
+
+        # other servers have their own listing
+        self.assertTrue(exists(self.es, 'other', 'logstash-2014.06.12'))
+        self.assertEqual(4, self.es.send_request.call_count)
+
+    @mock.patch('time.time')
+    def test_midnight(self, time_mock):
+        # 2014-06-12 23:59:00 UTC
+        time_mock.return_value = 1402617540
+        self.assertTrue(self.cache.exists(self.es, 'url',
+                                          'logstash-2014.06.12'))
+        time_mock.return_value += 59
+        self.cache.exists(self.es, 'url', 'logstash-2014.06.12')
+        self.assertEqual(1, self.es.send_request.call_count)
+        # a new day, there may be a new index
+        time_mock.return_value += 1
+        self.cache.exists(self.es, 'url', 'logstash-2014.06.12')
+        self.assertEqual(2, self.es.send_request.call_count)
+
+    @mock.patch('time.time')
+    def test_no_listing(self, time_mock):
+        time_mock.return_value = 1402567200
+        self.es.send_request.side_effect = \
+            pyelasticsearch.exceptions.ElasticHttpNotFoundError()
+
+        def status(index):
+            if index != 'logstash-2014.06.12':
+                raise pyelasticsearch.exceptions.ElasticHttpNotFoundError()
+
+        self.es.status.side_effect = status
+        for i in range(3):
+            self.assertTrue(self.cache.exists(self.es, 'url',
+                                              'logstash-2014.06.12'))
+            self.assertFalse(self.cache.exists(self.es, 'url',
+                                               'logstash-2014.06.11'))
+        self.assertEqual(2, self.es.status.call_count)
+        self.assertEqual(1, self.es.send_request.call_count)
+        time_mock.return_value += 61
+        self.assertTrue(self.cache.exists(self.es, 'url',
+                                          'logstash-2014.06.12'))
+        self.assertFalse(self.cache.exists(self.es, 'url',
+                                           'logstash-2014.06.11'))
+        self.assertEqual(3, self.es.status.call_count)
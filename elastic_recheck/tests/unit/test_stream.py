@@ -12,24 +12,43 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import json
 
 import fixtures
 import mock
+import six
 
 from elastic_recheck import elasticRecheck
+from elastic_recheck import journal
+from elastic_recheck import results
 from elastic_recheck import tests
 import elastic_recheck.tests.unit.fake_gerrit as fg
 
 
-class TestStream(tests.TestCase):
+class StreamTestCase(tests.TestCase):
+    """Streams on the events of the fake gerrit."""
 
     def setUp(self):
-        super(TestStream, self).setUp()
+        super(StreamTestCase, self).setUp()
         self.useFixture(fixtures.MonkeyPatch(
             'gerritlib.gerrit.Gerrit',
             fg.Gerrit))
 
+    def _next_raw_failure(self, stream):
+        """Return the next gerrit event of a stream that is a failure."""
+        while True:
+            event = stream.gerrit.getEvent()
+            if stream._failure_event(event) is not None:
+                return event
+
+    def _next_failure(self, stream):
+        """Return the FailEvent of the next failure of a stream."""
+        return stream._failure_event(self._next_raw_failure(stream))
+
+
+class TestStream(StreamTestCase):
+
     def test_gerrit_stream(self):
         """Tests that we can use our mock gerrit to process events."""
         with mock.patch.object(
@@ -105,6 +124,13 @@ class TestStream(tests.TestCase):
         self.assertFalse(
             elasticRecheck.Stream.parse_jenkins_failure(events[2]))
 
+        # the prefilter rejects the same events, without parsing them
+        self.assertTrue(elasticRecheck.Stream.is_failure_comment(events[0]))
+        self.assertFalse(elasticRecheck.Stream.is_failure_comment(events[1]))
+        self.assertFalse(elasticRecheck.Stream.is_failure_comment(events[2]))
+        self.assertFalse(elasticRecheck.Stream.is_failure_comment(
+            {'type': 'ref-updated'}))
+
         jobs = elasticRecheck.Stream.parse_jenkins_failure(events[0])
         job_names = [x.name for x in jobs]
         self.assertIn('check-requirements-integration-dsvm', job_names)
@@ -162,6 +188,8 @@ class TestStream(tests.TestCase):
                               'gate-keystone-python27'])
             self.assertEqual(event.get_all_bugs(), ['123456'])
             self.assertFalse(event.is_fully_classified())
+            self.assertEqual((event.created_on - 4 * 3600,
+                              event.created_on + 900), event.timerange())
 
             event = stream.get_failed_tempest()
             # Add bugs
@@ -188,3 +216,387 @@ class TestStream(tests.TestCase):
                               'gate-keystone-python27'])
             self.assertEqual(event.get_all_bugs(), ['123456'])
             self.assertFalse(event.is_fully_classified())
+
+
+class TestReadinessScheduler(StreamTestCase):
+
+    def test_scheduler_order(self):
+        scheduler = elasticRecheck.ReadinessScheduler()
+        self.assertIsNone(scheduler.next_due())
+        scheduler.add('late', 50)
+        scheduler.add('early', 10)
+        scheduler.add('early2', 10)
+        self.assertEqual(10, scheduler.next_due())
+        self.assertIsNone(scheduler.pop_due(5))
+        self.assertEqual('early', scheduler.pop_due(10))
+        self.assertEqual('early2', scheduler.pop_due(10))
+        self.assertIsNone(scheduler.pop_due(10))
+        self.assertEqual('late', scheduler.pop_due(100))
+        self.assertEqual(0, len(scheduler))
+
+    def test_slow_event_does_not_block(self):
+        def ready(event, wait=True):
+            # 64750,6 is still being indexed
+            return event.change != 64750
+
+        with mock.patch.object(elasticRecheck.Stream, '_does_es_have_data',
+                               side_effect=ready):
+            stream = elasticRecheck.Stream("", "", "")
+            event = stream.get_failed_tempest()
+            self.assertEqual(64749, event.change)
+            event = stream.get_failed_tempest()
+            self.assertEqual(63078, event.change)
+            # 64750,6 is waiting to be checked again
+            self.assertEqual(1, len(stream.scheduler))
+
+    def _jobs_ready_results(self, consoles, files, other=None):
+        facets = {'console': {'terms': [{'term': uuid, 'count': 1}
+                                        for uuid in consoles]}}
+        for uuid, names in files.items():
+            facets['files-%s' % uuid] = {
+                'terms': [{'term': name, 'count': 1} for name in names],
+                'other': (other or {}).get(uuid, 0)}
+        return results.ResultSet({'facets': facets})
+
+    @mock.patch('time.time')
+    def test_not_ready_without_waiting(self, time_mock):
+        stream = elasticRecheck.Stream("", "", "")
+        fevent = self._next_failure(stream)
+        time_mock.return_value = fevent.created_on + 10
+        with mock.patch.object(
+                stream.es, 'search',
+                return_value=self._jobs_ready_results([], {})):
+            self.assertFalse(stream._does_es_have_data(fevent, wait=False))
+            time_mock.return_value = (
+                fevent.created_on + elasticRecheck.READY_TIMEOUT + 1)
+            self.assertRaises(elasticRecheck.ResultTimedOut,
+                              stream._does_es_have_data, fevent, wait=False)
+
+    def test_jobs_ready_single_query(self):
+        stream = elasticRecheck.Stream("", "", "")
+        fevent = self._next_failure(stream)
+        uuids = fevent.build_short_uuids()
+        self.assertTrue(len(uuids) > 1)
+        # only the first job is ready
+        ready = self._jobs_ready_results(
+            uuids, {uuids[0]: ['job-output.txt', 'logs/foo.txt'],
+                    uuids[1]: ['logs/foo.txt']})
+        with mock.patch.object(stream.es, 'search',
+                               return_value=ready) as search:
+            self.assertRaises(elasticRecheck.FilesNotReady,
+                              stream._jobs_ready, fevent)
+            self.assertEqual(1, search.call_count)
+            # only the logs of the time of the builds are searched
+            self.assertEqual(fevent.timerange(),
+                             search.call_args[1]['timerange'])
+            query = search.call_args[0][0]
+            for uuid in uuids:
+                self.assertIn(uuid, query['query']['query_string']['query'])
+                self.assertIn('files-%s' % uuid, query['facets'])
+        self.assertEqual([True, False],
+                         [job.ready for job in fevent.failed_jobs])
+        self.assertEqual(['job-output.txt', 'logs/foo.txt'],
+                         fevent.failed_jobs[0].files)
+
+        # the ready job isn't asked about again
+        ready = self._jobs_ready_results(
+            uuids[1:], {uuids[1]: ['job-output.txt']})
+        with mock.patch.object(stream.es, 'search',
+                               return_value=ready) as search:
+            self.assertTrue(stream._does_es_have_data(fevent))
+            query = search.call_args[0][0]
+            self.assertNotIn('files-%s' % uuids[0], query['facets'])
+        self.assertTrue(all(job.ready for job in fevent.failed_jobs))
+
+    def test_jobs_ready_truncated_files(self):
+        # more files than the facet lists, they aren't used to skip queries
+        stream = elasticRecheck.Stream("", "", "")
+        fevent = self._next_failure(stream)
+        uuids = fevent.build_short_uuids()
+        ready = self._jobs_ready_results(
+            uuids, dict((uuid, ['job-output.txt']) for uuid in uuids),
+            other={uuids[0]: 10})
+        with mock.patch.object(stream.es, 'search', return_value=ready):
+            stream._jobs_ready(fevent)
+        self.assertTrue(all(job.ready for job in fevent.failed_jobs))
+        self.assertEqual([None] + [['job-output.txt']] * (len(uuids) - 1),
+                         [job.files for job in fevent.failed_jobs])
+
+    def test_console_not_ready(self):
+        stream = elasticRecheck.Stream("", "", "")
+        fevent = self._next_failure(stream)
+        uuids = fevent.build_short_uuids()
+        ready = self._jobs_ready_results(
+            uuids[1:], dict((uuid, ['job-output.txt']) for uuid in uuids))
+        with mock.patch.object(stream.es, 'search', return_value=ready):
+            self.assertRaises(elasticRecheck.ConsoleNotReady,
+                              stream._jobs_ready, fevent)
+        self.assertEqual([False] + [True] * (len(uuids) - 1),
+                         [job.ready for job in fevent.failed_jobs])
+
+    def test_get_event_timeout(self):
+        stream = elasticRecheck.Stream("", "", "")
+        stream.gerrit.event_queue = six.moves.queue.Queue()
+        self.assertIsNone(stream._get_event(timeout=0.01))
+        stream.gerrit.event_queue.put('event')
+        self.assertEqual('event', stream._get_event(timeout=0.01))
+
+
+class FakeLagMonitor(object):
+    def __init__(self, lag):
+        self.lag = lag
+
+
+class TestAdaptivePolling(StreamTestCase):
+
+    def setUp(self):
+        super(TestAdaptivePolling, self).setUp()
+        self.stream = elasticRecheck.Stream("", "", "")
+        self.fevent = self._next_failure(self.stream)
+        self.created = self.fevent.created_on
+
+    def test_no_monitor(self):
+        now = self.created + 5
+        self.assertEqual(now + elasticRecheck.READY_INTERVAL,
+                         self.stream._next_check(self.fevent, now))
+
+    def test_exponential_backoff(self):
+        self.stream.lag_monitor = FakeLagMonitor(0)
+        now = self.created + 5
+        waits = [self.stream._next_check(self.fevent, now) - now
+                 for x in range(8)]
+        self.assertEqual([10, 20, 40, 80, 160, 300, 300, 300], waits)
+
+    def test_unknown_lag(self):
+        self.stream.lag_monitor = FakeLagMonitor(None)
+        now = self.created + 5
+        self.assertEqual(now + 10, self.stream._next_check(self.fevent, now))
+
+    def test_wait_for_expected_arrival(self):
+        self.stream.lag_monitor = FakeLagMonitor(600)
+        now = self.created + 5
+        self.assertEqual(self.created + 600,
+                         self.stream._next_check(self.fevent, now))
+
+    def test_no_checks_long_after_timeout(self):
+        self.stream.lag_monitor = FakeLagMonitor(0)
+        self.fevent.ready_checks = 10
+        now = self.created + elasticRecheck.READY_TIMEOUT - 5
+        self.assertEqual(self.created + elasticRecheck.READY_TIMEOUT + 1,
+                         self.stream._next_check(self.fevent, now))
+
+    def test_fail_fast(self):
+        self.stream.lag_monitor = FakeLagMonitor(
+            elasticRecheck.READY_TIMEOUT + 1)
+        self.assertRaises(elasticRecheck.ResultTimedOut,
+                          self.stream._next_check, self.fevent,
+                          self.created + 5)
+
+    def test_fail_fast_nothing_indexed(self):
+        classifier = mock.Mock()
+        classifier.most_recent.return_value = (
+            datetime.datetime.utcfromtimestamp(0))
+        self.stream.lag_monitor = elasticRecheck.IndexLagMonitor(classifier)
+        self.stream.lag_monitor.check()
+        self.assertRaises(elasticRecheck.ResultTimedOut,
+                          self.stream._next_check, self.fevent,
+                          self.created + 5)
+
+
+class TestIndexLagMonitor(tests.TestCase):
+
+    @mock.patch('time.time', return_value=1000000)
+    def test_check(self, time_mock):
+        classifier = mock.Mock()
+        classifier.most_recent.return_value = (
+            datetime.datetime.utcfromtimestamp(1000000 - 120))
+        monitor = elasticRecheck.IndexLagMonitor(classifier)
+        self.assertIsNone(monitor.lag)
+        monitor.check()
+        self.assertEqual(120, monitor.lag)
+        classifier.most_recent.assert_called_once_with(recent=True)
+
+        # nothing indexed lately, that's the worst lag
+        classifier.most_recent.return_value = (
+            datetime.datetime.utcfromtimestamp(0))
+        monitor.check()
+        self.assertEqual(monitor.RECENT_WINDOW, monitor.lag)
+        self.assertTrue(monitor.lag > elasticRecheck.READY_TIMEOUT)
+
+        classifier.most_recent.side_effect = Exception('boom')
+        monitor.check()
+        self.assertIsNone(monitor.lag)
+
+
+class TestJournal(StreamTestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.journal = journal.EventJournal(':memory:')
+
+    def test_stages_are_recorded(self):
+        with mock.patch.object(elasticRecheck.Stream, '_does_es_have_data',
+                               return_value=True):
+            stream = elasticRecheck.Stream("", "", "", journal=self.journal)
+            event = stream.get_failed_tempest()
+        self.assertEqual(journal.READY, self.journal.stage(event.key()))
+        event.failed_jobs[0].bugs = set(['123'])
+        stream.mark(event, journal.CLASSIFIED)
+        self.assertEqual(
+            dict((job.build_short_uuid, sorted(job.bugs))
+                 for job in event.failed_jobs),
+            self.journal.pending()[0][3])
+        stream.mark(event, journal.COMMENTED)
+        self.assertEqual([], self.journal.pending())
+
+    def test_timed_out(self):
+        with mock.patch.object(elasticRecheck.Stream, '_does_es_have_data',
+                               side_effect=elasticRecheck.ResultTimedOut()):
+            stream = elasticRecheck.Stream("", "", "", journal=self.journal)
+            self.assertRaises(elasticRecheck.ResultTimedOut,
+                              stream.get_failed_tempest)
+        self.assertEqual([], self.journal.pending())
+
+    def test_resume_rejected(self):
+        # an event that isn't a failure we care about anymore
+        self.journal.add('1,1,a', {'type': 'comment-added', 'comment': ''})
+        with mock.patch.object(fg.Gerrit, 'getEvent',
+                               side_effect=fg.GerritDone()):
+            stream = elasticRecheck.Stream("", "", "", journal=self.journal)
+        self.assertEqual(0, len(stream.scheduler))
+        self.assertEqual(journal.FAILED, self.journal.stage('1,1,a'))
+        self.assertEqual([], self.journal.pending())
+
+    def test_resume(self):
+        with mock.patch.object(elasticRecheck.Stream, '_does_es_have_data',
+                               return_value=False):
+            stream = elasticRecheck.Stream("", "", "", journal=self.journal)
+            # read all the events, they're all waiting for their logs
+            self.assertRaises(fg.GerritDone, stream.get_failed_tempest)
+        pending = self.journal.pending()
+        self.assertEqual(4, len(pending))
+        classified = stream._failure_event(pending[1][1])
+        for job in classified.failed_jobs:
+            job.bugs = set(['123'])
+        stream.mark(classified, journal.CLASSIFIED)
+
+        # the bot restarts, the gerrit events are gone
+        with mock.patch.object(fg.Gerrit, 'getEvent',
+                               side_effect=fg.GerritDone()):
+            stream = elasticRecheck.Stream("", "", "", journal=self.journal)
+            self.assertEqual(4, len(stream.scheduler))
+            with mock.patch.object(stream, '_jobs_ready') as jobs_ready:
+                events = [stream.get_failed_tempest() for x in range(4)]
+            self.assertRaises(fg.GerritDone, stream.get_failed_tempest)
+        self.assertEqual([x[0] for x in pending], [e.key() for e in events])
+        self.assertEqual(4, jobs_ready.call_count)
+        self.assertEqual(journal.CLASSIFIED, events[1].stage)
+        self.assertTrue(all(job.bugs == set(['123'])
+                            for job in events[1].failed_jobs))
+        self.assertTrue(all(job.ready for job in events[1].failed_jobs))
+        self.assertEqual(journal.READY, events[0].stage)
+
+
+class TestEventCoalescer(StreamTestCase):
+
+    def setUp(self):
+        super(TestEventCoalescer, self).setUp()
+        self.stream = elasticRecheck.Stream("", "", "")
+        self.raw = self._next_raw_failure(self.stream)
+
+    def test_duplicates_are_dropped(self):
+        with mock.patch.object(self.stream, '_get_event',
+                               return_value=self.raw):
+            event = self.stream.next_failure()
+            self.assertIsNotNone(event)
+            self.assertIsNone(self.stream.next_failure())
+            self.assertIsNone(self.stream.next_failure())
+        self.assertEqual(2, self.stream.coalescer.coalesced)
+        self.assertEqual(1, len(self.stream.coalescer))
+        late = self.stream._failure_event(self.raw)
+        self.assertIs(event, self.stream.coalescer.add(late))
+
+    def test_other_builds_are_not_dropped(self):
+        coalescer = self.stream.coalescer
+        event = self.stream._failure_event(self.raw)
+        self.assertIsNone(coalescer.add(event))
+        other = self.stream._failure_event(self.raw)
+        other.failed_jobs.pop()
+        self.assertIsNone(coalescer.add(other))
+        self.assertEqual(0, coalescer.coalesced)
+
+    @mock.patch('time.time')
+    def test_window(self, time_mock):
+        coalescer = elasticRecheck.EventCoalescer(window=60)
+        time_mock.return_value = 1000
+        event = self.stream._failure_event(self.raw)
+        self.assertIsNone(coalescer.add(event))
+        time_mock.return_value = 1059
+        self.assertIs(event,
+                      coalescer.add(self.stream._failure_event(self.raw)))
+        time_mock.return_value = 1061
+        self.assertIsNone(coalescer.add(self.stream._failure_event(self.raw)))
+
+
+class FakeFeed(object):
+    def subscribe(self, callback):
+        self.callback = callback
+
+
+class TestReadinessFeed(StreamTestCase):
+
+    def setUp(self):
+        super(TestReadinessFeed, self).setUp()
+        self.feed = FakeFeed()
+        self.stream = elasticRecheck.Stream("", "", "", feed=self.feed)
+
+    def _next_watched_failure(self):
+        # through next_failure, which has the stream watch the feed for it
+        raw = self._next_raw_failure(self.stream)
+        with mock.patch.object(self.stream, '_get_event', return_value=raw):
+            return self.stream.next_failure()
+
+    def test_advance(self):
+        scheduler = elasticRecheck.ReadinessScheduler()
+        self.assertFalse(scheduler.advance('event', 5))
+        scheduler.add('event', 100)
+        scheduler.add('other', 50)
+        self.assertTrue(scheduler.advance('event', 10))
+        # never pushed back
+        self.assertTrue(scheduler.advance('other', 60))
+        self.assertEqual(2, len(scheduler))
+        self.assertEqual('event', scheduler.pop_due(10))
+        self.assertIsNone(scheduler.pop_due(49))
+        self.assertEqual('other', scheduler.pop_due(50))
+        # the old entry of 'event' is gone
+        self.assertIsNone(scheduler.pop_due(1000))
+        self.assertEqual(0, len(scheduler))
+
+    @mock.patch('time.time')
+    def test_indexed(self, time_mock):
+        time_mock.return_value = 1000
+        event = self._next_watched_failure()
+        with mock.patch.object(self.stream, '_jobs_ready',
+                               side_effect=elasticRecheck.ConsoleNotReady()):
+            self.assertFalse(self.stream.check_ready(event))
+        self.assertEqual(1040, self.stream.scheduler.next_due())
+
+        first, second = [job.build_short_uuid for job in event.failed_jobs]
+        self.feed.callback(first, ['job-output.txt'])
+        self.assertEqual(1040, self.stream.scheduler.next_due())
+        self.feed.callback(second)
+        # checked right away, and without asking elastic search
+        self.assertEqual(1000, self.stream.scheduler.next_due())
+        self.assertIs(event, self.stream.scheduler.pop_due(1000))
+        with mock.patch.object(self.stream.es, 'search') as search:
+            self.assertTrue(self.stream.check_ready(event))
+        self.assertFalse(search.called)
+        self.assertEqual(['job-output.txt'], event.failed_jobs[0].files)
+        self.assertEqual({}, self.stream._waiting)
+
+    def test_indexed_before_the_event(self):
+        event = self._next_failure(self.stream)
+        for job in event.failed_jobs:
+            self.feed.callback(job.build_short_uuid)
+        self.stream._watch(event)
+        self.assertTrue(all(job.ready for job in event.failed_jobs))
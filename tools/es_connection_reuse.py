@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import time
+
+import pyelasticsearch
+
+import elastic_recheck.config as er_conf
+import elastic_recheck.results as er_results
+
+QUERY = {'query': {'match_all': {}}}
+
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='Measure the connection setup time saved by sharing one '
+                    'elastic search client, against a new client for every '
+                    'search')
+    parser.add_argument('--conf', help="Elastic Recheck Configuration file",
+                        default=None)
+    parser.add_argument('-n', '--searches', type=int, default=100,
+                        help="Number of searches of each kind")
+    return parser.parse_args()
+
+
+def fresh_clients(url, searches):
+    start = time.time()
+    for i in range(searches):
+        pyelasticsearch.ElasticSearch(url).search(QUERY, size=0)
+    return time.time() - start
+
+
+def shared_client(url, searches, config):
+    es = er_results.get_client(url, pool_size=config.es_pool_size,
+                               timeout=config.es_timeout)
+    start = time.time()
+    for i in range(searches):
+        es.search(QUERY, size=0)
+    return time.time() - start, er_results.connections(es)
+
+
+def main():
+    opts = get_options()
+    config = er_conf.Config(config_file=opts.conf)
+    fresh = fresh_clients(config.es_url, opts.searches)
+    shared, (opened, requested) = shared_client(config.es_url,
+                                                opts.searches, config)
+    per_1000 = 1000.0 / opts.searches
+    print("new client per search: %.2fs per 1000 searches, %d connections" %
+          (fresh * per_1000, opts.searches))
+    print("shared client:         %.2fs per 1000 searches, %d connections "
+          "for %d requests" % (shared * per_1000, opened, requested))
+    print("saved:                 %.2fs per 1000 searches" %
+          ((fresh - shared) * per_1000))
+
+
+if __name__ == "__main__":
+    main()